@@ -1,21 +1,79 @@
 import streamlit as st
+import atexit
+import functools
 import os
-import json
-from datetime import datetime
-from dotenv import load_dotenv
-import requests
-from urllib.parse import urlencode, parse_qs, urlparse
-from providers import PROVIDERS
-
-load_dotenv()
-
-try:
-    from google.cloud import bigquery
-    from google.oauth2 import service_account
-    from google.cloud.exceptions import NotFound
-    BIGQUERY_AVAILABLE = True
-except ImportError:
-    BIGQUERY_AVAILABLE = False
+import time
+from typing import List, Optional
+from urllib.parse import urlencode
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import metrics
+import profiling
+from providers import get_catalog
+from providers.avatars import get_avatar_cache
+from providers.cassette import get_cassette
+from providers.flow import FLOW_TIMEOUT, ExchangeResult, ProviderFlow, exchange_many, resume_grant
+from providers.refresh import configured_providers, get_store_refresher
+from providers.ttlcache import token_key
+from providers.validation import validate
+from storage import BIGQUERY_AVAILABLE
+from storage.fleet import get_fleet
+from storage.pending_flows import platform_from_state
+from storage.rows import CompactTokens, accounts_from_row, build_token_row, tokens_from_row, user_info_from_row
+from storage.session_memory import get_session_memory
+from storage.token_store import DEFAULT_STORE_PATH, get_store
+from storage.writer import DEFAULT_SPOOL_PATH, get_writer
+
+
+@st.cache_resource(show_spinner=False)
+def load_environment() -> None:
+    # Read .env once per process rather than on every rerun
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+load_environment()
+
+@st.cache_resource(show_spinner=False)
+def setup_storage():
+    store = get_store(os.getenv("TOKEN_STORE_PATH", DEFAULT_STORE_PATH))
+    writer = None
+    if BIGQUERY_AVAILABLE and os.getenv("BIGQUERY_ACCOUNT") and os.getenv("BIGQUERY_TABLE"):
+        from storage.bigquery_sink import get_sink
+        
+        # Started on first run so rows spooled before a crash are replayed
+        writer = get_writer(
+            get_sink(os.getenv("BIGQUERY_ACCOUNT"), os.getenv("BIGQUERY_TABLE")),
+            os.getenv("BIGQUERY_SPOOL_PATH", DEFAULT_SPOOL_PATH)
+        )
+        # BigQuery is a replica fed from the local store
+        store.add_replica(writer.submit)
+    return store, writer
+
+
+token_store, token_writer = setup_storage()
+session_memory = get_session_memory(token_store)
+
+@st.cache_resource(show_spinner=False)
+def start_token_refresh():
+    # One refresher per process keeps every stored token ahead of its expiry
+    providers = configured_providers()
+    if os.getenv("BACKGROUND_REFRESH", "1") == "0" or not providers:
+        return None
+    refresher = get_store_refresher(token_store, providers).start()
+    atexit.register(refresher.stop)
+    return refresher
+
+
+token_refresher = start_token_refresh()
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server() -> None:
+    # One scrape endpoint per process, shared by every session
+    if os.getenv("METRICS_PORT"):
+        metrics.start_server(int(os.getenv("METRICS_PORT")))
+
+
+start_metrics_server()
 
 st.set_page_config(
     page_title="OAuth2 Playground",
@@ -24,472 +82,635 @@ st.set_page_config(
 
 st.title("OAuth2 Authentication Playground")
 
-if 'auth_code' not in st.session_state:
-    st.session_state.auth_code = None
-if 'tokens' not in st.session_state:
-    st.session_state.tokens = None
-if 'user_info' not in st.session_state:
-    st.session_state.user_info = None
-if 'provider_instance' not in st.session_state:
-    st.session_state.provider_instance = None
+# One flow per provider, kept when the provider is deselected so switching
+# back does not lose a code or tokens
+if 'flows' not in st.session_state:
+    st.session_state.flows = {}
 if 'code_just_extracted' not in st.session_state:
-    st.session_state.code_just_extracted = False
-if 'saved_to_bigquery' not in st.session_state:
-    st.session_state.saved_to_bigquery = False
-if 'last_selected_provider' not in st.session_state:
-    st.session_state.last_selected_provider = None
-
-code_extracted_this_run = False
-try:
-    if hasattr(st, 'query_params'):
-        query_params = st.query_params
-        if query_params and 'code' in query_params:
-            code = query_params.get('code')
-            if isinstance(code, list):
-                code = code[0] if code else None
-            if code and str(code).strip() and code != st.session_state.auth_code:
-                st.session_state.auth_code = str(code).strip()
-                st.session_state.code_just_extracted = True
-                code_extracted_this_run = True
-                try:
-                    new_params = dict(query_params)
-                    new_params.pop('code', None)
-                    if 'scope' in new_params:
-                        new_params.pop('scope', None)
-                    st.query_params = new_params
-                except:
-                    pass
-                st.rerun()
-except:
-    pass
+    st.session_state.code_just_extracted = None
+if 'token_validations' not in st.session_state:
+    st.session_state.token_validations = {}
+if 'run_counts' not in st.session_state:
+    st.session_state.run_counts = {"script": 0, "fragment": 0}
 
-with st.sidebar:
-    st.header("Configuration")
-    
-    env_vars_to_check = []
-    for provider_class in PROVIDERS.values():
-        provider = provider_class()
-        env_vars = provider.get_env_vars()
-        env_vars_to_check.extend([os.getenv(env_vars.get("client_id", "")), 
-                                  os.getenv(env_vars.get("client_secret", ""))])
-    
-    env_loaded = any(env_vars_to_check)
-    if env_loaded:
-        st.caption("Values loaded from .env file")
+# Fragments re-executed on their own are counted separately from full runs
+run_started = time.perf_counter()
+st.session_state.run_counts["script"] += 1
+st.session_state.in_script_run = True
+
+
+def session_id() -> str:
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+
+def touch_session() -> None:
+    # Restores the flows on screen if this session was spilled while idle
+    session_memory.touch(session_id(), st.session_state.flows, st.session_state.selected_providers)
+
+
+def record_fragment_run(name: str, seconds: float) -> None:
+    metrics.REGISTRY.observe(f"fragment_run:{name}", "", seconds)
+    if not st.session_state.get("in_script_run"):
+        st.session_state.run_counts["fragment"] += 1
+
+
+def timed_fragment(func):
+    """``st.fragment`` that also records how long each execution takes."""
+    @st.fragment
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        if not st.session_state.get("in_script_run"):
+            touch_session()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_fragment_run(func.__name__, time.perf_counter() - started)
+    return wrapper
+
+
+catalog = get_catalog()
+
+if 'selected_providers' not in st.session_state:
+    st.session_state.selected_providers = catalog.names()[:1]
+
+touch_session()
+
+
+def get_flow(name: str) -> ProviderFlow:
+    flows = st.session_state.flows
+    if name not in flows:
+        # Each flow holds a provider object carrying only the user's overrides
+        flows[name] = ProviderFlow(catalog.create(name))
+    # Callbacks run before the script touches the session, so flows are restored here too
+    session_memory.restore(session_id(), name, flows[name])
+    return flows[name]
+
+
+def selected_flows() -> List[ProviderFlow]:
+    return [get_flow(name) for name in st.session_state.selected_providers]
+
+
+def query_param(name: str) -> Optional[str]:
+    value = st.query_params.get(name)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value).strip() if value and str(value).strip() else None
+
+
+# The provider redirects back with ?code=...&state=...; the state names the
+# provider the code belongs to. Take the code into that provider's flow and
+# drop it from the URL so it is not picked up again. The state may have been
+# issued by another session or replica; the exchange verifies it against
+# the shared pending-flow store
+url_code = query_param('code')
+if url_code:
+    url_state = query_param('state')
+    platform = platform_from_state(url_state)
+    callback_provider = (
+        catalog.name_for_platform(platform) if platform else None
+    ) or (st.session_state.selected_providers or catalog.names())[0]
+    flow = get_flow(callback_provider)
+    if url_code != flow.auth_code:
+        flow.auth_code = url_code
+        flow.callback_state = url_state
+        st.session_state[f"{callback_provider}_auth_code_input"] = url_code
+        st.session_state.code_just_extracted = callback_provider
+        if callback_provider not in st.session_state.selected_providers:
+            st.session_state.selected_providers = st.session_state.selected_providers + [callback_provider]
+    for param in ('code', 'scope', 'state'):
+        st.query_params.pop(param, None)
+
+
+@timed_fragment
+def metrics_panel() -> None:
+    if st.checkbox("Show latency metrics", key="show_metrics"):
+        snapshot = metrics.REGISTRY.snapshot()
+        if snapshot:
+            st.dataframe(
+                [
+                    {
+                        "phase": entry["phase"],
+                        "provider": entry["provider"],
+                        "count": entry["count"],
+                        "errors": entry["errors"],
+                        "mean ms": round(entry["mean_seconds"] * 1000, 1),
+                        "p50 ms": entry["p50_seconds"] * 1000,
+                        "p95 ms": entry["p95_seconds"] * 1000,
+                    }
+                    for entry in snapshot
+                ],
+                hide_index=True
+            )
+        else:
+            st.caption("No phases recorded yet")
+        run_counts = st.session_state.run_counts
+        st.caption(
+            f"This session: {run_counts['script']} script runs, "
+            f"{run_counts['fragment']} fragment reruns; "
+            f"last script run {st.session_state.get('last_run_seconds', 0) * 1000:.0f} ms"
+        )
+        memory = session_memory.status()
+        st.caption(
+            f"Session memory: {memory['bytes'] / 1024:.0f} KiB of {memory['budget'] / 1048576:.0f} MiB "
+            f"in {memory['sessions']} sessions; {memory['spilled_flows']} flows spilled, "
+            f"avatar cache {get_avatar_cache().bytes / 1024:.0f} KiB"
+        )
+        cassette = get_cassette()
+        if cassette:
+            st.caption(
+                f"HTTP cassette ({cassette.mode}): {cassette.recorded} recorded, "
+                f"{cassette.replayed} replayed, {cassette.path}"
+            )
+        profiler = profiling.get_profiler()
+        if profiler and st.button("Write phase profiles", key="write_profiles"):
+            paths = profiler.dump()
+            st.caption(f"Wrote {len(paths) - 1} phase profiles and a summary to {profiler.directory}")
+
+
+
+def configure_provider(provider_instance) -> None:
+    name = provider_instance.name
+    spec = provider_instance.spec
+    label_prefix = "" if spec.editable_endpoints else f"{name} "
+    defaults = provider_instance.defaults
     
-    provider_names = list(PROVIDERS.keys()) + ["Custom"]
-    selected_provider_name = st.selectbox(
-        "Select OAuth2 Provider",
-        provider_names,
-        key="provider_selectbox"
+    provider_instance.client_id = st.text_input(
+        f"{label_prefix}Client ID",
+        value=defaults.client_id,
+        type="default",
+        key=f"{name}_client_id"
     )
-    
-    # Check if provider changed and force rerun to refresh values from .env
-    if st.session_state.last_selected_provider is not None and st.session_state.last_selected_provider != selected_provider_name:
-        st.session_state.last_selected_provider = selected_provider_name
-        st.rerun()
-    else:
-        st.session_state.last_selected_provider = selected_provider_name
-    
-    if selected_provider_name in PROVIDERS:
-        provider_instance = PROVIDERS[selected_provider_name]()
-        st.session_state.provider_instance = provider_instance
-        
-        # Always use fresh env values when provider instance is created
-        client_id = st.text_input(
-            f"{selected_provider_name} Client ID",
-            value=provider_instance.client_id,
+    provider_instance.client_secret = st.text_input(
+        f"{label_prefix}Client Secret",
+        value=defaults.client_secret,
+        type="password",
+        key=f"{name}_client_secret"
+    )
+    provider_instance.redirect_uri = st.text_input(
+        "Redirect URI",
+        value=defaults.redirect_uri,
+        type="default",
+        key=f"{name}_redirect_uri"
+    )
+    if spec.editable_endpoints:
+        provider_instance.auth_url = st.text_input(
+            "Authorization URL",
+            value=defaults.auth_url,
             type="default",
-            key=f"{selected_provider_name}_client_id"
+            key=f"{name}_auth_url"
         )
-        client_secret = st.text_input(
-            f"{selected_provider_name} Client Secret",
-            value=provider_instance.client_secret,
-            type="password",
-            key=f"{selected_provider_name}_client_secret"
+        provider_instance.token_url = st.text_input(
+            "Token URL",
+            value=defaults.token_url,
+            type="default",
+            key=f"{name}_token_url"
         )
-        redirect_uri = st.text_input(
-            "Redirect URI",
-            value=provider_instance.redirect_uri,
+        provider_instance.userinfo_url = st.text_input(
+            "User Info URL",
+            value=defaults.userinfo_url,
             type="default",
-            key=f"{selected_provider_name}_redirect_uri"
+            key=f"{name}_userinfo_url"
         )
-        scope = st.text_input(
-            "Scopes (comma-separated)",
-            value=provider_instance.scope,
+        provider_instance.oidc_issuer = st.text_input(
+            "OIDC Issuer (optional)",
+            value=defaults.oidc_issuer,
             type="default",
-            key=f"{selected_provider_name}_scope"
+            key=f"{name}_oidc_issuer",
+            help="Enables discovery and local id_token verification"
         )
+    provider_instance.scope = st.text_input(
+        "Scopes (comma-separated)",
+        value=defaults.scope,
+        type="default",
+        key=f"{name}_scope"
+    )
+
+
+with st.sidebar:
+    st.header("Configuration")
+    
+    if catalog.env_loaded:
+        st.caption("Values loaded from .env file")
+    
+    selected_names = st.multiselect(
+        "OAuth2 Providers",
+        catalog.names(),
+        key="selected_providers",
+        help="Selected providers are authorized, exchanged and saved together"
+    )
+    
+    for name in selected_names:
+        with st.expander(name, expanded=len(selected_names) == 1):
+            configure_provider(get_flow(name).provider)
+    
+    metrics_panel()
+
+
+def is_configured(provider_instance) -> bool:
+    return bool(
+        provider_instance.client_id and provider_instance.client_id.strip()
+        and provider_instance.client_secret and provider_instance.client_secret.strip()
+    )
+
+
+def exchange_tokens() -> None:
+    """
+    Exchange button callback; runs before the script so the same run shows
+    the result. Every selected provider with a pending code is exchanged
+    at once, post-exchange steps included.
+    """
+    messages = st.session_state.exchange_messages = []
+    codes = {}
+    for flow in selected_flows():
+        name = flow.provider.name
+        # Read the widget itself: a code typed just before the click has not
+        # been through a panel run yet
+        auth_code = st.session_state.get(f"{name}_auth_code_input", flow.auth_code or "").strip()
+        flow.auth_code = auth_code or None
+        if auth_code and is_configured(flow.provider):
+            codes[name] = (flow.provider, auth_code, flow.state)
+    if not codes:
+        messages.append(("error", "Authorization Code required"))
+        return
+    
+    with st.spinner("Exchanging authorization codes for tokens..."):
+        results = exchange_many(codes, timeout=FLOW_TIMEOUT)
+    
+    for name, result in results.items():
+        prefix = f"{name}: " if len(results) > 1 else ""
+        flow = get_flow(name)
+        # The state was redeemed either way; the next authorization needs a new one
+        flow.restart()
+        if isinstance(result, Exception):
+            messages.append(("error", f"{prefix}Error exchanging code: {str(result)}"))
+            response = getattr(result, 'response', None)
+            if response is not None:
+                try:
+                    messages.append(("json", response.json()))
+                except ValueError:
+                    messages.append(("text", response.text))
+            continue
         
-        provider_instance.client_id = client_id
-        provider_instance.client_secret = client_secret
-        provider_instance.redirect_uri = redirect_uri
-        provider_instance.scope = scope
-        st.session_state.provider_instance = provider_instance
+        # For Facebook, the short-lived token is swapped for a long-lived one
+        long_lived = result.steps.get("long_lived_token")
+        if long_lived is not None:
+            if long_lived.ok:
+                messages.append(("info", f"✅ {prefix}Exchanged for long-lived token (60 days)"))
+            else:
+                messages.append(("warning", f"{prefix}Could not exchange for long-lived token: {str(long_lived.error)}. Using short-lived token."))
         
-        auth_url = provider_instance.get_auth_url()
-        token_url = provider_instance.get_token_url()
-        userinfo_url = provider_instance.get_userinfo_url()
+        accounts_step = result.steps.get("accounts")
+        if accounts_step is not None and not accounts_step.ok:
+            messages.append(("warning", f"{prefix}Could not discover accounts: {str(accounts_step.error)}"))
         
-    else:
-        st.session_state.provider_instance = None
-        client_id = st.text_input(
-            "Client ID",
-            value=os.getenv("APP_CLIENT_ID", ""),
-            type="default"
-        )
-        client_secret = st.text_input(
-            "Client Secret",
-            value=os.getenv("APP_CLIENT_SECRET", ""),
-            type="password"
-        )
-        redirect_uri = st.text_input(
-            "Redirect URI",
-            value=os.getenv("APP_REDIRECT_URI", "http://localhost:8501"),
-            type="default"
-        )
-        auth_url = st.text_input(
-            "Authorization URL",
-            value=os.getenv("AUTH_URL", ""),
-            type="default"
-        )
-        token_url = st.text_input(
-            "Token URL",
-            value=os.getenv("TOKEN_URL", ""),
-            type="default"
+        flow.apply(result)
+        # The code is spent; clear it so the next exchange skips this provider
+        flow.auth_code = None
+        st.session_state[f"{name}_auth_code_input"] = ""
+        messages.append(("success", f"{prefix}Tokens retrieved"))
+
+
+def clear_credentials() -> None:
+    for name in list(st.session_state.flows):
+        # Restoring first also drops a spilled payload from the store
+        get_flow(name).clear()
+        st.session_state[f"{name}_auth_code_input"] = ""
+    st.session_state.token_validations = {}
+
+
+@timed_fragment
+def authentication_panel(flow: ProviderFlow) -> None:
+    # Typing a code only re-runs this panel, not the sidebar and credentials
+    provider_instance = flow.provider
+    name = provider_instance.name
+    st.markdown(f"### {name}")
+    
+    # Re-authorizing a stored account starts from its current grant
+    accounts = {account["unique_id"]: account for account in token_store.list_accounts(provider_instance.platform)}
+    account_id = st.selectbox(
+        "Account",
+        [None, *accounts],
+        format_func=lambda unique_id: "New account" if unique_id is None else (
+            accounts[unique_id]["email"] or accounts[unique_id]["name"] or unique_id
+        ),
+        key=f"{name}_account"
+    )
+    row = token_store.get_current(provider_instance.platform, account_id) if account_id else None
+    flow.grant = CompactTokens(tokens_from_row(row)) if row else None
+    try:
+        plan = provider_instance.plan_authorization(flow.grant)
+    except Exception as e:
+        st.caption(f"Could not check the stored grant: {str(e)}")
+        plan = None
+    
+    if plan is not None and plan.action in ("refresh", "reuse"):
+        st.markdown("#### Step 1: Use Existing Grant")
+        st.info("This account has already granted every requested scope; no consent needed")
+        if st.button(
+            "Refresh Stored Token" if plan.action == "refresh" else "Use Stored Token",
+            type="primary",
+            key=f"{name}_resume_grant"
+        ):
+            try:
+                tokens = resume_grant(provider_instance, flow.grant, plan)
+            except Exception as e:
+                st.error(f"Error using stored grant: {str(e)}")
+            else:
+                flow.apply(ExchangeResult(tokens, user_info_from_row(row), {}, accounts_from_row(row)))
+                # The credentials column changes too
+                st.rerun()
+        return
+    
+    # The pending flow's state routes the callback back to this flow; a tab
+    # left open past its TTL gets a new one rather than an expired state
+    params = provider_instance.get_auth_params(flow.current_pending(), plan)
+    auth_url_full = f"{provider_instance.get_auth_url()}?{urlencode(params)}"
+    
+    st.markdown("#### Step 1: Authorize")
+    if plan is not None and plan.action == "incremental":
+        st.caption("Requesting only the scopes not granted yet: " + ", ".join(sorted(plan.missing)))
+    st.code(auth_url_full, language=None)
+    st.link_button("Start OAuth2 Flow", auth_url_full, type="primary")
+    
+    st.markdown("#### Step 2: Enter Authorization Code")
+    
+    if st.session_state.code_just_extracted == name and flow.auth_code:
+        st.success("Code extracted from URL")
+        st.session_state.code_just_extracted = None
+    
+    # Widget state is dropped while the panel is hidden; restore it from the flow
+    input_key = f"{name}_auth_code_input"
+    if input_key not in st.session_state:
+        st.session_state[input_key] = flow.auth_code or ""
+    auth_code = st.text_input(
+        "Authorization Code",
+        type="default",
+        key=input_key
+    )
+    flow.auth_code = auth_code.strip() or None
+
+
+def show_credentials(flow: ProviderFlow) -> None:
+    tab1, tab2 = st.tabs(["Tokens", "User Info"])
+    
+    with tab1:
+        st.markdown("### Tokens")
+        with st.expander("View Tokens", expanded=True):
+            tokens_display = dict(flow.tokens)
+            if "access_token" in tokens_display:
+                tokens_display["access_token"] = tokens_display["access_token"][:50] + "..."
+            st.json(tokens_display)
+        
+        if "access_token" in flow.tokens:
+            st.markdown("**Access Token (full):**")
+            st.code(flow.tokens["access_token"], language=None)
+        
+        if "refresh_token" in flow.tokens:
+            st.markdown("**Refresh Token:**")
+            st.code(flow.tokens["refresh_token"], language=None)
+        
+        st.markdown("### Token Details")
+        token_details = {}
+        if "expires_in" in flow.tokens:
+            token_details["Expires In (seconds)"] = flow.tokens["expires_in"]
+        if "token_type" in flow.tokens:
+            token_details["Token Type"] = flow.tokens["token_type"]
+        if "scope" in flow.tokens:
+            token_details["Scope"] = flow.tokens["scope"]
+        
+        if token_details:
+            st.json(token_details)
+    
+    with tab2:
+        st.markdown("### User Information")
+        if flow.user_info:
+            with st.expander("View User Info", expanded=True):
+                st.json(flow.user_info)
+                
+                if "name" in flow.user_info:
+                    st.markdown(f"**Name:** {flow.user_info['name']}")
+                elif "data" in flow.user_info and "display_name" in flow.user_info["data"]:
+                    st.markdown(f"**Display Name:** {flow.user_info['data']['display_name']}")
+                
+                if "email" in flow.user_info:
+                    st.markdown(f"**Email:** {flow.user_info['email']}")
+                
+                if "id" in flow.user_info or "sub" in flow.user_info:
+                    unique_id = flow.user_info.get('id') or flow.user_info.get('sub')
+                    st.markdown(f"**Unique ID:** {unique_id}")
+                
+                if "picture" in flow.user_info:
+                    if isinstance(flow.user_info["picture"], dict):
+                        picture_url = flow.user_info["picture"].get("data", {}).get("url", 
+                                    flow.user_info["picture"].get("url", ""))
+                    else:
+                        picture_url = flow.user_info["picture"]
+                    # Served from memory once the server has fetched it; until
+                    # then, and for hosts it does not fetch from, the browser loads it
+                    avatar = get_avatar_cache().get(picture_url, flow.provider.spec.avatar_hosts)
+                    if avatar:
+                        st.image(avatar, width=100)
+                    elif picture_url.startswith(("https://", "http://")):
+                        # Never a path: st.image would read it from the server's disk
+                        st.image(picture_url, width=100)
+        else:
+            st.info("User information not available")
+        
+        if flow.accounts:
+            show_accounts(flow.accounts)
+
+
+def show_accounts(accounts: dict) -> None:
+    st.markdown("### Accessible Accounts")
+    for edge, message in accounts.get("errors", {}).items():
+        st.warning(f"Could not list {edge.replace('_', ' ')}: {message}")
+    more = accounts.get("next_cursors", {})
+    for edge, items in accounts.items():
+        if not isinstance(items, list):
+            continue
+        st.markdown(f"**{edge.replace('_', ' ').title()}** ({len(items)}{'+' if edge in more else ''})")
+        if items:
+            st.dataframe(items, hide_index=True)
+
+
+@timed_fragment
+def validation_panel(flow: ProviderFlow) -> None:
+    provider_instance = flow.provider
+    access_token = flow.tokens.get("access_token")
+    if not access_token or not provider_instance.can_validate():
+        return
+    
+    # Results are kept per token so a new exchange never shows a stale check
+    current = token_key(access_token)
+    if st.button("Validate Token", key=f"{provider_instance.name}_validate"):
+        try:
+            st.session_state.token_validations[current] = validate(provider_instance, access_token)
+        except Exception as e:
+            st.error(f"Error validating token: {str(e)}")
+    
+    result = st.session_state.token_validations.get(current)
+    if result:
+        if result["valid"]:
+            expires = (
+                time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(result["expires_at"]))
+                if result["expires_at"] else "never"
+            )
+            st.success(f"Token is valid; expires {expires}")
+        else:
+            st.error(f"Token is not valid: {result['error']}")
+        if result["scopes"]:
+            st.caption("Granted scopes: " + ", ".join(result["scopes"]))
+
+
+@timed_fragment
+def save_panel() -> None:
+    # Saving only re-runs this panel; the writer status below is refreshed with it
+    flows = [flow for flow in selected_flows() if flow.tokens]
+    if st.button("Save Tokens", type="primary"):
+        try:
+            rows = [
+                build_token_row(
+                    flow.tokens, flow.user_info, flow.provider.platform,
+                    created_at=flow.obtained_at, accounts=flow.accounts
+                )
+                for flow in flows
+            ]
+            
+            # Every connected provider is written in one batch
+            with metrics.span("save", ",".join(sorted({row["platform"] for row in rows}))):
+                token_store.upsert_many(rows)
+            for flow in flows:
+                flow.saved = True
+            saved = "Saved to token store" if len(rows) == 1 else f"Saved {len(rows)} tokens to token store"
+            if token_writer:
+                st.success(f"{saved} and queued for BigQuery")
+            else:
+                st.success(saved)
+        except Exception as e:
+            st.error(f"Error saving tokens: {str(e)}")
+    
+    if token_writer:
+        writer_status = token_writer.status()
+        st.caption(
+            f"BigQuery writer: {writer_status['queued']} queued, "
+            f"{writer_status['flushed']} flushed, {writer_status['failed']} failed"
         )
-        userinfo_url = st.text_input(
-            "User Info URL",
-            value=os.getenv("USERINFO_URL", ""),
-            type="default"
+        if writer_status["last_error"]:
+            st.caption(f"Last BigQuery error: {writer_status['last_error']}")
+    elif BIGQUERY_AVAILABLE:
+        st.caption("Set BIGQUERY_ACCOUNT and BIGQUERY_TABLE in .env to replicate saved tokens to BigQuery")
+    else:
+        st.caption("Install google-cloud-bigquery to replicate saved tokens to BigQuery")
+    if token_refresher:
+        refresh_status = token_refresher.status()
+        st.caption(
+            f"Background refresh: {refresh_status['scheduled']} scheduled, "
+            f"{refresh_status['refreshed']} refreshed, {refresh_status['failed']} failed"
         )
-        scope = st.text_input(
-            "Scopes (comma-separated)",
-            value="openid profile",
-            type="default"
+        if refresh_status["last_error"]:
+            st.caption(f"Last refresh error: {refresh_status['last_error']}")
+
+
+@timed_fragment
+def fleet_panel() -> None:
+    # Every stored token, not just this session's; only loaded when asked for
+    if not st.checkbox("Show token fleet health", key="show_fleet"):
+        return
+    horizon = st.slider("At risk within (hours)", 1, 168, 24, key="fleet_horizon")
+    report = get_fleet(token_store).report(horizon)
+    if not report.total:
+        st.info("No saved tokens yet")
+        return
+    
+    at_risk = report.at_risk.sum()
+    metric_cols = st.columns(3)
+    metric_cols[0].metric("Stored tokens", report.total)
+    metric_cols[1].metric(f"Expiring within {horizon}h", int(at_risk["expiring"]))
+    metric_cols[2].metric(
+        "At risk", int(at_risk["at_risk"]),
+        help="Access token expires within the window and no refresh token outlives it"
+    )
+    
+    st.markdown("**Access token expiry**")
+    st.dataframe(report.buckets)
+    st.markdown("**At risk by platform**")
+    st.dataframe(report.at_risk)
+    
+    st.markdown(f"**Refresh tokens expiring per day (next {len(report.refresh_cliffs)} days)**")
+    cliffs = report.refresh_cliffs
+    if cliffs.to_numpy().any():
+        st.bar_chart(cliffs)
+        peak = cliffs.sum(axis=1)
+        st.caption(f"Largest cliff: {int(peak.max())} refresh tokens expire on {peak.idxmax()}")
+    else:
+        st.caption("No refresh tokens expire in this period")
+    
+    st.markdown("**Scope coverage**")
+    if report.scope_coverage.empty:
+        st.caption("No stored token records its scopes")
+    else:
+        st.dataframe(
+            report.scope_coverage,
+            column_config={"coverage": st.column_config.ProgressColumn("coverage", min_value=0.0, max_value=1.0)},
+            hide_index=True
         )
 
+
+flows = selected_flows()
+
 col1, col2 = st.columns(2)
 
 with col1:
     st.header("Authentication")
     
-    if not client_id or not client_secret:
-        st.warning("Configure Client ID and Client Secret")
-    else:
-        if st.session_state.provider_instance:
-            params = st.session_state.provider_instance.get_auth_params()
+    if not flows:
+        st.info("Select a provider in the sidebar")
+    for flow in flows:
+        if not is_configured(flow.provider):
+            st.warning(f"Configure {flow.provider.name} Client ID and Client Secret")
         else:
-            params = {
-                "client_id": client_id,
-                "redirect_uri": redirect_uri,
-                "response_type": "code",
-                "scope": scope.replace(",", " "),
-            }
-        
-        auth_url_full = f"{auth_url}?{urlencode(params)}"
-        
-        st.markdown("### Step 1: Authorize")
-        st.code(auth_url_full, language=None)
-        st.link_button("Start OAuth2 Flow", auth_url_full, type="primary")
-        
-        st.markdown("### Step 2: Enter Authorization Code")
-        
-        if st.session_state.code_just_extracted and st.session_state.auth_code:
-            st.success("Code extracted from URL")
-            st.session_state.code_just_extracted = False
-        
-        try:
-            if hasattr(st, 'query_params'):
-                query_params = st.query_params
-                if query_params and 'code' in query_params:
-                    url_code = query_params.get('code')
-                    if isinstance(url_code, list):
-                        url_code = url_code[0] if url_code else None
-                    if url_code and str(url_code).strip() and url_code != st.session_state.auth_code:
-                        if st.button("Extract Code from URL", type="secondary", key="extract_code_btn"):
-                            st.session_state.auth_code = str(url_code).strip()
-                            st.rerun()
-        except:
-            pass
-        
-        auth_code = st.text_input(
-            "Authorization Code",
-            value=st.session_state.auth_code or "",
-            type="default"
+            authentication_panel(flow)
+    
+    if any(is_configured(flow.provider) for flow in flows):
+        # Exchanging changes both columns, so it is a callback on a full run
+        # rather than part of the fragment
+        st.button(
+            "Exchange Codes for Tokens" if len(flows) > 1 else "Exchange Code for Tokens",
+            type="primary",
+            on_click=exchange_tokens
         )
-        
-        if auth_code:
-            st.session_state.auth_code = auth_code
-            
-            if st.button("Exchange Code for Tokens", type="primary"):
-                if not client_secret or not client_secret.strip():
-                    st.error("Client Secret required")
-                elif not client_id or not client_id.strip():
-                    st.error("Client ID required")
-                else:
-                    with st.spinner("Exchanging authorization code for tokens..."):
-                        try:
-                            if st.session_state.provider_instance:
-                                token_data = st.session_state.provider_instance.get_token_data(auth_code)
-                            else:
-                                token_data = {
-                                    "code": auth_code,
-                                    "client_id": client_id,
-                                    "client_secret": client_secret,
-                                    "redirect_uri": redirect_uri,
-                                    "grant_type": "authorization_code"
-                                }
-                            
-                            response = requests.post(token_url, data=token_data)
-                            response.raise_for_status()
-                            tokens = response.json()
-                            
-                            # For Facebook, exchange short-lived token for long-lived token
-                            if st.session_state.provider_instance and st.session_state.provider_instance.name == "Facebook":
-                                if "access_token" in tokens:
-                                    short_lived_token = tokens["access_token"]
-                                    try:
-                                        long_lived_response = st.session_state.provider_instance.exchange_for_long_lived_token(short_lived_token)
-                                        # Update tokens with long-lived token data
-                                        tokens.update(long_lived_response)
-                                        st.info("✅ Exchanged for long-lived token (60 days)")
-                                    except Exception as e:
-                                        st.warning(f"Could not exchange for long-lived token: {str(e)}. Using short-lived token.")
-                            
-                            st.session_state.tokens = tokens
-                            
-                            if "access_token" in tokens:
-                                access_token = tokens["access_token"]
-                                
-                                if userinfo_url:
-                                    if st.session_state.provider_instance:
-                                        if hasattr(st.session_state.provider_instance, 'get_userinfo_headers'):
-                                            headers = st.session_state.provider_instance.get_userinfo_headers(access_token)
-                                        else:
-                                            headers = {"Authorization": f"Bearer {access_token}"}
-                                        
-                                        if hasattr(st.session_state.provider_instance, 'get_userinfo_params'):
-                                            params = st.session_state.provider_instance.get_userinfo_params(access_token)
-                                            user_response = requests.get(userinfo_url, headers=headers, params=params)
-                                        else:
-                                            user_response = requests.get(userinfo_url, headers=headers)
-                                    else:
-                                        headers = {"Authorization": f"Bearer {access_token}"}
-                                        user_response = requests.get(userinfo_url, headers=headers)
-                                    
-                                    if user_response.status_code == 200:
-                                        st.session_state.user_info = user_response.json()
-                                elif st.session_state.provider_instance and st.session_state.provider_instance.name in ["Google", "Google Analytics"]:
-                                    headers = {"Authorization": f"Bearer {access_token}"}
-                                    user_response = requests.get("https://www.googleapis.com/oauth2/v3/userinfo", headers=headers)
-                                    if user_response.status_code == 200:
-                                        st.session_state.user_info = user_response.json()
-                                elif st.session_state.provider_instance and st.session_state.provider_instance.name == "Facebook":
-                                    # Facebook Graph API uses access_token as query parameter
-                                    user_response = requests.get(
-                                        "https://graph.facebook.com/v24.0/me",
-                                        params={"access_token": access_token, "fields": "id,name,email,picture"}
-                                    )
-                                    if user_response.status_code == 200:
-                                        st.session_state.user_info = user_response.json()
-                            
-                            st.success("Tokens retrieved")
-                            st.rerun()
-                            
-                        except requests.exceptions.RequestException as e:
-                            st.error(f"Error exchanging code: {str(e)}")
-                            if hasattr(e, 'response') and e.response is not None:
-                                try:
-                                    st.json(e.response.json())
-                                except:
-                                    st.text(e.response.text)
+        for kind, payload in st.session_state.pop("exchange_messages", []):
+            getattr(st, kind)(payload)
 
 with col2:
     st.header("Credentials Display")
     
-    if st.session_state.tokens:
+    connected = [flow for flow in flows if flow.tokens]
+    if connected:
         st.success("Authentication successful!")
+        if len(connected) == 1:
+            show_credentials(connected[0])
+            validation_panel(connected[0])
+        else:
+            for tab, flow in zip(st.tabs([flow.provider.name for flow in connected]), connected):
+                with tab:
+                    show_credentials(flow)
+                    validation_panel(flow)
         
-        tab1, tab2 = st.tabs(["Tokens", "User Info"])
-        
-        with tab1:
-            st.markdown("### Tokens")
-            with st.expander("View Tokens", expanded=True):
-                tokens_display = st.session_state.tokens.copy()
-                if "access_token" in tokens_display:
-                    tokens_display["access_token"] = tokens_display["access_token"][:50] + "..."
-                st.json(tokens_display)
-            
-            if "access_token" in st.session_state.tokens:
-                st.markdown("**Access Token (full):**")
-                st.code(st.session_state.tokens["access_token"], language=None)
-            
-            if "refresh_token" in st.session_state.tokens:
-                st.markdown("**Refresh Token:**")
-                st.code(st.session_state.tokens["refresh_token"], language=None)
-            
-            st.markdown("### Token Details")
-            token_details = {}
-            if "expires_in" in st.session_state.tokens:
-                token_details["Expires In (seconds)"] = st.session_state.tokens["expires_in"]
-            if "token_type" in st.session_state.tokens:
-                token_details["Token Type"] = st.session_state.tokens["token_type"]
-            if "scope" in st.session_state.tokens:
-                token_details["Scope"] = st.session_state.tokens["scope"]
-            
-            if token_details:
-                st.json(token_details)
-        
-        with tab2:
-            st.markdown("### User Information")
-            if st.session_state.user_info:
-                with st.expander("View User Info", expanded=True):
-                    st.json(st.session_state.user_info)
-                    
-                    if "name" in st.session_state.user_info:
-                        st.markdown(f"**Name:** {st.session_state.user_info['name']}")
-                    elif "data" in st.session_state.user_info and "display_name" in st.session_state.user_info["data"]:
-                        st.markdown(f"**Display Name:** {st.session_state.user_info['data']['display_name']}")
-                    
-                    if "email" in st.session_state.user_info:
-                        st.markdown(f"**Email:** {st.session_state.user_info['email']}")
-                    
-                    if "id" in st.session_state.user_info or "sub" in st.session_state.user_info:
-                        unique_id = st.session_state.user_info.get('id') or st.session_state.user_info.get('sub')
-                        st.markdown(f"**Unique ID:** {unique_id}")
-                    
-                    if "picture" in st.session_state.user_info:
-                        if isinstance(st.session_state.user_info["picture"], dict):
-                            picture_url = st.session_state.user_info["picture"].get("data", {}).get("url", 
-                                        st.session_state.user_info["picture"].get("url", ""))
-                        else:
-                            picture_url = st.session_state.user_info["picture"]
-                        if picture_url:
-                            st.image(picture_url, width=100)
-            else:
-                st.info("User information not available")
-
         st.markdown("---")
         
-        if BIGQUERY_AVAILABLE:
-            bigquery_cred_path = os.getenv("BIGQUERY_ACCOUNT", "")
-            bigquery_table_path = os.getenv("BIGQUERY_TABLE", "")
-            
-            if bigquery_cred_path and bigquery_table_path:
-                if st.button("Save to BigQuery", type="primary"):
-                    with st.spinner("Saving tokens to BigQuery..."):
-                        try:
-                            cred_path = bigquery_cred_path.strip().strip('"').strip("'")
-                            
-                            if not os.path.exists(cred_path):
-                                st.error(f"Credentials file not found: {cred_path}")
-                                raise FileNotFoundError(f"Credentials file not found: {cred_path}")
-                            
-                            with open(cred_path, 'r') as f:
-                                service_account_info = json.load(f)
-                            
-                            if 'project_id' not in service_account_info:
-                                st.error("Missing 'project_id' in service account JSON file")
-                                raise ValueError("Missing project_id")
-                            
-                            credentials = service_account.Credentials.from_service_account_info(service_account_info)
-                            
-                            table_id = bigquery_table_path
-                            table_parts = table_id.split('.')
-                            if len(table_parts) == 3:
-                                table_project = table_parts[0]
-                                client = bigquery.Client(credentials=credentials, project=table_project)
-                            else:
-                                client = bigquery.Client(credentials=credentials, project=service_account_info['project_id'])
-                            
-                            tokens = st.session_state.tokens
-                            user_info = st.session_state.user_info or {}
-                            
-                            email = ''
-                            name = ''
-                            unique_id = ''
-                            
-                            if user_info:
-                                email = user_info.get('email') or user_info.get('mail') or ''
-                                name = user_info.get('name') or user_info.get('display_name') or user_info.get('full_name') or ''
-                                if not name and (user_info.get('given_name') or user_info.get('family_name')):
-                                    name = f"{user_info.get('given_name', '')} {user_info.get('family_name', '')}".strip()
-                                unique_id = user_info.get('id') or user_info.get('sub') or user_info.get('user_id') or user_info.get('account_id') or ''
-                            
-                            if not email:
-                                st.error("Email not found in user info")
-                                raise ValueError("Missing email in user info")
-                            
-                            if not unique_id:
-                                unique_id = email
-                            
-                            if not name:
-                                name = email.split('@')[0]
-                            
-                            try:
-                                client.get_table(table_id)
-                            except NotFound:
-                                if len(table_parts) == 3:
-                                    schema = [
-                                        bigquery.SchemaField("email", "STRING", mode="REQUIRED"),
-                                        bigquery.SchemaField("name", "STRING", mode="REQUIRED"),
-                                        bigquery.SchemaField("unique_id", "STRING", mode="REQUIRED"),
-                                        bigquery.SchemaField("platform", "STRING", mode="REQUIRED"),
-                                        bigquery.SchemaField("access_token", "STRING", mode="REQUIRED"),
-                                        bigquery.SchemaField("refresh_token", "STRING", mode="NULLABLE"),
-                                        bigquery.SchemaField("expires_in", "INTEGER", mode="NULLABLE"),
-                                        bigquery.SchemaField("scope", "STRING", mode="NULLABLE"),
-                                        bigquery.SchemaField("token_type", "STRING", mode="NULLABLE"),
-                                        bigquery.SchemaField("refresh_token_expires_in", "INTEGER", mode="NULLABLE"),
-                                        bigquery.SchemaField("created_at", "TIMESTAMP", mode="REQUIRED")
-                                    ]
-                                    
-                                    table = bigquery.Table(table_id, schema=schema)
-                                    table = client.create_table(table)
-                                    st.info(f"Created table {table_id} with schema")
-                                    
-                                    import time
-                                    time.sleep(1)
-                            
-                            # Determine platform name
-                            platform_name = "custom"
-                            if st.session_state.provider_instance:
-                                provider_name = st.session_state.provider_instance.name.lower().replace(" ", "")
-                                platform_name = provider_name
-                            
-                            row = {
-                                "email": email,
-                                "name": name,
-                                "unique_id": str(unique_id),
-                                "platform": platform_name,
-                                "access_token": tokens.get("access_token") or "",
-                                "refresh_token": tokens.get("refresh_token") or None,
-                                "expires_in": tokens.get("expires_in"),
-                                "scope": tokens.get("scope") or None,
-                                "token_type": tokens.get("token_type") or None,
-                                "refresh_token_expires_in": tokens.get("refresh_token_expires_in"),
-                                "created_at": datetime.utcnow().isoformat()
-                            }
-                            
-                            errors = client.insert_rows_json(table_id, [row])
-                            if errors:
-                                st.error(f"Error saving to BigQuery: {errors}")
-                            else:
-                                st.success("Saved to BigQuery")
-                                st.session_state.saved_to_bigquery = True
-                        except Exception as e:
-                            st.error(f"Error saving to BigQuery: {str(e)}")
-            else:
-                st.info("Set BIGQUERY_ACCOUNT and BIGQUERY_TABLE in .env to enable BigQuery saving")
-        else:
-            st.info("Install google-cloud-bigquery to enable BigQuery saving")
+        save_panel()
         
-        if st.button("Clear Credentials", type="secondary"):
-            st.session_state.auth_code = None
-            st.session_state.tokens = None
-            st.session_state.user_info = None
-            st.session_state.saved_to_bigquery = False
-            st.rerun()
+        st.button("Clear Credentials", type="secondary", on_click=clear_credentials)
     else:
         st.info("Complete the authentication flow to see credentials here")
+
+st.markdown("---")
+st.header("Token Fleet")
+fleet_panel()
+
+st.session_state.in_script_run = False
+st.session_state.last_run_seconds = time.perf_counter() - run_started
+metrics.REGISTRY.observe("script_run", "", st.session_state.last_run_seconds)
@@ -0,0 +1,214 @@
+"""
+Storage Write API stand-in over plaintext gRPC, writing into the tables of a
+mock server so the ``storage_write`` BigQuery mode can be run and benchmarked
+locally. Needs ``google-cloud-bigquery-storage`` (for the message types).
+
+    python benchmarks/bigquery_storage_server.py --port 8765 --storage-port 8766
+    BIGQUERY_WRITE_MODE=storage_write BIGQUERY_STORAGE_ENDPOINT=127.0.0.1:8766 streamlit run app.py
+
+Supports CreateWriteStream, AppendRows (with offsets), GetWriteStream and
+FinalizeWriteStream on committed streams. An append at an offset that is
+already written is answered ALREADY_EXISTS, one past the end OUT_OF_RANGE.
+With the mock's error rate, failed appends are committed and the response
+is then lost (UNAVAILABLE), which is what offsets exist to make safe.
+"""
+import argparse
+import threading
+import time
+import uuid
+from concurrent import futures
+from datetime import datetime, timedelta
+from typing import Dict
+
+import grpc
+
+import mock_server
+
+SERVICE = "google.cloud.bigquery.storage.v1.BigQueryWrite"
+# google.rpc.Code
+INVALID_ARGUMENT = 3
+ALREADY_EXISTS = 6
+OUT_OF_RANGE = 11
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class StorageWriteServer:
+    def __init__(self, mock: mock_server.MockServer, port: int = 0, host: str = "127.0.0.1"):
+        from google.cloud.bigquery_storage_v1 import types
+
+        self.mock = mock
+        self.streams: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._types = types
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+        self._server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(SERVICE, {
+            "CreateWriteStream": grpc.unary_unary_rpc_method_handler(
+                self.create_write_stream,
+                request_deserializer=types.CreateWriteStreamRequest.deserialize,
+                response_serializer=types.WriteStream.serialize
+            ),
+            "GetWriteStream": grpc.unary_unary_rpc_method_handler(
+                self.get_write_stream,
+                request_deserializer=types.GetWriteStreamRequest.deserialize,
+                response_serializer=types.WriteStream.serialize
+            ),
+            "FinalizeWriteStream": grpc.unary_unary_rpc_method_handler(
+                self.finalize_write_stream,
+                request_deserializer=types.FinalizeWriteStreamRequest.deserialize,
+                response_serializer=types.FinalizeWriteStreamResponse.serialize
+            ),
+            "AppendRows": grpc.stream_stream_rpc_method_handler(
+                self.append_rows,
+                request_deserializer=types.AppendRowsRequest.deserialize,
+                response_serializer=types.AppendRowsResponse.serialize
+            ),
+        }),))
+        self.port = self._server.add_insecure_port(f"{host}:{port}")
+        self.host = host
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def start(self) -> "StorageWriteServer":
+        self._server.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.stop(None)
+
+    def _stream(self, name: str, context) -> Dict:
+        stream = self.streams.get(name)
+        if stream is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Stream not found: {name}")
+        return stream
+
+    def _write_stream(self, name: str, stream: Dict):
+        return self._types.WriteStream(
+            name=name,
+            type_=self._types.WriteStream.Type.COMMITTED,
+            create_time=stream["created"]
+        )
+
+    def create_write_stream(self, request, context):
+        # parent is projects/P/datasets/D/tables/T
+        parts = request.parent.split("/")
+        table = (parts[1], parts[3], parts[5])
+        if table not in self.mock.tables:
+            context.abort(grpc.StatusCode.NOT_FOUND, f"Not found: Table {'.'.join(table)}")
+        name = f"{request.parent}/streams/{uuid.uuid4().hex}"
+        with self._lock:
+            self.streams[name] = {"table": table, "rows": 0, "finalized": False, "created": datetime.utcnow()}
+        self.mock.record("bigquery_storage/CreateWriteStream")
+        return self._write_stream(name, self.streams[name])
+
+    def get_write_stream(self, request, context):
+        return self._write_stream(request.name, self._stream(request.name, context))
+
+    def finalize_write_stream(self, request, context):
+        stream = self._stream(request.name, context)
+        stream["finalized"] = True
+        return self._types.FinalizeWriteStreamResponse(row_count=stream["rows"])
+
+    def append_rows(self, requests, context):
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+        name = None
+        row_class = None
+        for request in requests:
+            time.sleep(self.mock.config.delay())
+            raw = self._types.AppendRowsRequest.pb(request)
+            name = raw.write_stream or name
+            stream = self._stream(name, context)
+            if raw.proto_rows.HasField("writer_schema"):
+                # The first request on a connection carries the row descriptor
+                file_proto = descriptor_pb2.FileDescriptorProto(name=f"{uuid.uuid4().hex}.proto", syntax="proto2")
+                file_proto.message_type.add().CopyFrom(raw.proto_rows.writer_schema.proto_descriptor)
+                pool = descriptor_pool.DescriptorPool()
+                pool.Add(file_proto)
+                row_class = message_factory.GetMessageClass(
+                    pool.FindMessageTypeByName(raw.proto_rows.writer_schema.proto_descriptor.name)
+                )
+            rows = [self._decode(row_class.FromString(data), stream["table"]) for data in raw.proto_rows.rows.serialized_rows]
+            yield self._append(name, stream, rows, raw.offset.value if raw.HasField("offset") else None, context)
+
+    def _append(self, name: str, stream: Dict, rows, offset, context):
+        types = self._types
+        route = "bigquery_storage/AppendRows"
+        with self._lock:
+            if stream["finalized"]:
+                self.mock.record(route, failed=True)
+                return types.AppendRowsResponse(
+                    error={"code": INVALID_ARGUMENT, "message": "Stream is finalized"}, write_stream=name
+                )
+            if offset is not None and offset < stream["rows"]:
+                self.mock.record(route)
+                return types.AppendRowsResponse(
+                    error={"code": ALREADY_EXISTS, "message": f"Offset {offset} already written"}, write_stream=name
+                )
+            if offset is not None and offset > stream["rows"]:
+                self.mock.record(route, failed=True)
+                return types.AppendRowsResponse(
+                    error={"code": OUT_OF_RANGE, "message": f"Offset {offset} is past the end ({stream['rows']})"},
+                    write_stream=name
+                )
+            row_errors = [
+                types.RowError(index=index, code=types.RowError.RowErrorCode.FIELDS_ERROR,
+                               message=f"missing required field(s) {', '.join(missing)}")
+                for index, missing in enumerate(self.mock.missing_required(stream["table"], row) for row in rows)
+                if missing
+            ]
+            if row_errors:
+                # All or nothing: no row of the request is written
+                self.mock.record(route, failed=True)
+                return types.AppendRowsResponse(
+                    error={"code": INVALID_ARGUMENT, "message": "Row errors"}, row_errors=row_errors, write_stream=name
+                )
+            start = stream["rows"]
+            stream["rows"] += len(rows)
+        stored = self.mock.store_rows(stream["table"], rows)
+        if self.mock.config.should_fail():
+            self.mock.record(route, failed=True, rows=stored)
+            context.abort(grpc.StatusCode.UNAVAILABLE, "injected failure after commit")
+        self.mock.record(route, rows=stored)
+        return types.AppendRowsResponse(append_result={"offset": start}, write_stream=name)
+
+    def _decode(self, message, table) -> Dict:
+        timestamps = {field["name"] for field in self.mock.tables.get(table, []) if field.get("type") == "TIMESTAMP"}
+        row = {}
+        for field, value in message.ListFields():
+            if field.name in timestamps:
+                value = (_EPOCH + timedelta(microseconds=value)).isoformat()
+            row[field.name] = value
+        return row
+
+
+def start(mock: mock_server.MockServer, port: int = 0, host: str = "127.0.0.1") -> StorageWriteServer:
+    """Serve the Storage Write API for ``mock``'s tables; port 0 picks a free port."""
+    return StorageWriteServer(mock, port, host).start()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="HTTP mock server port")
+    parser.add_argument("--storage-port", type=int, default=8766, help="Storage Write API gRPC port")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    args = parser.parse_args()
+
+    mock = mock_server.start(args.port, args.host, mock_server.MockConfig(latency=args.latency, error_rate=args.error_rate))
+    server = start(mock, args.storage_port, args.host)
+    print(f"Mock server on {mock.url}, Storage Write API on {server.endpoint}; point the app at them with:")
+    for name, value in mock.provider_env().items():
+        print(f"{name}={value}")
+    print(f"BIGQUERY_STORAGE_ENDPOINT={server.endpoint}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
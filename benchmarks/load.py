@@ -0,0 +1,302 @@
+"""
+Concurrent end-to-end load benchmark against the local mock server.
+
+Each flow builds the provider's authorize URL and follows it to a code,
+exchanges the code (token, userinfo and any post-exchange steps), builds
+the token row and saves it to a scratch token store. N flows run on C
+worker threads; throughput, p50/p95/p99 flow latency and per-phase
+timings are reported at the end.
+
+    python benchmarks/load.py --flows 500 --concurrency 32
+    python benchmarks/load.py --latency 0.05 --jitter 0.05 --error-rate 0.02
+    python benchmarks/load.py --bigquery          # replicate saves to the mock BigQuery
+    python benchmarks/load.py --bigquery --bigquery-mode storage_write   # via the gRPC stand-in
+    python benchmarks/load.py --mock-url http://127.0.0.1:8765
+    python benchmarks/load.py --pending-store redis   # state/PKCE through the Redis stand-in
+    python benchmarks/load.py --cassette .cassettes/flows.ndjson.gz --cassette-mode record --flows 20
+    python benchmarks/load.py --cassette .cassettes/flows.ndjson.gz --cassette-mode replay --latency-scale 0
+
+The mock server is started in-process unless --mock-url points at one
+started with benchmarks/mock_server.py (for storage_write, start
+benchmarks/bigquery_storage_server.py and set BIGQUERY_STORAGE_ENDPOINT).
+
+With a cassette, the mock listens on a fixed port while recording, so the
+recorded URLs match on replay, when no server runs and nothing touches the
+network. ``--latency-scale 0`` replays without provider latency, leaving
+only the app's own overhead; ``--profile-dir`` writes a cProfile per phase.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import mock_server  # noqa: E402
+import redis_server  # noqa: E402
+
+DEFAULT_PROVIDERS = "Google Analytics,Facebook"
+BIGQUERY_TABLE = "mock-project.mock_dataset.tokens"
+CASSETTE_MOCK_URL = "http://127.0.0.1:8765"
+
+
+def write_service_account(path: str, token_uri: str) -> None:
+    # The BigQuery client signs a real assertion, so the key has to be real
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+    with open(path, 'w') as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "mock-project",
+            "private_key_id": "mock",
+            "private_key": pem,
+            "client_email": "loadtest@mock-project.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": token_uri,
+        }, f)
+
+
+def run_flow(provider, store) -> None:
+    from metrics import span
+    from providers.flow import exchange_code
+    from storage.rows import build_token_row
+
+    with span("authorize", provider.platform):
+        response = provider.http_get(
+            provider.get_auth_url(),
+            params=provider.get_auth_params(),
+            allow_redirects=False
+        )
+        if response.status_code != 302:
+            response.raise_for_status()
+            raise RuntimeError(f"Authorize returned {response.status_code}, expected a redirect")
+    callback = parse_qs(urlparse(response.headers["Location"]).query)
+
+    result = exchange_code(provider, callback["code"][0], state=callback["state"][0])
+    row = build_token_row(result.tokens, result.user_info, provider.platform, accounts=result.accounts)
+    with span("save", provider.platform):
+        store.upsert(row)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run(args: argparse.Namespace) -> Dict:
+    server = None
+    if args.mock_url:
+        url = args.mock_url.rstrip("/")
+    elif args.cassette_mode == "replay":
+        url = CASSETTE_MOCK_URL
+    elif args.cassette_mode == "record":
+        server = mock_server.start(urlparse(CASSETTE_MOCK_URL).port, config=mock_server.MockConfig(
+            args.latency, args.jitter, args.error_rate, seed=args.seed
+        ))
+        url = server.url
+    else:
+        server = mock_server.start(config=mock_server.MockConfig(
+            args.latency, args.jitter, args.error_rate, seed=args.seed
+        ))
+        url = server.url
+    # The catalog reads provider URLs from the environment when first built
+    os.environ.update(mock_server.provider_env(url))
+    scratch = tempfile.mkdtemp(prefix="oauth-load-")
+    redis = None
+    if args.pending_store == "sqlite":
+        os.environ["PENDING_FLOW_STORE"] = f"sqlite:///{os.path.join(scratch, 'pending.sqlite3')}"
+    elif args.pending_store == "redis":
+        redis = redis_server.start()
+        os.environ["PENDING_FLOW_STORE"] = redis.url
+    else:
+        os.environ["PENDING_FLOW_STORE"] = "memory://"
+    storage = None
+    if args.bigquery and args.bigquery_mode == "storage_write" and server:
+        import bigquery_storage_server
+        storage = bigquery_storage_server.start(server)
+        os.environ["BIGQUERY_STORAGE_ENDPOINT"] = storage.endpoint
+
+    import metrics
+    import profiling
+    from providers import get_catalog
+    from storage.token_store import SQLiteTokenStore
+
+    cassette = None
+    if args.cassette:
+        from providers.cassette import Cassette, use_cassette
+
+        cassette = Cassette(args.cassette, args.cassette_mode, args.latency_scale)
+        use_cassette(cassette)
+    profiler = profiling.enable(args.profile_dir) if args.profile_dir else None
+
+    store = SQLiteTokenStore(os.path.join(scratch, "tokens.sqlite3"))
+    writer = None
+    if args.bigquery:
+        from storage.bigquery_sink import BigQuerySink
+        from storage.writer import BufferedTokenWriter
+
+        cred_path = os.path.join(scratch, "service_account.json")
+        write_service_account(cred_path, f"{url}/token")
+        writer = BufferedTokenWriter(
+            BigQuerySink(cred_path, BIGQUERY_TABLE, args.bigquery_mode),
+            os.path.join(scratch, "spool.ndjson"),
+            max_batch_age=0.5
+        )
+        store.add_replica(writer.submit)
+
+    catalog = get_catalog()
+    names = [name.strip() for name in args.providers.split(",") if name.strip()]
+    providers = [
+        catalog.create(name, client_id="mock-client", client_secret="mock-secret", redirect_uri="http://localhost:8501")
+        for name in names
+    ]
+
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    errors_lock = threading.Lock()
+
+    def timed(index: int) -> None:
+        started = time.perf_counter()
+        try:
+            run_flow(providers[index % len(providers)], store)
+        except Exception as e:
+            with errors_lock:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    metrics.REGISTRY.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(timed, range(args.flows)))
+    elapsed = time.perf_counter() - started
+    if writer:
+        # Drain the spool so BigQuery phases are part of the snapshot
+        writer.close()
+
+    result = {
+        "flows": args.flows,
+        "concurrency": args.concurrency,
+        "providers": names,
+        "pending_store": args.pending_store,
+        "ok": len(latencies),
+        "failed": sum(errors.values()),
+        "errors": errors,
+        "elapsed_seconds": round(elapsed, 3),
+        "flows_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.5) * 1000, 1),
+            "p95": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99": round(percentile(latencies, 0.99) * 1000, 1),
+            "max": round(max(latencies, default=0) * 1000, 1),
+        },
+        "phases": metrics.REGISTRY.snapshot(),
+        "stored_rows": store.count(),
+    }
+    if writer:
+        result["bigquery"] = dict(writer.status(), mode=args.bigquery_mode)
+    if cassette:
+        result["cassette"] = {
+            "path": args.cassette, "mode": args.cassette_mode, "latency_scale": args.latency_scale,
+            "recorded": cassette.recorded, "replayed": cassette.replayed,
+        }
+    if profiler:
+        result["profiles"] = profiler.dump()
+    if server:
+        result["mock"] = server.stats()
+        server.shutdown()
+    if redis:
+        redis.shutdown()
+    if storage:
+        storage.stop()
+    return result
+
+
+def report(result: Dict) -> None:
+    latency = result["latency_ms"]
+    print(
+        f"{result['flows']} flows x{result['concurrency']} ({', '.join(result['providers'])}; "
+        f"{result['pending_store']} pending store): "
+        f"{result['ok']} ok, {result['failed']} failed in {result['elapsed_seconds']:.2f}s "
+        f"({result['flows_per_second']:.1f} flows/s)"
+    )
+    print(f"flow latency p50={latency['p50']:.0f}ms p95={latency['p95']:.0f}ms "
+          f"p99={latency['p99']:.0f}ms max={latency['max']:.0f}ms")
+    if result["errors"]:
+        print("errors: " + ", ".join(f"{name}={count}" for name, count in result["errors"].items()))
+    print(f"\n{'phase':<22}{'provider':<18}{'count':>7}{'errors':>8}{'mean ms':>10}{'p95 ms':>9}")
+    for entry in result["phases"]:
+        print(
+            f"{entry['phase']:<22}{entry['provider'] or '-':<18}{entry['count']:>7}{entry['errors']:>8}"
+            f"{entry['mean_seconds'] * 1000:>10.1f}{entry['p95_seconds'] * 1000:>9.0f}"
+        )
+    print(f"\nstored rows: {result['stored_rows']}")
+    if "bigquery" in result:
+        status = result["bigquery"]
+        print(f"BigQuery writer ({status['mode']}): {status['flushed']} flushed, {status['failed']} failed, "
+              f"{status['queued']} queued")
+    if "cassette" in result:
+        cassette = result["cassette"]
+        print(f"cassette ({cassette['mode']}, latency x{cassette['latency_scale']}): "
+              f"{cassette['recorded']} recorded, {cassette['replayed']} replayed from {cassette['path']}")
+    if "profiles" in result:
+        print(f"profiles: {len(result['profiles']) - 1} phases written, see {result['profiles'][-1]}")
+    if "mock" in result:
+        mock = result["mock"]
+        print(f"mock server: {sum(mock['requests'].values())} requests, "
+              f"{sum(mock['errors'].values())} failed, {mock['inserted_rows']} rows inserted")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flows", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--providers", default=DEFAULT_PROVIDERS, help="comma-separated provider names, used round-robin")
+    parser.add_argument("--latency", type=float, default=0.02, help="mock latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="extra uniform mock latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of mock requests that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bigquery", action="store_true", help="replicate saved rows to the mock BigQuery")
+    parser.add_argument("--bigquery-mode", choices=["streaming", "storage_write", "load"], default="streaming",
+                        help="BigQuery write mode for --bigquery")
+    parser.add_argument("--mock-url", help="use an already running mock server")
+    parser.add_argument("--pending-store", choices=["memory", "sqlite", "redis"], default="memory",
+                        help="pending-flow backend; redis uses the in-process Redis stand-in")
+    parser.add_argument("--cassette", metavar="PATH", help="record HTTP responses to, or replay them from, this file")
+    parser.add_argument("--cassette-mode", choices=["record", "replay"], help="what to do with --cassette")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="replay: recorded latency x this; 0 replays without waiting")
+    parser.add_argument("--profile-dir", metavar="DIR", help="write cProfile stats per phase here")
+    parser.add_argument("--json", metavar="PATH", help="also write the full result as JSON")
+    args = parser.parse_args(argv)
+    if bool(args.cassette) != bool(args.cassette_mode):
+        parser.error("--cassette and --cassette-mode go together")
+    if args.cassette_mode == "replay" and args.bigquery:
+        parser.error("BigQuery calls do not go through the transport and cannot be replayed")
+
+    result = run(args)
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if result["failed"] and not args.error_rate else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,704 @@
+"""
+Local stand-in for the Google, Facebook Graph and BigQuery endpoints the
+app talks to, with configurable latency and error injection.
+
+    python benchmarks/mock_server.py --port 8765 --latency 0.05 --error-rate 0.01
+
+Routes (all under one origin):
+
+    GET  /o/oauth2/v2/auth                 Google authorize; redirects with a code
+    POST /token                            Google token endpoint (code, refresh, service account)
+    GET  /oauth2/v3/userinfo               Google userinfo (Bearer token)
+    GET  /tokeninfo                        Google token validation
+    GET  /v24.0/dialog/oauth               Facebook authorize; redirects with a code
+    GET|POST /v24.0/oauth/access_token     Graph code exchange and fb_exchange_token
+    GET  /v24.0/me                         Graph /me (access_token query parameter)
+    GET  /v24.0/debug_token                Graph token validation (app access token)
+    GET  /v24.0/me/adaccounts, /me/businesses   Graph edges with cursor paging
+    POST /v24.0                            Graph batch of the GET routes above
+    GET  /v1beta/accountSummaries, /v1beta/properties   GA Admin API lists with page tokens
+    GET|POST|PATCH /bigquery/v2/projects/.../tables[/...]   BigQuery tables.get/insert/patch
+    POST /bigquery/v2/projects/.../insertAll          BigQuery streaming insert (deduplicated by insertId)
+    POST /upload/bigquery/v2/projects/.../jobs, PUT   NDJSON load jobs (multipart or resumable upload)
+    POST /bigquery/v2/projects/.../jobs               query jobs; runs the sink's current-token MERGE
+    GET  /bigquery/v2/projects/.../jobs/ID, queries/ID   jobs.get and getQueryResults
+    GET  /_stats                           Request and injected error counts per route
+
+Tokens are derived from the authorization code, so the server is stateless
+apart from its counters and any number of flows can run against it at once.
+A PKCE challenge sent to the authorize routes is carried inside the code,
+and the token routes reject a code_verifier that does not match it.
+BigQuery rows are kept in memory per table; ``benchmarks/bigquery_storage_server.py``
+adds the Storage Write API over gRPC on top of the same tables.
+Point the app at it with the provider URL variables printed on startup.
+"""
+import argparse
+import base64
+import email.parser
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+_TABLE_PATH = re.compile(r"^/bigquery/v2/projects/([^/]+)/datasets/([^/]+)/tables(?:/([^/]+))?(/insertAll)?$")
+_JOB_PATH = re.compile(r"^(/upload)?/bigquery/v2/projects/([^/]+)/(jobs|queries)(?:/([^/]+))?$")
+_MERGE_TABLES = re.compile(r"MERGE\s+`([^`]+)`.*?\bFROM\s+`([^`]+)`", re.S)
+
+
+class MockConfig:
+    """
+    ``latency`` is added to every response, plus up to ``jitter`` seconds of
+    uniform noise. ``error_rate`` of requests fail with ``error_status``;
+    with ``retry_after`` set those failures carry a ``Retry-After`` header,
+    and failed Graph calls report exhausted ``x-app-usage``. Every Facebook
+    user has ``ad_accounts`` ad accounts and ``businesses`` businesses; every
+    Google user has ``ga_accounts`` accounts of ``ga_properties`` properties.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 503, seed: Optional[int] = None, retry_after: Optional[float] = None,
+                 ad_accounts: int = 25, businesses: int = 2, ga_accounts: int = 3, ga_properties: int = 4):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.ad_accounts = ad_accounts
+        self.businesses = businesses
+        self.ga_accounts = ga_accounts
+        self.ga_properties = ga_properties
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+def _identity(token: str) -> Dict:
+    # Stable per-user identity for a token chain (code -> token -> long-lived token)
+    digest = hashlib.sha256(token.split(":", 1)[-1].encode()).hexdigest()
+    user = str(int(digest[:12], 16))
+    return {"id": user, "email": f"user{user}@example.test", "name": f"Mock User {user}"}
+
+
+def _code_subject(code: str, code_verifier: Optional[str]) -> Optional[str]:
+    """
+    The subject of an authorization code, or None when the code carries a
+    PKCE challenge that ``code_verifier`` does not satisfy.
+    """
+    subject, _, challenge = code.split(":", 1)[-1].partition("~")
+    if challenge:
+        digest = hashlib.sha256((code_verifier or "").encode()).digest()
+        if base64.urlsafe_b64encode(digest).rstrip(b"=").decode() != challenge:
+            return None
+    return subject
+
+
+def _timestamp(value) -> datetime:
+    # Rows carry ISO strings; query parameters use a space and a UTC offset
+    return datetime.fromisoformat(str(value).replace(" ", "T")).replace(tzinfo=None)
+
+
+def _table_key(table_id: str, project: str) -> tuple:
+    parts = table_id.split(".")
+    return tuple(parts) if len(parts) == 3 else (project, *parts)
+
+
+def provider_env(url: str) -> Dict[str, str]:
+    """Environment variables that point every provider at a mock server."""
+    return {
+        "GOOGLE_ANALYTICS_AUTH_URL": f"{url}/o/oauth2/v2/auth",
+        "GOOGLE_ANALYTICS_TOKEN_URL": f"{url}/token",
+        "GOOGLE_ANALYTICS_USERINFO_URL": f"{url}/oauth2/v3/userinfo",
+        # No id_tokens are issued, so there is nothing to discover
+        "GOOGLE_ANALYTICS_OIDC_ISSUER": "",
+        "GOOGLE_ANALYTICS_API_URL": f"{url}/v1beta",
+        "GOOGLE_ANALYTICS_TOKENINFO_URL": f"{url}/tokeninfo",
+        "FACEBOOK_AUTH_URL": f"{url}/v24.0/dialog/oauth",
+        "FACEBOOK_TOKEN_URL": f"{url}/v24.0/oauth/access_token",
+        "FACEBOOK_USERINFO_URL": f"{url}/v24.0/me",
+        "FACEBOOK_API_URL": f"{url}/v24.0",
+        "FACEBOOK_TOKENINFO_URL": f"{url}/v24.0/debug_token",
+        "BIGQUERY_API_ENDPOINT": url,
+    }
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, config: MockConfig):
+        super().__init__(address, _MockHandler)
+        self.config = config
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.inserted_rows = 0
+        self.tables: Dict[tuple, list] = {}
+        self.table_rows: Dict[tuple, List[Dict]] = {}
+        self.jobs: Dict[tuple, Dict] = {}
+        self.uploads: Dict[str, Dict] = {}
+        self._insert_ids: Dict[tuple, set] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, route: str, failed: bool = False, rows: int = 0) -> None:
+        with self._lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+            if failed:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            self.inserted_rows += rows
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "requests": dict(self.counts),
+                "errors": dict(self.errors),
+                "inserted_rows": self.inserted_rows,
+                "table_rows": {".".join(key): len(rows) for key, rows in self.table_rows.items()},
+            }
+
+    def store_rows(self, table: tuple, rows: List[Dict], insert_ids: Optional[List[str]] = None) -> int:
+        """Append rows to a table, skipping insert IDs it has seen; returns the number stored."""
+        with self._lock:
+            stored = self.table_rows.setdefault(table, [])
+            seen = self._insert_ids.setdefault(table, set())
+            count = 0
+            for index, row in enumerate(rows):
+                row_id = insert_ids[index] if insert_ids else None
+                if row_id is not None:
+                    if row_id in seen:
+                        continue
+                    seen.add(row_id)
+                stored.append(row)
+                count += 1
+            return count
+
+    def missing_required(self, table: tuple, row: Dict) -> List[str]:
+        return [
+            field["name"] for field in self.tables.get(table, [])
+            if field.get("mode") == "REQUIRED" and row.get(field["name"]) in (None, "")
+        ]
+
+    def merge_current(self, current: tuple, history: tuple, since: Optional[datetime]) -> int:
+        """The sink's MERGE: newest history row per (platform, unique_id) into the current table."""
+        with self._lock:
+            latest: Dict[tuple, Dict] = {}
+            for row in self.table_rows.get(history, []):
+                if since is not None and _timestamp(row["created_at"]) < since:
+                    continue
+                key = (row["platform"], row["unique_id"])
+                rank = (_timestamp(row["created_at"]), row.get("insert_id") or "")
+                if key not in latest or rank > (_timestamp(latest[key]["created_at"]), latest[key].get("insert_id") or ""):
+                    latest[key] = row
+            rows = self.table_rows.setdefault(current, [])
+            positions = {(row["platform"], row["unique_id"]): index for index, row in enumerate(rows)}
+            affected = 0
+            for key, row in latest.items():
+                if key not in positions:
+                    rows.append(dict(row))
+                elif _timestamp(row["created_at"]) > _timestamp(rows[positions[key]]["created_at"]):
+                    rows[positions[key]] = dict(row)
+                else:
+                    continue
+                affected += 1
+            return affected
+
+    def provider_env(self) -> Dict[str, str]:
+        return provider_env(self.url)
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, keep-alive
+    # responses would stall on delayed ACKs and swamp the injected latency
+    disable_nagle_algorithm = True
+    server: MockServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_PATCH(self):
+        self._dispatch()
+
+    def do_PUT(self):
+        self._dispatch()
+
+    def _params(self) -> Dict[str, str]:
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self._body = self.rfile.read(length) if length else b""
+        if self._body and "application/x-www-form-urlencoded" in self.headers.get("Content-Type", ""):
+            params.update({key: values[0] for key, values in parse_qs(self._body.decode()).items()})
+        return params
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, params: Dict[str, str]) -> None:
+        code = f"code:{uuid.uuid4().hex}"
+        if params.get("code_challenge"):
+            if params.get("code_challenge_method") != "S256":
+                code += "~unsupported"
+            else:
+                code += f"~{params['code_challenge']}"
+        query = {"code": code}
+        if params.get("state"):
+            query["state"] = params["state"]
+        self.send_response(302)
+        self.send_header("Location", f"{params.get('redirect_uri', '')}?{urlencode(query)}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _dispatch(self):
+        path = urlparse(self.path).path
+        params = self._params()
+        table = _TABLE_PATH.match(path)
+        job = _JOB_PATH.match(path)
+        if table:
+            route = "bigquery" + (table.group(4) or "")
+        elif job:
+            route = "bigquery" + (job.group(1) or "") + "/" + job.group(3)
+        else:
+            route = path
+
+        config = self.server.config
+        time.sleep(config.delay())
+        if not path.startswith("/_") and config.should_fail():
+            self.server.record(route, failed=True)
+            headers = {}
+            if config.retry_after is not None:
+                headers["Retry-After"] = f"{config.retry_after:g}"
+            if path.startswith("/v24.0/"):
+                headers["x-app-usage"] = json.dumps({"call_count": 100, "total_time": 40, "total_cputime": 35})
+            self._send_json(config.error_status, {"error": {"message": "injected failure"}}, headers)
+            return
+
+        rows = 0
+        if path in ("/o/oauth2/v2/auth", "/v24.0/dialog/oauth"):
+            self.server.record(route)
+            self._redirect(params)
+            return
+        elif path == "/token":
+            status, payload = self._google_token(params)
+        elif path == "/oauth2/v3/userinfo":
+            status, payload = self._google_userinfo()
+        elif path == "/tokeninfo":
+            status, payload = self._google_tokeninfo(params)
+        elif path.startswith("/v1beta/"):
+            status, payload = self._analytics_admin(path, params)
+        elif path == "/v24.0/oauth/access_token":
+            status, payload = self._graph_token(params)
+        elif path == "/v24.0/debug_token":
+            status, payload = self._graph_debug_token(params)
+        elif path == "/v24.0" and self.command == "POST":
+            status, payload = self._graph_batch(params)
+        elif path.startswith("/v24.0/me"):
+            status, payload = self._graph(path, params)
+        elif table:
+            status, payload, rows = self._bigquery(table)
+        elif job and job.group(1) and params.get("uploadType") == "resumable" and self.command == "POST":
+            # Resumable upload: the job resource now, the data in a PUT to the session URL
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = json.loads(self._body or b"{}")
+            self.server.record(route)
+            self._send_json(200, {}, {"Location": f"{self.server.url}{path}?uploadType=resumable&upload_id={upload_id}"})
+            return
+        elif job and job.group(1):
+            status, payload, rows = self._load_job(job.group(2), params)
+        elif job:
+            status, payload = self._job(job.group(2), job.group(3), job.group(4))
+        elif path == "/_stats":
+            status, payload = 200, self.server.stats()
+        else:
+            status, payload = 404, {"error": {"message": f"No mock for {path}"}}
+        self.server.record(route, failed=status >= 400, rows=rows)
+        self._send_json(status, payload)
+
+    def _google_token(self, params: Dict[str, str]):
+        grant_type = params.get("grant_type")
+        if grant_type == "authorization_code" and params.get("code"):
+            seed = _code_subject(params["code"], params.get("code_verifier"))
+            if seed is None:
+                return 400, {"error": "invalid_grant", "error_description": "Invalid code verifier."}
+        elif grant_type == "refresh_token" and params.get("refresh_token"):
+            seed = params["refresh_token"]
+        elif grant_type == "urn:ietf:params:oauth:grant-type:jwt-bearer":
+            # Service account assertion from the BigQuery client
+            return 200, {"access_token": f"sa:{uuid.uuid4().hex}", "expires_in": 3599, "token_type": "Bearer"}
+        else:
+            return 400, {"error": "invalid_grant"}
+        subject = seed.split(":", 1)[-1]
+        return 200, {
+            "access_token": f"ya29:{subject}",
+            "refresh_token": f"1//:{subject}",
+            "expires_in": 3599,
+            "refresh_token_expires_in": 604799,
+            "scope": "https://www.googleapis.com/auth/analytics.readonly openid email profile",
+            "token_type": "Bearer",
+        }
+
+    def _google_userinfo(self):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return 401, {"error": "invalid_request"}
+        identity = _identity(authorization[len("Bearer "):])
+        return 200, {"sub": identity["id"], "email": identity["email"], "name": identity["name"], "email_verified": True}
+
+    def _google_tokeninfo(self, params: Dict[str, str]):
+        token = params.get("access_token", "")
+        # Only access tokens this server issued are valid
+        if not token.startswith("ya29:"):
+            return 400, {"error": "invalid_token", "error_description": "Invalid Value"}
+        identity = _identity(token)
+        return 200, {
+            "azp": "mock-client",
+            "aud": "mock-client",
+            "sub": identity["id"],
+            "scope": "https://www.googleapis.com/auth/analytics.readonly openid email profile",
+            "exp": str(int(time.time()) + 3599),
+            "expires_in": "3599",
+            "email": identity["email"],
+            "email_verified": "true",
+            "access_type": "offline",
+        }
+
+    def _analytics_admin(self, path: str, params: Dict[str, str]):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return 401, {"error": {"code": 401, "status": "UNAUTHENTICATED"}}
+        user = _identity(authorization[len("Bearer "):])["id"]
+        config = self.server.config
+
+        def account(index):
+            return f"accounts/{user}{index:03d}"
+
+        def properties(account_name):
+            return [
+                {
+                    "name": f"properties/{account_name.split('/')[1]}{index:02d}",
+                    "displayName": f"Property {index}",
+                    "parent": account_name,
+                    "propertyType": "PROPERTY_TYPE_ORDINARY",
+                    "timeZone": "Europe/Berlin",
+                    "currencyCode": "EUR",
+                }
+                for index in range(config.ga_properties)
+            ]
+
+        if path == "/v1beta/accountSummaries":
+            items = [
+                {
+                    "name": f"accountSummaries/{account(index).split('/')[1]}",
+                    "account": account(index),
+                    "displayName": f"GA Account {index}",
+                    "propertySummaries": [
+                        {"property": item["name"], "displayName": item["displayName"], "parent": item["parent"]}
+                        for item in properties(account(index))
+                    ],
+                }
+                for index in range(config.ga_accounts)
+            ]
+            key = "accountSummaries"
+        elif path == "/v1beta/properties":
+            parent = (params.get("filter") or "").partition("parent:")[2]
+            if not parent:
+                return 400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": "filter is required"}}
+            items = properties(parent)
+            key = "properties"
+        else:
+            return 404, {"error": {"code": 404, "status": "NOT_FOUND"}}
+
+        size = int(params.get("pageSize") or 50)
+        offset = int(params.get("pageToken") or 0)
+        page = {key: items[offset:offset + size]}
+        if offset + size < len(items):
+            page["nextPageToken"] = str(offset + size)
+        return 200, page
+
+    def _graph_token(self, params: Dict[str, str]):
+        if params.get("grant_type") == "fb_exchange_token" and params.get("fb_exchange_token"):
+            subject = params["fb_exchange_token"].split(":", 1)[-1]
+            return 200, {"access_token": f"EAAL:{subject}", "token_type": "bearer", "expires_in": 5183944}
+        if params.get("code"):
+            subject = _code_subject(params["code"], params.get("code_verifier"))
+            if subject is None:
+                return 400, {"error": {"message": "Invalid code verifier", "type": "OAuthException", "code": 100}}
+            return 200, {"access_token": f"EAAS:{subject}", "token_type": "bearer", "expires_in": 5400}
+        return 400, {"error": {"message": "Missing code or fb_exchange_token", "type": "OAuthException"}}
+
+    def _graph_debug_token(self, params: Dict[str, str]):
+        if "|" not in params.get("access_token", ""):
+            return 400, {"error": {"message": "Invalid OAuth access token - Cannot parse access token",
+                                   "type": "OAuthException", "code": 190}}
+        token = params.get("input_token", "")
+        app_id = params["access_token"].split("|", 1)[0]
+        if not token.startswith(("EAAS:", "EAAL:")):
+            return 200, {"data": {"is_valid": False, "scopes": [], "error": {
+                "code": 190, "message": "The access token could not be decrypted",
+            }}}
+        lifetime = 5183944 if token.startswith("EAAL:") else 5400
+        return 200, {"data": {
+            "app_id": app_id,
+            "type": "USER",
+            "application": "Mock App",
+            "data_access_expires_at": int(time.time()) + 7776000,
+            "expires_at": int(time.time()) + lifetime,
+            "is_valid": True,
+            "scopes": ["email", "public_profile", "ads_read", "business_management"],
+            "user_id": _identity(token)["id"],
+        }}
+
+    def _graph(self, path: str, params: Dict[str, str]):
+        if not params.get("access_token"):
+            return 400, {"error": {"message": "An active access token must be used", "type": "OAuthException"}}
+        identity = _identity(params["access_token"])
+        if path == "/v24.0/me":
+            return 200, {
+                "id": identity["id"],
+                "name": identity["name"],
+                "email": identity["email"],
+                "picture": {"data": {"url": f"{self.server.url}/avatar/{identity['id']}.png"}},
+            }
+        if path == "/v24.0/me/adaccounts":
+            total = self.server.config.ad_accounts
+            make = lambda index: {
+                "id": f"act_{identity['id']}{index:04d}",
+                "account_id": f"{identity['id']}{index:04d}",
+                "name": f"Ad Account {index}",
+                "account_status": 1,
+                "currency": "USD",
+            }
+        elif path == "/v24.0/me/businesses":
+            total = self.server.config.businesses
+            make = lambda index: {"id": f"{identity['id']}{index:03d}", "name": f"Business {index}"}
+        else:
+            return 404, {"error": {"message": f"Unknown path components: {path}", "type": "OAuthException"}}
+        return 200, self._page(path, params, total, make)
+
+    def _page(self, path: str, params: Dict[str, str], total: int, make):
+        # Cursors are opaque to clients; here they are just the offset
+        limit = int(params.get("limit") or 25)
+        offset = int(params.get("after") or 0)
+        end = min(offset + limit, total)
+        page = {"data": [make(index) for index in range(offset, end)], "paging": {
+            "cursors": {"before": str(offset), "after": str(end)},
+        }}
+        if end < total:
+            query = {key: value for key, value in params.items() if key != "after"}
+            query["after"] = str(end)
+            page["paging"]["next"] = f"{self.server.url}{path}?{urlencode(query)}"
+        return page
+
+    def _graph_batch(self, params: Dict[str, str]):
+        try:
+            batch = json.loads(params.get("batch") or "[]")
+        except ValueError:
+            return 400, {"error": {"message": "Invalid batch", "type": "GraphBatchException"}}
+        if len(batch) > 50:
+            return 400, {"error": {"message": "Too many requests in batch", "type": "GraphBatchException"}}
+        results = []
+        for request in batch:
+            url = urlparse("/v24.0/" + request.get("relative_url", "").lstrip("/"))
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            query.setdefault("access_token", params.get("access_token", ""))
+            status, payload = self._graph(url.path, query)
+            results.append({"code": status, "body": json.dumps(payload)})
+        return 200, results
+
+    def _bigquery(self, match):
+        project, dataset, table, insert_all = match.groups()
+        if insert_all:
+            rows = json.loads(self._body or b"{}").get("rows", [])
+            invalid = {
+                index: missing for index, missing in
+                ((index, self.server.missing_required((project, dataset, table), row["json"])) for index, row in enumerate(rows))
+                if missing
+            }
+            if invalid:
+                # Without skipInvalidRows nothing is written; valid rows are reported as stopped
+                return 200, {"kind": "bigquery#tableDataInsertAllResponse", "insertErrors": [
+                    {"index": index, "errors": [
+                        {"reason": "invalid", "message": f"Missing required field(s) {', '.join(invalid[index])}"}
+                        if index in invalid else {"reason": "stopped", "message": ""}
+                    ]}
+                    for index in range(len(rows))
+                ]}, 0
+            stored = self.server.store_rows(
+                (project, dataset, table),
+                [row["json"] for row in rows],
+                [row.get("insertId") for row in rows]
+            )
+            return 200, {"kind": "bigquery#tableDataInsertAllResponse"}, stored
+        resource = json.loads(self._body or b"{}")
+        if table is None and self.command == "POST":
+            # tables.insert; the resource names the table
+            table = resource.get("tableReference", {}).get("tableId")
+            self.server.tables[(project, dataset, table)] = resource.get("schema", {}).get("fields", [])
+        elif (project, dataset, table) not in self.server.tables:
+            return 404, {"error": {"code": 404, "message": f"Not found: Table {project}:{dataset}.{table}"}}, 0
+        elif self.command == "PATCH" and "schema" in resource:
+            self.server.tables[(project, dataset, table)] = resource["schema"].get("fields", [])
+        return 200, {
+            "kind": "bigquery#table",
+            "id": f"{project}:{dataset}.{table}",
+            "tableReference": {"projectId": project, "datasetId": dataset, "tableId": table},
+            "schema": {"fields": self.server.tables[(project, dataset, table)]},
+        }, 0
+
+
+    def _load_job(self, project: str, params: Dict[str, str]):
+        if params.get("upload_id"):
+            resource = self.server.uploads.pop(params["upload_id"], None)
+            if resource is None:
+                return 404, {"error": {"code": 404, "message": "Unknown upload session"}}, 0
+            data = self._body
+        else:
+            # multipart/related: the job resource, then the file
+            message = email.parser.BytesParser().parsebytes(
+                b"Content-Type: " + self.headers.get("Content-Type", "").encode() + b"\r\n\r\n" + self._body
+            )
+            parts = message.get_payload()
+            resource = json.loads(parts[0].get_payload(decode=True))
+            data = parts[1].get_payload(decode=True)
+
+        reference = dict(resource.get("jobReference") or {}, projectId=project)
+        reference.setdefault("jobId", uuid.uuid4().hex)
+        key = (project, reference["jobId"])
+        if key in self.server.jobs:
+            return 409, {"error": {"code": 409, "message": f"Already Exists: Job {project}:{reference['jobId']}"}}, 0
+
+        destination = resource["configuration"]["load"]["destinationTable"]
+        table = (destination["projectId"], destination["datasetId"], destination["tableId"])
+        rows = [json.loads(line) for line in data.decode().splitlines() if line.strip()]
+        invalid = next((
+            (index, missing) for index, missing in
+            ((index, self.server.missing_required(table, row)) for index, row in enumerate(rows)) if missing
+        ), None)
+        status = {"state": "DONE"}
+        stored = 0
+        if table not in self.server.tables:
+            status["errorResult"] = {"reason": "notFound", "message": f"Not found: Table {'.'.join(table)}"}
+        elif invalid:
+            # Load jobs are all or nothing
+            status["errorResult"] = {
+                "reason": "invalid",
+                "message": f"Row {invalid[0]}: missing required field(s) {', '.join(invalid[1])}"
+            }
+        else:
+            stored = self.server.store_rows(table, rows)
+        job = dict(resource, jobReference=reference, status=status, statistics={"load": {"outputRows": str(stored)}})
+        self.server.jobs[key] = job
+        return 200, job, stored
+
+    def _job(self, project: str, kind: str, job_id: Optional[str]):
+        if job_id is not None:
+            job = self.server.jobs.get((project, job_id))
+            if job is None:
+                return 404, {"error": {"code": 404, "message": f"Not found: Job {project}:{job_id}"}}
+            if kind == "jobs":
+                return 200, job
+            return 200, {
+                "kind": "bigquery#getQueryResultsResponse",
+                "jobReference": job["jobReference"],
+                "jobComplete": True,
+                "totalRows": "0",
+                "schema": {"fields": []},
+                "numDmlAffectedRows": job["statistics"]["query"]["numDmlAffectedRows"],
+            }
+
+        resource = json.loads(self._body or b"{}")
+        reference = dict(resource.get("jobReference") or {}, projectId=project)
+        reference.setdefault("jobId", uuid.uuid4().hex)
+        if (project, reference["jobId"]) in self.server.jobs:
+            return 409, {"error": {"code": 409, "message": f"Already Exists: Job {project}:{reference['jobId']}"}}
+        query = resource.get("configuration", {}).get("query", {})
+        tables = _MERGE_TABLES.search(query.get("query", ""))
+        if not tables:
+            return 400, {"error": {"code": 400, "message": "The mock only runs the current-token MERGE"}}
+        since = next((
+            parameter["parameterValue"].get("value") for parameter in query.get("queryParameters", [])
+            if parameter.get("name") == "since"
+        ), None)
+        affected = self.server.merge_current(
+            _table_key(tables.group(1), project),
+            _table_key(tables.group(2), project),
+            _timestamp(since) if since else None
+        )
+        job = dict(
+            resource,
+            jobReference=reference,
+            status={"state": "DONE"},
+            statistics={"query": {"numDmlAffectedRows": str(affected), "statementType": "MERGE"}}
+        )
+        self.server.jobs[(project, reference["jobId"])] = job
+        return 200, job
+
+
+def start(port: int = 0, host: str = "127.0.0.1", config: Optional[MockConfig] = None) -> MockServer:
+    """Start a mock server on a daemon thread; port 0 picks a free port."""
+    server = MockServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds, uniform")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with injected failures")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--ad-accounts", type=int, default=25, help="ad accounts per Facebook user")
+    parser.add_argument("--businesses", type=int, default=2, help="businesses per Facebook user")
+    parser.add_argument("--ga-accounts", type=int, default=3, help="Analytics accounts per Google user")
+    parser.add_argument("--ga-properties", type=int, default=4, help="properties per Analytics account")
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), MockConfig(
+        args.latency, args.jitter, args.error_rate, args.error_status, args.seed, args.retry_after,
+        args.ad_accounts, args.businesses, args.ga_accounts, args.ga_properties
+    ))
+    print(f"Mock server on {server.url}; point the app at it with:")
+    for name, value in server.provider_env().items():
+        print(f"{name}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Minimal Redis-protocol (RESP2) server for the pending-flow store, so the
+Redis backend can be run and benchmarked without a Redis install.
+
+    python benchmarks/redis_server.py --port 6390
+    PENDING_FLOW_STORE=redis://127.0.0.1:6390/0 streamlit run app.py
+
+Supports PING, SELECT, CLIENT, SET (EX/PX/NX/XX), GET, GETDEL, DEL, EXISTS,
+PTTL, DBSIZE and FLUSHDB/FLUSHALL with key expiry; one keyspace shared by
+all databases. Not a Redis replacement: nothing is persisted.
+"""
+import argparse
+import socket
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class RedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _RedisHandler)
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def _live(self, key: bytes) -> Optional[bytes]:
+        # Caller holds the lock; expired keys are dropped when touched
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return entry[0]
+
+    def execute(self, args: List[bytes]):
+        name = args[0].upper().decode()
+        with self.lock:
+            self.commands += 1
+            if name == "PING":
+                return ("simple", args[1] if len(args) > 1 else b"PONG")
+            if name in ("SELECT", "CLIENT"):
+                return ("simple", b"OK")
+            if name == "SET":
+                return self._set(args[1], args[2], [arg.upper() for arg in args[3:]], args[3:])
+            if name == "GET":
+                return self._live(args[1])
+            if name == "GETDEL":
+                value = self._live(args[1])
+                self.data.pop(args[1], None)
+                return value
+            if name == "DEL":
+                return sum(1 for key in args[1:] if self._live(key) is not None and self.data.pop(key))
+            if name == "EXISTS":
+                return sum(1 for key in args[1:] if self._live(key) is not None)
+            if name == "PTTL":
+                if self._live(args[1]) is None:
+                    return -2
+                expires_at = self.data[args[1]][1]
+                return -1 if expires_at is None else int((expires_at - time.monotonic()) * 1000)
+            if name == "DBSIZE":
+                return len(self.data)
+            if name in ("FLUSHDB", "FLUSHALL"):
+                self.data.clear()
+                return ("simple", b"OK")
+        return ("error", f"ERR unknown command '{name}'".encode())
+
+    def _set(self, key: bytes, value: bytes, options: List[bytes], raw: List[bytes]):
+        expires_at = None
+        for index, option in enumerate(options):
+            if option == b"EX":
+                expires_at = time.monotonic() + float(raw[index + 1])
+            elif option == b"PX":
+                expires_at = time.monotonic() + float(raw[index + 1]) / 1000
+        exists = self._live(key) is not None
+        if b"NX" in options and exists or b"XX" in options and not exists:
+            return None
+        self.data[key] = (value, expires_at)
+        return ("simple", b"OK")
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+    server: RedisServer
+
+    def setup(self):
+        super().setup()
+        # Replies are small; do not hold them back waiting for ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            try:
+                reply = self.server.execute(args)
+            except (IndexError, ValueError):
+                reply = ("error", b"ERR syntax error")
+            self.wfile.write(_encode(reply))
+            self.wfile.flush()
+
+    def _read_command(self) -> Optional[List[bytes]]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, as typed into telnet
+            return line.split() or [b"PING"]
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+
+def _encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    kind, value = reply
+    return (b"+" if kind == "simple" else b"-") + value + b"\r\n"
+
+
+def start(port: int = 0, host: str = "127.0.0.1") -> RedisServer:
+    """Start a server on a daemon thread; port 0 picks a free port."""
+    server = RedisServer((host, port))
+    threading.Thread(target=server.serve_forever, name="redis-server", daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server = RedisServer((args.host, args.port))
+    print(f"Redis-protocol server on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
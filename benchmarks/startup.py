@@ -0,0 +1,110 @@
+"""
+Cold-start and warm-rerun latency benchmark for app.py.
+
+Cold start is measured from spawning a fresh interpreter to the end of the
+app's first script run; warm rerun is the time of a repeated script run in
+an already-warm process. The fastest of several runs is reported, which is
+far less sensitive to machine noise than the mean. Results are compared
+against benchmarks/baseline.json and the script exits non-zero on a
+regression.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --update-baseline
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+def run_child(reruns: int) -> None:
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(APP_PATH, default_timeout=60)
+    app.run()
+    first_render = time.time()
+    if app.exception:
+        raise SystemExit(f"app.py raised: {app.exception}")
+
+    durations = []
+    for _ in range(reruns):
+        started = time.perf_counter()
+        app.run()
+        durations.append(time.perf_counter() - started)
+
+    print(json.dumps({"first_render": first_render, "warm_rerun": min(durations)}))
+
+
+def measure(cold_runs: int, reruns: int) -> dict:
+    env = dict(os.environ)
+    # Keep the benchmark off the network and away from real BigQuery config
+    for name in ("BIGQUERY_ACCOUNT", "BIGQUERY_TABLE"):
+        env.pop(name, None)
+
+    cold, warm = [], []
+    for _ in range(cold_runs):
+        spawned = time.time()
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--reruns", str(reruns)],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        cold.append(result["first_render"] - spawned)
+        warm.append(result["warm_rerun"])
+
+    return {
+        "cold_start": min(cold),
+        "warm_rerun": min(warm),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cold-runs", type=int, default=5)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--tolerance", type=float, default=0.3,
+                        help="allowed slowdown over the baseline, as a fraction")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.reruns)
+        return 0
+
+    results = measure(args.cold_runs, args.reruns)
+    for name, value in results.items():
+        print(f"{name}: {value * 1000:.1f} ms")
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump({name: round(value, 4) for name, value in results.items()}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("No baseline found; run with --update-baseline first")
+        return 1
+
+    with open(BASELINE_PATH, 'r') as f:
+        baseline = json.load(f)
+
+    regressed = False
+    for name, value in results.items():
+        limit = baseline[name] * (1 + args.tolerance)
+        if value > limit:
+            regressed = True
+            print(f"REGRESSION {name}: {value * 1000:.1f} ms > {limit * 1000:.1f} ms "
+                  f"(baseline {baseline[name] * 1000:.1f} ms)")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,370 @@
+"""
+Headless batch processing for authorization codes and stored tokens.
+
+    python cli.py exchange --provider "Google Analytics" --input codes.txt
+    python cli.py refresh --input tokens.ndjson --workers 16 --rate Facebook=5
+    python cli.py exchange --provider Facebook --input codes.txt --bigquery
+    python cli.py refresh --from-store .data/tokens.sqlite3 --bigquery --bigquery-mode load
+    python cli.py refresh --from-store .data/tokens.sqlite3 --store .data/tokens.sqlite3
+    python cli.py refresh --from-store .data/tokens.sqlite3 --daemon --workers 8
+    python cli.py validate --from-store .data/tokens.sqlite3 --workers 32 --output health.ndjson
+    python cli.py export --from-store .data/tokens.sqlite3 --format parquet --output tokens.parquet
+    python cli.py export --from-store .data/tokens.sqlite3 --columns platform,unique_id,email --platform facebook
+    python cli.py export --from-store .data/tokens.sqlite3 --tokens hash --output tokens.ndjson
+
+``exchange`` reads one authorization code per line (or NDJSON objects
+with a ``code`` and optional ``provider`` and ``state`` fields; a state
+is verified against the shared pending-flow store and supplies the PKCE
+verifier). ``refresh`` reads NDJSON token rows as written to BigQuery,
+or the tokens expiring soon in a token store (``--from-store``), and
+refreshes each through its provider. Results stream out as NDJSON, or
+are saved with ``--store`` (upsert into the local token store,
+replicated to BigQuery when combined with ``--bigquery``) or
+``--bigquery`` alone; throughput and latency are reported on stderr at
+the end. ``--bigquery-mode`` overrides ``BIGQUERY_WRITE_MODE``; ``load``
+sends rows in large NDJSON load jobs, the cheapest way to backfill.
+
+``refresh --daemon`` keeps running instead: every token in the store is
+refreshed shortly before it expires, with jitter, and written back to the
+same store, until interrupted (Ctrl-C or SIGTERM). Providers need their
+client ID and secret in the environment.
+
+``validate`` checks every access token in NDJSON token rows or a whole token
+store against the provider's validation endpoint and writes one result per
+row (platform, unique_id, valid, expires_at, scopes, error) without the
+token itself. Rows sharing a token are validated once.
+
+``export`` streams a token store's rows to NDJSON (stdout by default) or
+Parquet in chunks, with ``--columns`` projection, ``--platform`` and expiry
+window filters (``--expires-after``/``--expires-before``, seconds from
+now), and ``--tokens hash`` or ``redact`` for the token columns.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional
+
+from providers import get_catalog, resilience
+from providers.flow import FLOW_TIMEOUT, exchange_code
+from providers.ratelimit import RateLimiter
+from providers.validation import validate
+from storage.rows import build_token_row, refreshed_row, tokens_from_row
+
+LOAD_BATCH_SIZE = 10_000
+DAEMON_REPORT_INTERVAL = 60.0
+
+
+def read_codes(path: str, default_provider: Optional[str]) -> Iterator[Dict]:
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line) if line.startswith("{") else {"code": line}
+            item.setdefault("provider", default_provider)
+            yield item
+
+
+def read_rows(path: str) -> Iterator[Dict]:
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_rates(values: List[str]) -> Dict[str, float]:
+    rates = {}
+    for value in values:
+        name, _, rate = value.rpartition("=")
+        if not name:
+            raise ValueError(f"Expected PROVIDER=CALLS_PER_SECOND, got {value!r}")
+        rates[name] = float(rate)
+    return rates
+
+
+def parse_columns(value: str) -> List[str]:
+    return [column.strip() for column in value.split(",") if column.strip()]
+
+
+class BatchRunner:
+    def __init__(self, rates: Dict[str, float]):
+        self.catalog = get_catalog()
+        self._providers = {}
+        self._limiters = {name: RateLimiter(rate, burst=max(int(rate), 1)) for name, rate in rates.items()}
+        self._lock = threading.Lock()
+
+    def provider(self, name: str):
+        with self._lock:
+            if name not in self._providers:
+                if name not in self.catalog.specs:
+                    raise KeyError(f"Unknown provider: {name}")
+                self._providers[name] = self.catalog.create(name)
+            return self._providers[name]
+
+    def provider_for_platform(self, platform: str):
+        name = self.catalog.name_for_platform(platform)
+        if name is None:
+            raise KeyError(f"Unknown platform: {platform}")
+        return self.provider(name)
+
+    def _throttle(self, provider) -> None:
+        limiter = self._limiters.get(provider.name)
+        if limiter:
+            limiter.acquire()
+
+    def exchange(self, item: Dict) -> Dict:
+        provider = self.provider(item["provider"])
+        self._throttle(provider)
+        result = exchange_code(provider, item["code"], state=item.get("state"))
+        return build_token_row(result.tokens, result.user_info, provider.platform, accounts=result.accounts)
+
+    def refresh(self, row: Dict) -> Dict:
+        provider = self.provider_for_platform(row["platform"])
+        tokens = tokens_from_row(row)
+        if not provider.can_refresh(tokens):
+            raise ValueError(f"No refreshable token for {row.get('unique_id')}")
+        self._throttle(provider)
+        with resilience.deadline(FLOW_TIMEOUT):
+            tokens.update(provider.refresh(tokens))
+        return refreshed_row(row, tokens)
+
+    def validate(self, row: Dict) -> Dict:
+        provider = self.provider_for_platform(row["platform"])
+        if not row.get("access_token"):
+            raise ValueError(f"No access token for {row.get('unique_id')}")
+        self._throttle(provider)
+        result = validate(provider, row["access_token"])
+        return dict(result, platform=row["platform"], unique_id=row.get("unique_id"), email=row.get("email"))
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_export(args: argparse.Namespace) -> int:
+    from storage.export import export
+    from storage.token_store import get_store
+
+    now = time.time()
+    started = time.perf_counter()
+    count = export(
+        get_store(args.from_store),
+        args.output,
+        args.format,
+        columns=args.columns,
+        platforms=args.platform,
+        expires_after=now + args.expires_after if args.expires_after is not None else None,
+        expires_before=now + args.expires_before if args.expires_before is not None else None,
+        tokens=args.tokens,
+        chunk_size=args.chunk_size
+    )
+    elapsed = time.perf_counter() - started
+    print(f"{count} rows exported in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f}/s)", file=sys.stderr)
+    return 0
+
+
+def run_refresh_daemon(args: argparse.Namespace) -> int:
+    from providers.refresh import configured_providers, get_store_refresher
+    from storage.token_store import get_store
+
+    providers = configured_providers()
+    if not providers:
+        print("No provider has its client ID and secret set in the environment", file=sys.stderr)
+        return 2
+    refresher = get_store_refresher(get_store(args.from_store), providers, max_workers=args.workers).start()
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    print(f"Refreshing tokens of {', '.join(sorted(providers))} in {args.from_store}", file=sys.stderr)
+    try:
+        while not stopped.wait(DAEMON_REPORT_INTERVAL):
+            status = refresher.status()
+            print(f"{status['scheduled']} scheduled, {status['refreshed']} refreshed, {status['failed']} failed",
+                  file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        refresher.stop()
+    status = refresher.status()
+    print(f"Stopped: {status['refreshed']} refreshed, {status['failed']} failed", file=sys.stderr)
+    return 0
+
+
+def run(args: argparse.Namespace) -> int:
+    if args.command == "export":
+        return run_export(args)
+    if args.daemon:
+        return run_refresh_daemon(args)
+    runner = BatchRunner(args.rate)
+    if args.command == "exchange":
+        items = list(read_codes(args.input, args.provider))
+        if any(not item.get("provider") for item in items):
+            print("Every code needs a provider: pass --provider or a 'provider' field", file=sys.stderr)
+            return 2
+        work = runner.exchange
+    else:
+        if args.from_store:
+            from storage.token_store import get_store
+            store = get_store(args.from_store)
+            if args.command == "validate":
+                items = list(store.iter_rows())
+            else:
+                items = list(store.expiring_before(time.time() + args.expiring_within))
+        else:
+            items = list(read_rows(args.input))
+        work = runner.validate if args.command == "validate" else runner.refresh
+
+    writer = None
+    if args.bigquery:
+        from storage import BIGQUERY_AVAILABLE
+        if not BIGQUERY_AVAILABLE or not os.getenv("BIGQUERY_ACCOUNT") or not os.getenv("BIGQUERY_TABLE"):
+            print("--bigquery needs google-cloud-bigquery, BIGQUERY_ACCOUNT and BIGQUERY_TABLE", file=sys.stderr)
+            return 2
+        from storage.bigquery_sink import get_sink
+        from storage.writer import DEFAULT_SPOOL_PATH, get_writer
+        sink = get_sink(os.getenv("BIGQUERY_ACCOUNT"), os.getenv("BIGQUERY_TABLE"), args.bigquery_mode)
+        # Load jobs have a daily quota per table, so they get far larger batches
+        options = {"batch_size": LOAD_BATCH_SIZE, "max_batch_age": 30.0} if sink.write_mode == "load" else {}
+        writer = get_writer(sink, os.getenv("BIGQUERY_SPOOL_PATH", DEFAULT_SPOOL_PATH), **options)
+
+    save = writer.submit if writer else None
+    if args.store:
+        from storage.token_store import get_store
+        store = get_store(args.store)
+        if writer:
+            store.add_replica(writer.submit)
+        save = store.upsert
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    latencies: List[float] = []
+    errors = 0
+    invalid = 0
+
+    def timed(item: Dict):
+        started = time.perf_counter()
+        try:
+            return work(item), None, time.perf_counter() - started
+        except Exception as e:
+            return None, e, time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(timed, item): index for index, item in enumerate(items)}
+            for future in as_completed(futures):
+                row, error, elapsed = future.result()
+                latencies.append(elapsed)
+                record = {"index": futures[future], "latency": round(elapsed, 4)}
+                if error is not None:
+                    errors += 1
+                    record.update(status="error", error=str(error))
+                else:
+                    record["status"] = "ok"
+                    if args.command == "validate" and not row["valid"]:
+                        invalid += 1
+                    if save:
+                        save(row)
+                    else:
+                        record["row"] = row
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if writer:
+            writer.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{len(items)} items, {len(items) - errors} ok, {errors} failed in {elapsed:.2f}s "
+        f"({len(items) / elapsed if elapsed else 0:.1f}/s); latency "
+        f"p50={percentile(latencies, 0.5) * 1000:.0f}ms "
+        f"p95={percentile(latencies, 0.95) * 1000:.0f}ms "
+        f"max={max(latencies, default=0) * 1000:.0f}ms",
+        file=sys.stderr
+    )
+    if args.command == "validate":
+        print(f"{len(items) - errors - invalid} valid, {invalid} invalid", file=sys.stderr)
+    if writer:
+        status = writer.status()
+        print(f"BigQuery writer: {status['flushed']} flushed, {status['failed']} failed, "
+              f"{status['queued']} left in spool", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["exchange", "refresh", "validate", "export"])
+    parser.add_argument("--input", help="codes file (exchange) or NDJSON token rows (refresh, validate)")
+    parser.add_argument("--from-store", metavar="PATH",
+                        help="refresh, validate, export: read tokens from this token store instead of --input")
+    parser.add_argument("--expiring-within", type=float, default=3600.0, metavar="SECONDS",
+                        help="refresh --from-store: only tokens expiring within this window")
+    parser.add_argument("--daemon", action="store_true",
+                        help="refresh --from-store: keep refreshing tokens ahead of expiry until interrupted")
+    parser.add_argument("--store", metavar="PATH", help="upsert results into this token store")
+    parser.add_argument("--provider", help="provider name for plain code files, e.g. 'Google Analytics'")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", action="append", default=[], metavar="PROVIDER=CALLS_PER_SECOND",
+                        help="per-provider rate limit; may be repeated")
+    parser.add_argument("--output", help="write NDJSON results here instead of stdout")
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson", help="export: output format")
+    parser.add_argument("--columns", type=parse_columns, help="export: comma-separated columns (default: all)")
+    parser.add_argument("--platform", action="append", default=[],
+                        help="export: only this platform, e.g. facebook; may be repeated")
+    parser.add_argument("--expires-after", type=float, metavar="SECONDS",
+                        help="export: only tokens expiring this many seconds from now or later, or never")
+    parser.add_argument("--expires-before", type=float, metavar="SECONDS",
+                        help="export: only tokens expiring within this many seconds from now")
+    parser.add_argument("--tokens", choices=["plain", "hash", "redact"], default="plain",
+                        help="export: how access and refresh tokens are written")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="export: rows read and written at a time")
+    parser.add_argument("--bigquery", action="store_true", help="send rows to the BigQuery writer")
+    parser.add_argument("--bigquery-mode", choices=["streaming", "storage_write", "load"],
+                        help="BigQuery write mode (default: BIGQUERY_WRITE_MODE, or streaming)")
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        if not args.from_store:
+            parser.error("export needs --from-store")
+        if args.format == "parquet" and not args.output:
+            parser.error("--format parquet needs --output")
+        if args.format == "parquet":
+            from storage import PARQUET_AVAILABLE
+            if not PARQUET_AVAILABLE:
+                parser.error("--format parquet needs pyarrow")
+        from storage.rows import TOKEN_FIELDS
+        args.columns = args.columns or list(TOKEN_FIELDS)
+        unknown = sorted(set(args.columns) - set(TOKEN_FIELDS))
+        if unknown:
+            parser.error(f"unknown column(s) {', '.join(unknown)}; choose from {', '.join(TOKEN_FIELDS)}")
+        if args.store or args.bigquery:
+            parser.error("export only writes files; --store and --bigquery do not apply")
+    if not args.input and not (args.command != "exchange" and args.from_store):
+        parser.error("--input is required unless refreshing or validating with --from-store")
+    if args.command == "validate" and (args.store or args.bigquery):
+        parser.error("validate only reports; --store and --bigquery do not apply")
+    if args.daemon and (args.command != "refresh" or not args.from_store):
+        parser.error("--daemon needs refresh --from-store")
+    if args.daemon and (args.store or args.bigquery or args.output):
+        parser.error("--daemon writes back to --from-store; --store, --bigquery and --output do not apply")
+    if args.bigquery_mode and not args.bigquery:
+        parser.error("--bigquery-mode needs --bigquery")
+    try:
+        args.rate = parse_rates(args.rate)
+    except ValueError as e:
+        parser.error(str(e))
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Per-phase latency histograms and error counters for the OAuth flow.
+
+Phases are recorded with ``span(phase, provider)`` around each call and
+exposed as a JSON snapshot, as Prometheus text, or over a small HTTP
+server (``/metrics`` and ``/metrics.json``) that a local scraper can read.
+With profiling enabled (see ``profiling``) each span is also profiled.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import profiling
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds: float) -> None:
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.counts[index] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the quantile, as Prometheus would estimate it
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, str], Histogram] = {}
+        self._gauges: Dict[str, Tuple[float, str]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, phase: str, provider: str, seconds: float, error: bool = False) -> None:
+        key = (phase, provider or "")
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                histogram.errors += 1
+
+    def set_gauge(self, name: str, value: float, help: str = "") -> None:
+        with self._lock:
+            self._gauges[name] = (value, help)
+
+    def gauges(self) -> Dict[str, float]:
+        with self._lock:
+            return {name: value for name, (value, _) in sorted(self._gauges.items())}
+
+    @contextmanager
+    def span(self, phase: str, provider: str = "") -> Iterator[None]:
+        profiler = profiling.get_profiler()
+        if profiler is not None:
+            profiler.enter(phase, provider)
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(phase, provider, time.perf_counter() - started, error=True)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.exit()
+        self.observe(phase, provider, time.perf_counter() - started)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def snapshot(self) -> List[Dict]:
+        with self._lock:
+            items = [
+                (phase, provider, list(h.counts), h.total, h.count, h.errors, h.quantile(0.5), h.quantile(0.95))
+                for (phase, provider), h in sorted(self._histograms.items())
+            ]
+        return [
+            {
+                "phase": phase,
+                "provider": provider,
+                "count": count,
+                "errors": errors,
+                "sum_seconds": round(total, 6),
+                "mean_seconds": round(total / count, 6) if count else 0.0,
+                "p50_seconds": p50,
+                "p95_seconds": p95,
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], counts)),
+            }
+            for phase, provider, counts, total, count, errors, p50, p95 in items
+        ]
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP oauth_phase_seconds Latency of OAuth flow phases",
+            "# TYPE oauth_phase_seconds histogram",
+        ]
+        errors = [
+            "# HELP oauth_phase_errors_total Failed OAuth flow phases",
+            "# TYPE oauth_phase_errors_total counter",
+        ]
+        for entry in self.snapshot():
+            labels = f'phase="{entry["phase"]}",provider="{entry["provider"]}"'
+            cumulative = 0
+            for bound, count in entry["buckets"].items():
+                cumulative += count
+                lines.append(f'oauth_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"oauth_phase_seconds_sum{{{labels}}} {entry['sum_seconds']}")
+            lines.append(f"oauth_phase_seconds_count{{{labels}}} {entry['count']}")
+            errors.append(f"oauth_phase_errors_total{{{labels}}} {entry['errors']}")
+        gauges = []
+        with self._lock:
+            items = sorted(self._gauges.items())
+        for name, (value, help) in items:
+            gauges += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines + errors + gauges) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def span(phase: str, provider: str = ""):
+    return REGISTRY.span(phase, provider)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = REGISTRY.prometheus_text().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(REGISTRY.snapshot()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def start_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the registry on a daemon thread; repeated calls reuse the server."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server
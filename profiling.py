@@ -0,0 +1,110 @@
+"""
+cProfile per flow phase.
+
+With ``PROFILE_DIR`` set (or ``enable(directory)`` called), every
+``metrics.span`` also runs under cProfile, and the stats are merged per
+phase and provider. A phase's profile leaves out the phases nested inside
+it, which get their own. ``dump()`` (also run at exit) writes one pstats
+file per phase, ``<phase>[.<provider>].prof``, readable with
+``python -m pstats`` or snakeviz, plus a ``summary.txt`` of the top
+functions by cumulative time. Profiles are merged only when dumped, so
+dump once the profiled work is done.
+"""
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+SUMMARY_FUNCTIONS = 15
+
+
+class PhaseProfiler:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.skipped = 0
+        # Every thread's profile per phase; a profile accumulates over enable/disable
+        self._profiles: Dict[Tuple[str, str], List[cProfile.Profile]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _thread_state(self) -> Tuple[Dict[Tuple[str, str], cProfile.Profile], list]:
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = ({}, [])
+        return state
+
+    def enter(self, phase: str, provider: str = "") -> None:
+        profiles, stack = self._thread_state()
+        if stack and stack[-1] is not None:
+            stack[-1].disable()
+        key = (phase, provider or "")
+        profile = profiles.get(key)
+        if profile is None:
+            profile = profiles[key] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(key, []).append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (on 3.12+ there is one per process)
+            profile = None
+            self.skipped += 1
+        stack.append(profile)
+
+    def exit(self) -> None:
+        _, stack = self._thread_state()
+        profile = stack.pop()
+        if profile is not None:
+            profile.disable()
+        if stack and stack[-1] is not None:
+            stack[-1].enable()
+
+    def phases(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            return sorted(self._profiles)
+
+    def dump(self) -> List[str]:
+        """Write the stats collected so far; returns the files written."""
+        os.makedirs(self.directory, exist_ok=True)
+        paths = []
+        summary = io.StringIO()
+        with self._lock:
+            items = sorted((key, list(profiles)) for key, profiles in self._profiles.items())
+        for (phase, provider), profiles in items:
+            profiles = [profile for profile in profiles if profile.getstats()]
+            if not profiles:
+                continue
+            stats = pstats.Stats(*profiles, stream=summary)
+            name = re.sub(r"[^\w.-]+", "_", f"{phase}.{provider}" if provider else phase)
+            path = os.path.join(self.directory, f"{name}.prof")
+            stats.dump_stats(path)
+            paths.append(path)
+            summary.write(f"=== {phase} {provider}".rstrip() + "\n")
+            stats.sort_stats("cumulative").print_stats(SUMMARY_FUNCTIONS)
+        path = os.path.join(self.directory, "summary.txt")
+        with open(path, "w") as f:
+            f.write(summary.getvalue())
+        return paths + [path]
+
+
+_profiler: Optional[PhaseProfiler] = None
+
+
+def enable(directory: str) -> PhaseProfiler:
+    global _profiler
+    if _profiler is None or _profiler.directory != directory:
+        _profiler = PhaseProfiler(directory)
+        atexit.register(_profiler.dump)
+    return _profiler
+
+
+def get_profiler() -> Optional[PhaseProfiler]:
+    return _profiler
+
+
+if os.getenv("PROFILE_DIR"):
+    enable(os.getenv("PROFILE_DIR"))
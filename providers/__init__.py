@@ -1,9 +1,29 @@
-from .google_analytics import GoogleAnalyticsProvider
-from .facebook import FacebookProvider
+from collections.abc import Mapping
 
-__all__ = ['GoogleAnalyticsProvider', 'FacebookProvider']
+from .catalog import CUSTOM, SPECS, ProviderSpec, get_catalog
 
-PROVIDERS = {
-    'Google Analytics': GoogleAnalyticsProvider,
-    'Facebook': FacebookProvider,
-}
+__all__ = ['GoogleAnalyticsProvider', 'FacebookProvider', 'ProviderSpec', 'get_catalog']
+
+
+class _ProviderRegistry(Mapping):
+    # Provider modules are imported the first time a provider class is looked up
+    def __getitem__(self, name: str):
+        if name == CUSTOM:
+            raise KeyError(name)
+        return get_catalog().provider_class(name)
+
+    def __iter__(self):
+        return (spec.name for spec in SPECS if spec.name != CUSTOM)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+PROVIDERS = _ProviderRegistry()
+
+
+def __getattr__(name: str):
+    for spec in SPECS:
+        if spec.provider_path[1] == name:
+            return get_catalog().provider_class(spec.name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
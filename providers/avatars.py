@@ -0,0 +1,138 @@
+"""
+Profile pictures fetched server-side into a process-wide LRU byte cache.
+
+Reruns, and every session showing the same account, reuse the cached bytes
+instead of each browser fetching the picture again. Total size is bounded
+by ``max_bytes``; least recently shown pictures are evicted first, and
+pictures over ``max_item_bytes`` are not kept at all.
+
+Only ``https`` pictures on the provider's ``avatar_hosts`` are fetched, and
+never from a private, loopback or otherwise non-public address, so a
+provider's userinfo cannot point the server at internal hosts. Fetches run
+on a background thread: a miss returns None at once (the caller shows the
+URL itself) and a later run gets the bytes.
+
+    AVATAR_CACHE_BYTES=8388608
+"""
+import ipaddress
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Set
+from urllib.parse import urlparse
+
+from metrics import REGISTRY
+
+from . import transport
+from .transport import TransportConfig
+
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+MAX_AVATAR_BYTES = 256 * 1024
+MAX_ENTRIES = 4096
+# A picture that failed to load is not retried on every rerun
+FAILURE_TTL = 300.0
+
+AVATAR_CONFIG = TransportConfig(connect_timeout=2.0, read_timeout=5.0)
+FETCH_WORKERS = 2
+
+
+def allowed_url(url: str, hosts: Sequence[str]) -> bool:
+    """Whether ``url`` is https on one of ``hosts`` or their subdomains."""
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower().rstrip(".")
+    return parsed.scheme == "https" and any(host == allowed or host.endswith("." + allowed) for allowed in hosts)
+
+
+def public_host(host: str) -> bool:
+    """Whether every address ``host`` resolves to is publicly routable."""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP)}
+    except (OSError, UnicodeError):
+        return False
+    # Strip any IPv6 zone index before parsing
+    return bool(addresses) and all(ipaddress.ip_address(address.split("%", 1)[0]).is_global for address in addresses)
+
+
+class AvatarCache:
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES, max_item_bytes: int = MAX_AVATAR_BYTES):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.bytes = 0
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._failures: "OrderedDict[str, float]" = OrderedDict()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="avatar")
+
+    def get(self, url: str, hosts: Sequence[str] = ()) -> Optional[bytes]:
+        """
+        The cached picture at ``url``, or None when it is not cached yet (a
+        fetch is started if ``url`` is allowed for ``hosts``) or cannot be.
+        """
+        if not url or not allowed_url(url, hosts):
+            return None
+        with self._lock:
+            data = self._items.get(url)
+            if data is not None:
+                self._items.move_to_end(url)
+                return data
+            failed_at = self._failures.get(url)
+            if failed_at is not None and time.monotonic() - failed_at < FAILURE_TTL:
+                return None
+            if url in self._pending:
+                return None
+            self._pending.add(url)
+        self._executor.submit(self._load, url)
+        return None
+
+    def _load(self, url: str) -> None:
+        try:
+            data = self._fetch(url)
+        except Exception:
+            data = None
+        with self._lock:
+            self._pending.discard(url)
+            if data is None:
+                self._failures[url] = time.monotonic()
+                if len(self._failures) > MAX_ENTRIES:
+                    self._failures.popitem(last=False)
+            elif url not in self._items:
+                self._failures.pop(url, None)
+                self._items[url] = data
+                self.bytes += len(data)
+                while self.bytes > self.max_bytes or len(self._items) > MAX_ENTRIES:
+                    _, evicted = self._items.popitem(last=False)
+                    self.bytes -= len(evicted)
+            REGISTRY.set_gauge("oauth_avatar_cache_bytes", self.bytes, "Bytes of profile pictures held in memory")
+
+    def _fetch(self, url: str) -> Optional[bytes]:
+        if not public_host(urlparse(url).hostname):
+            return None
+        try:
+            # No redirects: a redirect could lead off the allowed hosts
+            response = transport.get(url, config=AVATAR_CONFIG, stream=True, allow_redirects=False)
+        except Exception:
+            return None
+        with response:
+            if response.status_code != 200 or not response.headers.get("Content-Type", "").startswith("image/"):
+                return None
+            # Read one byte past the limit to tell a picture that fits from one that does not
+            data = response.raw.read(self.max_item_bytes + 1, decode_content=True)
+        if not data or len(data) > self.max_item_bytes:
+            return None
+        return data
+
+
+_avatar_cache: Optional[AvatarCache] = None
+_avatar_cache_lock = threading.Lock()
+
+
+def get_avatar_cache() -> AvatarCache:
+    global _avatar_cache
+    with _avatar_cache_lock:
+        if _avatar_cache is None:
+            _avatar_cache = AvatarCache(int(os.getenv("AVATAR_CACHE_BYTES", DEFAULT_CACHE_BYTES)))
+        return _avatar_cache
@@ -1,46 +1,336 @@
-from typing import Dict
+import time
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, NamedTuple, Optional
+
+from metrics import span
+from storage.pending_flows import InvalidStateError, PendingFlow, get_pending_store
+
+from . import cassette, oidc, resilience, transport, validation
+from .catalog import CUSTOM, ProviderSpec, resolve_defaults, get_catalog, get_spec, normalize_scopes, split_scopes
+from .post_exchange import Step
+
+if TYPE_CHECKING:
+    import requests
+
+
+def _overridable(field: str) -> property:
+    def getter(self):
+        return self.overrides.get(field, getattr(self.defaults, field))
+    
+    def setter(self, value):
+        # Only values that differ from the shared defaults are kept per session
+        if value == getattr(self.defaults, field):
+            self.overrides.pop(field, None)
+        else:
+            self.overrides[field] = value
+    
+    return property(getter, setter)
+
+
+class GrantPlan(NamedTuple):
+    # "refresh", "reuse", "incremental" or "consent"
+    action: str
+    granted: FrozenSet[str]
+    missing: FrozenSet[str]
 
 
 class BaseProvider:
-    def __init__(
-        self,
-        name: str,
-        client_id: str = "",
-        client_secret: str = "",
-        redirect_uri: str = "http://localhost:8501",
-        scope: str = "openid profile"
-    ):
-        self.name = name
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.redirect_uri = redirect_uri
-        self.scope = scope
+    __slots__ = ("spec", "defaults", "overrides")
+    
+    transport_config = transport.DEFAULT_CONFIG
+    retry_policy = resilience.DEFAULT_POLICY
+    
+    client_id = _overridable("client_id")
+    client_secret = _overridable("client_secret")
+    redirect_uri = _overridable("redirect_uri")
+    scope = _overridable("scope")
+    auth_url = _overridable("auth_url")
+    token_url = _overridable("token_url")
+    userinfo_url = _overridable("userinfo_url")
+    oidc_issuer = _overridable("oidc_issuer")
+    api_url = _overridable("api_url")
+    tokeninfo_url = _overridable("tokeninfo_url")
+    
+    def __init__(self, spec: Optional[ProviderSpec] = None, **overrides):
+        self.spec = spec or get_spec(CUSTOM)
+        self.defaults = get_catalog().defaults.get(self.spec.name) or resolve_defaults(self.spec)
+        self.overrides: Dict[str, str] = {}
+        for field, value in overrides.items():
+            setattr(self, field, value)
+    
+    @property
+    def name(self) -> str:
+        return self.spec.name
+    
+    @property
+    def platform(self) -> str:
+        return self.spec.platform
     
     def get_auth_url(self) -> str:
-        raise NotImplementedError("Subclasses must implement get_auth_url")
+        return self.auth_url
     
     def get_token_url(self) -> str:
-        raise NotImplementedError("Subclasses must implement get_token_url")
+        return self.token_url
     
     def get_userinfo_url(self) -> str:
-        raise NotImplementedError("Subclasses must implement get_userinfo_url")
+        return self.userinfo_url
     
-    def get_auth_params(self) -> Dict[str, str]:
-        return {
+    def start_flow(self) -> PendingFlow:
+        """Register a new state and PKCE verifier in the shared pending-flow store."""
+        pending = PendingFlow.new(self.name, self.platform)
+        get_pending_store().put(pending)
+        return pending
+    
+    def get_auth_params(self, pending: Optional[PendingFlow] = None, plan: Optional[GrantPlan] = None) -> Dict[str, str]:
+        """
+        Authorization request parameters for ``pending``, or for a newly
+        started flow, so every URL carries a registered state. With an
+        incremental ``plan`` only the missing scopes are requested.
+        """
+        pending = pending or self.start_flow()
+        incremental = plan is not None and plan.action == "incremental"
+        scopes = split_scopes(self.scope)
+        if incremental:
+            scopes = [scope for scope in scopes if self.normalize_scopes(scope) <= plan.missing]
+        params = {
             "client_id": self.client_id,
             "redirect_uri": self.redirect_uri,
             "response_type": "code",
-            "scope": self.scope.replace(",", " "),
+            "scope": self.spec.scope_separator.join(scopes),
+            "state": pending.state,
         }
+        if self.spec.pkce:
+            params["code_challenge"] = pending.code_challenge
+            params["code_challenge_method"] = "S256"
+        params.update(self.spec.extra_auth_params)
+        params.update(self.spec.incremental_auth_params if incremental else self.spec.consent_auth_params)
+        return params
     
-    def get_token_data(self, auth_code: str) -> Dict[str, str]:
-        return {
+    def normalize_scopes(self, scope) -> FrozenSet[str]:
+        return normalize_scopes(scope, self.spec.scope_aliases)
+    
+    def granted_scopes(self, tokens: Dict) -> Optional[FrozenSet[str]]:
+        """
+        Scopes of an existing grant: the token response's ``scope`` if it
+        has one, otherwise what the validation endpoint reports for a still
+        valid token. None when the grant is unknown or no longer valid.
+        """
+        if tokens.get("scope"):
+            return self.normalize_scopes(tokens["scope"])
+        if self.can_validate() and tokens.get("access_token"):
+            result = validation.validate(self, tokens["access_token"])
+            if result["valid"]:
+                return self.normalize_scopes(result["scopes"])
+        return None
+    
+    def plan_authorization(self, grant: Optional[Dict]) -> GrantPlan:
+        """
+        How to get a token for the configured scopes, given an account's
+        current grant (its stored tokens): refresh it when it already covers
+        them, reuse a still valid token that cannot be refreshed, ask only
+        for the missing scopes, or run the full consent flow.
+        """
+        requested = self.normalize_scopes(self.scope)
+        granted = self.granted_scopes(grant) if grant else None
+        if granted is None:
+            return GrantPlan("consent", frozenset(), requested)
+        missing = requested - granted
+        if missing:
+            return GrantPlan("incremental", granted, missing)
+        if self.can_refresh(grant):
+            return GrantPlan("refresh", granted, missing)
+        if self.can_validate() and validation.validate(self, grant["access_token"])["valid"]:
+            return GrantPlan("reuse", granted, missing)
+        return GrantPlan("consent", granted, requested)
+    
+    def redeem_state(self, state: str) -> PendingFlow:
+        # Taking the record makes the state single-use on every replica
+        pending = get_pending_store().take(state)
+        if pending is None:
+            raise InvalidStateError("Unknown or expired state; start the authorization again")
+        if pending.provider != self.name:
+            raise InvalidStateError(f"State was issued for {pending.provider}, not {self.name}")
+        return pending
+    
+    def get_token_data(self, auth_code: str, state: Optional[str] = None) -> Dict[str, str]:
+        """
+        Token request for ``auth_code``. With the callback's ``state`` the
+        pending flow is verified and redeemed and its PKCE verifier sent;
+        codes obtained outside this app are exchanged without either.
+        """
+        data = {
             "code": auth_code,
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "redirect_uri": self.redirect_uri,
             "grant_type": "authorization_code"
         }
+        if state is not None:
+            pending = self.redeem_state(state)
+            if self.spec.pkce:
+                data["code_verifier"] = pending.code_verifier
+        return data
+    
+    def get_userinfo_headers(self, access_token: str) -> Dict[str, str]:
+        if self.spec.userinfo_strategy == "query_token":
+            return {}
+        return {"Authorization": f"Bearer {access_token}"}
+    
+    def get_userinfo_params(self, access_token: str) -> Dict[str, str]:
+        if self.spec.userinfo_strategy == "query_token":
+            return {"access_token": access_token, "fields": self.spec.userinfo_fields}
+        return {}
+    
+    def fetch_user_info(self, access_token: str) -> Optional[Dict]:
+        userinfo_url = self.get_userinfo_url()
+        if not userinfo_url and self.oidc_issuer:
+            userinfo_url = oidc.get_discovery_cache().get_configuration(self.oidc_issuer).get("userinfo_endpoint", "")
+        if not userinfo_url:
+            return None
+        with span("userinfo", self.platform):
+            response = self.http_get(
+                userinfo_url,
+                headers=self.get_userinfo_headers(access_token),
+                params=self.get_userinfo_params(access_token)
+            )
+        if response.status_code != 200:
+            return None
+        return response.json()
+    
+    def verify_id_token(self, id_token: str) -> Dict:
+        with span("id_token_verify", self.platform):
+            return oidc.get_discovery_cache().verify_id_token(id_token, self.oidc_issuer, self.client_id)
+    
+    def resolve_user_info(self, tokens: Dict) -> Optional[Dict]:
+        """
+        Identity for a token response. A locally verified id_token already
+        carries sub/email/name, so the userinfo call is only a fallback.
+        """
+        id_token = tokens.get("id_token")
+        # Recorded id_tokens are scrubbed and cannot verify, so cassette runs use userinfo
+        if id_token and self.oidc_issuer and oidc.JWT_AVAILABLE and not cassette.active():
+            try:
+                return oidc.identity_from_claims(self.verify_id_token(id_token))
+            except Exception:
+                # Verification or discovery failed; fall back to userinfo
+                pass
+        return self.fetch_user_info(tokens["access_token"])
+    
+    def get_post_exchange_steps(self, tokens: Dict) -> List[Step]:
+        """
+        Calls to run after the code exchange. Steps without dependencies
+        between them run in parallel; subclasses add provider-specific ones.
+        """
+        return [Step("user_info", lambda _: self.resolve_user_info(tokens))]
+    
+    def get_refresh_data(self, refresh_token: str) -> Dict[str, str]:
+        return {
+            "refresh_token": refresh_token,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "refresh_token"
+        }
+    
+    def can_refresh(self, tokens: Dict) -> bool:
+        if self.spec.refresh_with_access_token:
+            return bool(tokens.get("access_token"))
+        return bool(tokens.get("refresh_token"))
+    
+    def refresh(self, tokens: Dict) -> Dict:
+        """
+        Run the refresh_token grant and return the new token response.
+        Providers that do not rotate refresh tokens omit it from the
+        response, so the previous one is carried over.
+        """
+        with span("refresh", self.platform):
+            response = self.http_post(self.get_token_url(), data=self.get_refresh_data(tokens["refresh_token"]))
+            response.raise_for_status()
+            refreshed = response.json()
+        refreshed.setdefault("refresh_token", tokens["refresh_token"])
+        return refreshed
+    
+    def can_validate(self) -> bool:
+        return bool(self.spec.validation_strategy and self.tokeninfo_url)
+    
+    def get_validation_params(self, access_token: str) -> Dict[str, str]:
+        if self.spec.validation_strategy == "debug_token":
+            # debug_token is called with an app access token, never the user's own
+            return {"input_token": access_token, "access_token": f"{self.client_id}|{self.client_secret}"}
+        return {"access_token": access_token}
+    
+    def validate_token(self, access_token: str) -> Dict:
+        """
+        Ask the provider whether ``access_token`` is still usable. Returns
+        ``valid``, ``expires_at`` (epoch seconds, None if it never expires),
+        ``scopes``, ``user_id`` and ``error``. Transport failures and server
+        errors raise, so they are never reported as an invalid token.
+        """
+        if not self.can_validate():
+            raise ValueError(f"{self.name} has no token validation endpoint")
+        with span("token_validation", self.platform):
+            response = self.http_get(self.tokeninfo_url, params=self.get_validation_params(access_token))
+        if response.status_code >= 500 or response.status_code in (401, 403, 429):
+            response.raise_for_status()
+        try:
+            body = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise
+        if self.spec.validation_strategy == "debug_token":
+            if "error" in body:
+                # The app token was rejected; says nothing about the user's token
+                raise ValueError(body["error"].get("message", "debug_token failed"))
+            data = body.get("data", {})
+            error = data.get("error") or {}
+            return {
+                "valid": bool(data.get("is_valid")),
+                "expires_at": float(data["expires_at"]) if data.get("expires_at") else None,
+                "scopes": list(data.get("scopes", [])),
+                "user_id": data.get("user_id"),
+                "error": error.get("message") if not data.get("is_valid") else None,
+            }
+        if response.status_code != 200:
+            return {
+                "valid": False,
+                "expires_at": None,
+                "scopes": [],
+                "user_id": None,
+                "error": body.get("error_description") or body.get("error") or f"HTTP {response.status_code}",
+            }
+        return {
+            "valid": True,
+            "expires_at": float(body["exp"]) if body.get("exp") else (
+                time.time() + float(body["expires_in"]) if body.get("expires_in") else None
+            ),
+            "scopes": split_scopes(body.get("scope", "")),
+            "user_id": body.get("sub") or body.get("user_id"),
+            "error": None,
+        }
     
     def get_env_vars(self) -> Dict[str, str]:
-        raise NotImplementedError("Subclasses must implement get_env_vars")
+        env_vars = self.spec.env_vars
+        return {
+            "client_id": env_vars.client_id,
+            "client_secret": env_vars.client_secret,
+            "redirect_uri": env_vars.redirect_uri
+        }
+    
+    @property
+    def breaker(self) -> resilience.CircuitBreaker:
+        return resilience.get_breaker(self.name)
+    
+    def http_request(self, method: str, url: str, idempotent: bool, **kwargs) -> "requests.Response":
+        return resilience.call(
+            method, url,
+            config=self.transport_config,
+            breaker=self.breaker,
+            idempotent=idempotent,
+            policy=self.retry_policy,
+            **kwargs
+        )
+    
+    def http_get(self, url: str, idempotent: bool = True, **kwargs) -> "requests.Response":
+        return self.http_request("GET", url, idempotent, **kwargs)
+    
+    def http_post(self, url: str, idempotent: bool = False, **kwargs) -> "requests.Response":
+        # Code exchanges and refresh grants are single-use, so POSTs are not retried by default
+        return self.http_request("POST", url, idempotent, **kwargs)
@@ -0,0 +1,243 @@
+"""
+Record and replay of outbound HTTP at the transport level.
+
+Every provider call, and the app's own calls (avatars, OIDC discovery),
+go through ``transport``; with a cassette, its sessions use an adapter
+that either records each response or answers from the recording without
+touching the network.
+
+    HTTP_CASSETTE=.cassettes/flows.ndjson.gz
+    HTTP_CASSETTE_MODE=record        # or replay
+    HTTP_CASSETTE_LATENCY=1.0        # replay: recorded latency x this; 0 = none
+
+Recordings are NDJSON (gzip when the path ends in ``.gz``), one response
+per line, appended to. Tokens, codes, secrets and verifiers are scrubbed
+from URLs, headers and bodies before they are written, each distinct
+value to its own stable placeholder so token-keyed caches behave on
+replay as they did live; request bodies are not kept at all. Replay
+matches on method, path and the non-secret query parameters, and hands
+out a key's recordings in order, starting over when they run out, so one
+recorded login replays as many flows. A state echoed in a recorded
+redirect is replaced by the replayed request's state.
+"""
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, unquote_plus, urlencode, urlparse
+
+if TYPE_CHECKING:
+    import requests
+
+RECORD = "record"
+REPLAY = "replay"
+MODES = (RECORD, REPLAY)
+
+SCRUBBED = "scrubbed"
+STATE_MARKER = "{{state}}"
+# Query and form parameters whose values are credentials
+SECRET_PARAMS = (
+    "access_token", "refresh_token", "id_token", "code", "client_secret", "input_token",
+    "code_verifier", "appsecret_proof", "fb_exchange_token", "assertion"
+)
+# Left out of replay keys as well: they differ on every flow
+VOLATILE_PARAMS = SECRET_PARAMS + ("state", "code_challenge")
+SECRET_FIELDS = ("access_token", "refresh_token", "id_token")
+KEPT_HEADERS = (
+    "content-type", "location", "retry-after", "cache-control", "expires",
+    "x-app-usage", "x-business-use-case-usage", "x-ad-account-usage"
+)
+
+_SECRET_PARAM = re.compile(r"(?<![A-Za-z_])(" + "|".join(SECRET_PARAMS) + r")=([^&\"\s\\]+)")
+# JSON string fields, also inside JSON-encoded strings (Graph batch bodies)
+_SECRET_FIELD = re.compile(r'(\\*")(' + "|".join(SECRET_FIELDS) + r')\1\s*:\s*\1([^"\\]*)\1')
+
+
+class CassetteMissError(LookupError):
+    pass
+
+
+def placeholder(secret: str) -> str:
+    """A stand-in for ``secret``: the same for equal secrets, distinct otherwise."""
+    return f"{SCRUBBED}-{hashlib.sha256(secret.encode()).hexdigest()[:12]}"
+
+
+def _scrub_param(match: "re.Match") -> str:
+    # Hashed decoded, so a token matches whether it came in a URL or a body
+    return f"{match.group(1)}={placeholder(unquote_plus(match.group(2)))}"
+
+
+def _scrub_field(match: "re.Match") -> str:
+    quote, name = match.group(1), match.group(2)
+    return f"{quote}{name}{quote}:{quote}{placeholder(match.group(3))}{quote}"
+
+
+def scrub(text: str, state: Optional[str] = None) -> str:
+    text = _SECRET_PARAM.sub(_scrub_param, text)
+    text = _SECRET_FIELD.sub(_scrub_field, text)
+    if state:
+        text = text.replace(state, STATE_MARKER)
+    return text
+
+
+def request_key(method: str, url: str) -> str:
+    parsed = urlparse(url)
+    params = sorted((name, value) for name, value in parse_qsl(parsed.query) if name not in VOLATILE_PARAMS)
+    return f"{method} {parsed.netloc}{parsed.path}" + (f"?{urlencode(params)}" if params else "")
+
+
+def request_state(request: "requests.PreparedRequest") -> Optional[str]:
+    state = dict(parse_qsl(urlparse(request.url).query)).get("state")
+    if state is None and isinstance(request.body, (str, bytes)):
+        body = request.body.decode(errors="replace") if isinstance(request.body, bytes) else request.body
+        state = dict(parse_qsl(body)).get("state")
+    return state
+
+
+def _raw_response(status: int, reason: str, headers: Dict[str, str], body: bytes):
+    from urllib3 import HTTPResponse
+
+    # The body is stored decoded, so no content-encoding applies any more
+    return HTTPResponse(
+        body=io.BytesIO(body), headers=headers, status=status, reason=reason,
+        preload_content=False, decode_content=False
+    )
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.recorded = 0
+        self.replayed = 0
+        self._entries: Dict[str, List[Dict]] = {}
+        self._positions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if mode == REPLAY:
+            for entry in self._read():
+                self._entries.setdefault(entry["key"], []).append(entry)
+
+    def _open(self, mode: str):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _read(self) -> List[Dict]:
+        with self._open("r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def record(self, request: "requests.PreparedRequest", response: "requests.Response", body: bytes, latency: float) -> None:
+        state = request_state(request)
+        entry = {
+            "key": request_key(request.method, request.url),
+            "url": scrub(request.url, state),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {
+                name: scrub(value, state) for name, value in response.headers.items() if name.lower() in KEPT_HEADERS
+            },
+            "latency": round(latency, 6),
+        }
+        try:
+            entry["body"] = scrub(body.decode("utf-8"), state)
+        except UnicodeDecodeError:
+            entry["body_base64"] = base64.b64encode(body).decode()
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Each write is a complete line, and a gzip member of its own
+            with self._open("a") as f:
+                f.write(line)
+            self.recorded += 1
+
+    def next_entry(self, request: "requests.PreparedRequest") -> Dict:
+        key = request_key(request.method, request.url)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMissError(f"No recorded response for {key}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            self.replayed += 1
+        return entries[position % len(entries)]
+
+    def replay(self, request: "requests.PreparedRequest") -> Tuple[int, str, Dict[str, str], bytes, float]:
+        entry = self.next_entry(request)
+        state = request_state(request) or ""
+        headers = {name: value.replace(STATE_MARKER, state) for name, value in entry["headers"].items()}
+        if "body_base64" in entry:
+            body = base64.b64decode(entry["body_base64"])
+        else:
+            body = entry["body"].replace(STATE_MARKER, state).encode("utf-8")
+        return entry["status"], entry["reason"], headers, body, entry["latency"] * self.latency_scale
+
+
+def build_adapter(cassette: Cassette, **kwargs):
+    """An ``HTTPAdapter`` that records through, or replays from, ``cassette``."""
+    from requests.adapters import HTTPAdapter
+
+    class CassetteAdapter(HTTPAdapter):
+        def send(self, request, **send_kwargs):
+            if cassette.mode == REPLAY:
+                status, reason, headers, body, latency = cassette.replay(request)
+                if latency > 0:
+                    time.sleep(latency)
+                return self.build_response(request, _raw_response(status, reason, headers, body))
+            started = time.perf_counter()
+            response = super().send(request, **send_kwargs)
+            body = response.content
+            cassette.record(request, response, body, time.perf_counter() - started)
+            # The live body was read to record it; hand back a response that can still be streamed
+            headers = {
+                name: value for name, value in response.headers.items()
+                if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+            }
+            return self.build_response(request, _raw_response(response.status_code, response.reason, headers, body))
+
+    return CassetteAdapter(**kwargs)
+
+
+_cassette: Optional[Cassette] = None
+_cassette_loaded = False
+_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Optional[Cassette]:
+    """The cassette configured by ``HTTP_CASSETTE``/``HTTP_CASSETTE_MODE``, or None."""
+    global _cassette, _cassette_loaded
+    if _cassette_loaded:
+        return _cassette
+    with _cassette_lock:
+        if not _cassette_loaded:
+            path = os.getenv("HTTP_CASSETTE")
+            mode = os.getenv("HTTP_CASSETTE_MODE")
+            if path and mode:
+                _cassette = Cassette(path, mode, float(os.getenv("HTTP_CASSETTE_LATENCY", "1.0")))
+            _cassette_loaded = True
+    return _cassette
+
+
+def use_cassette(cassette: Optional[Cassette]) -> None:
+    """Switch cassettes at runtime; pooled sessions are rebuilt with the new one."""
+    global _cassette, _cassette_loaded
+    from . import transport
+
+    with _cassette_lock:
+        _cassette = cassette
+        _cassette_loaded = True
+    transport.close_all()
+
+
+def active() -> bool:
+    return get_cassette() is not None
@@ -0,0 +1,242 @@
+import os
+import re
+from functools import lru_cache
+from types import MappingProxyType
+from typing import FrozenSet, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+
+class EnvVars(NamedTuple):
+    client_id: str
+    client_secret: str
+    redirect_uri: str
+    auth_url: str = ""
+    token_url: str = ""
+    userinfo_url: str = ""
+    oidc_issuer: str = ""
+    api_url: str = ""
+    tokeninfo_url: str = ""
+
+
+class ProviderDefaults(NamedTuple):
+    client_id: str
+    client_secret: str
+    redirect_uri: str
+    scope: str
+    auth_url: str
+    token_url: str
+    userinfo_url: str
+    oidc_issuer: str
+    api_url: str
+    tokeninfo_url: str
+
+
+class ProviderSpec(NamedTuple):
+    name: str
+    platform: str
+    provider_path: Tuple[str, str]
+    env_vars: EnvVars
+    auth_url: str = ""
+    token_url: str = ""
+    userinfo_url: str = ""
+    # Issuer for OIDC discovery; id_tokens from it are verified locally
+    oidc_issuer: str = ""
+    # Base URL of the provider's data API, used for account discovery
+    api_url: str = ""
+    scope: str = "openid profile"
+    scope_separator: str = " "
+    # Scopes the provider reports under another name, as (requested, granted)
+    scope_aliases: Tuple[Tuple[str, str], ...] = ()
+    extra_auth_params: Tuple[Tuple[str, str], ...] = ()
+    # Sent only for a first authorization, or only when extending an
+    # existing grant with missing scopes
+    consent_auth_params: Tuple[Tuple[str, str], ...] = ()
+    incremental_auth_params: Tuple[Tuple[str, str], ...] = ()
+    # "bearer" sends an Authorization header, "query_token" passes the
+    # access token and requested fields as query parameters
+    userinfo_strategy: str = "bearer"
+    userinfo_fields: str = ""
+    # Token introspection: "tokeninfo" (Google) or "debug_token" (Graph);
+    # empty when the provider has no validation endpoint
+    tokeninfo_url: str = ""
+    validation_strategy: str = ""
+    # Send a PKCE S256 challenge with the authorization request
+    pkce: bool = True
+    # No refresh_token grant: a still-valid access token is exchanged for a
+    # new one instead, so any access token can be refreshed
+    refresh_with_access_token: bool = False
+    editable_endpoints: bool = False
+    # Hosts (and their subdomains) whose profile pictures the server may
+    # fetch and cache; any other picture is left to the browser
+    avatar_hosts: Tuple[str, ...] = ()
+
+
+CUSTOM = "Custom"
+DEFAULT_REDIRECT_URI = "http://localhost:8501"
+
+SPECS = (
+    ProviderSpec(
+        name="Google Analytics",
+        platform="googleanalytics",
+        provider_path=(".google_analytics", "GoogleAnalyticsProvider"),
+        env_vars=EnvVars(
+            client_id="GOOGLE_ANALYTICS_CLIENT_ID",
+            client_secret="GOOGLE_ANALYTICS_CLIENT_SECRET",
+            redirect_uri="GOOGLE_ANALYTICS_REDIRECT_URI",
+            auth_url="GOOGLE_ANALYTICS_AUTH_URL",
+            token_url="GOOGLE_ANALYTICS_TOKEN_URL",
+            userinfo_url="GOOGLE_ANALYTICS_USERINFO_URL",
+            oidc_issuer="GOOGLE_ANALYTICS_OIDC_ISSUER",
+            api_url="GOOGLE_ANALYTICS_API_URL",
+            tokeninfo_url="GOOGLE_ANALYTICS_TOKENINFO_URL"
+        ),
+        auth_url="https://accounts.google.com/o/oauth2/v2/auth",
+        token_url="https://oauth2.googleapis.com/token",
+        userinfo_url="https://www.googleapis.com/oauth2/v3/userinfo",
+        oidc_issuer="https://accounts.google.com",
+        # GA4 Admin API, for account and property discovery
+        api_url="https://analyticsadmin.googleapis.com/v1beta",
+        scope="https://www.googleapis.com/auth/analytics.readonly openid email profile",
+        # Token responses name the OIDC shorthands by their full URLs
+        scope_aliases=(
+            ("email", "https://www.googleapis.com/auth/userinfo.email"),
+            ("profile", "https://www.googleapis.com/auth/userinfo.profile"),
+        ),
+        extra_auth_params=(("access_type", "offline"),),
+        # Forcing consent is what makes Google issue a new refresh token
+        consent_auth_params=(("prompt", "consent"),),
+        incremental_auth_params=(("include_granted_scopes", "true"),),
+        tokeninfo_url="https://oauth2.googleapis.com/tokeninfo",
+        validation_strategy="tokeninfo",
+        avatar_hosts=("googleusercontent.com",),
+    ),
+    ProviderSpec(
+        name="Facebook",
+        platform="facebook",
+        provider_path=(".facebook", "FacebookProvider"),
+        env_vars=EnvVars(
+            client_id="FACEBOOK_CLIENT_ID",
+            client_secret="FACEBOOK_CLIENT_SECRET",
+            redirect_uri="FACEBOOK_REDIRECT_URI",
+            auth_url="FACEBOOK_AUTH_URL",
+            token_url="FACEBOOK_TOKEN_URL",
+            userinfo_url="FACEBOOK_USERINFO_URL",
+            api_url="FACEBOOK_API_URL",
+            tokeninfo_url="FACEBOOK_TOKENINFO_URL"
+        ),
+        auth_url="https://www.facebook.com/v24.0/dialog/oauth",
+        token_url="https://graph.facebook.com/v24.0/oauth/access_token",
+        userinfo_url="https://graph.facebook.com/v24.0/me",
+        api_url="https://graph.facebook.com/v24.0",
+        scope="ads_read,read_insights,business_management",
+        # Facebook uses comma-separated scopes, not space-separated
+        scope_separator=",",
+        userinfo_strategy="query_token",
+        userinfo_fields="id,name,email,picture",
+        # Without it, permissions the user declined before are not asked again
+        incremental_auth_params=(("auth_type", "rerequest"),),
+        refresh_with_access_token=True,
+        tokeninfo_url="https://graph.facebook.com/v24.0/debug_token",
+        validation_strategy="debug_token",
+        # Graph picture URLs point at the lookaside host or the CDN
+        avatar_hosts=("fbcdn.net", "fbsbx.com", "graph.facebook.com"),
+    ),
+    ProviderSpec(
+        name=CUSTOM,
+        platform="custom",
+        provider_path=(".base", "BaseProvider"),
+        env_vars=EnvVars(
+            client_id="APP_CLIENT_ID",
+            client_secret="APP_CLIENT_SECRET",
+            redirect_uri="APP_REDIRECT_URI",
+            auth_url="AUTH_URL",
+            token_url="TOKEN_URL",
+            userinfo_url="USERINFO_URL",
+            oidc_issuer="OIDC_ISSUER"
+        ),
+        editable_endpoints=True,
+    ),
+)
+
+
+def split_scopes(scope: str) -> List[str]:
+    return [part for part in re.split(r"[\s,]+", scope or "") if part]
+
+
+def normalize_scopes(
+    scope: Union[str, Iterable[str], None],
+    aliases: Tuple[Tuple[str, str], ...] = ()
+) -> FrozenSet[str]:
+    """
+    Scope set from a comma- or space-separated string or a list of scopes,
+    with provider aliases mapped to one name so grants compare equal.
+    """
+    parts = split_scopes(scope) if isinstance(scope, str) or scope is None else scope
+    canonical = dict(aliases)
+    return frozenset(canonical.get(part, part) for part in parts)
+
+
+def _getenv(name: str, default: str) -> str:
+    return os.getenv(name, default) if name else default
+
+
+def resolve_defaults(spec: ProviderSpec) -> ProviderDefaults:
+    env_vars = spec.env_vars
+    return ProviderDefaults(
+        client_id=_getenv(env_vars.client_id, ""),
+        client_secret=_getenv(env_vars.client_secret, ""),
+        redirect_uri=_getenv(env_vars.redirect_uri, DEFAULT_REDIRECT_URI),
+        scope=spec.scope,
+        auth_url=_getenv(env_vars.auth_url, spec.auth_url),
+        token_url=_getenv(env_vars.token_url, spec.token_url),
+        userinfo_url=_getenv(env_vars.userinfo_url, spec.userinfo_url),
+        oidc_issuer=_getenv(env_vars.oidc_issuer, spec.oidc_issuer),
+        api_url=_getenv(env_vars.api_url, spec.api_url),
+        tokeninfo_url=_getenv(env_vars.tokeninfo_url, spec.tokeninfo_url),
+    )
+
+
+class ProviderCatalog:
+    """
+    Immutable set of provider specs plus their environment defaults.
+    Built once per process and shared by every session; provider
+    instances only carry the values a user overrode on top of it.
+    """
+
+    __slots__ = ("specs", "defaults", "env_loaded")
+
+    def __init__(self, specs: Tuple[ProviderSpec, ...]):
+        self.specs: Mapping[str, ProviderSpec] = MappingProxyType({spec.name: spec for spec in specs})
+        self.defaults: Mapping[str, ProviderDefaults] = MappingProxyType(
+            {spec.name: resolve_defaults(spec) for spec in specs}
+        )
+        self.env_loaded = any(
+            os.getenv(spec.env_vars.client_id) or os.getenv(spec.env_vars.client_secret)
+            for spec in specs
+        )
+
+    def names(self) -> List[str]:
+        return list(self.specs)
+
+    def name_for_platform(self, platform: str) -> Optional[str]:
+        for spec in self.specs.values():
+            if spec.platform == platform:
+                return spec.name
+        return None
+
+    def provider_class(self, name: str):
+        from importlib import import_module
+
+        module_name, class_name = self.specs[name].provider_path
+        return getattr(import_module(module_name, __package__), class_name)
+
+    def create(self, name: str, **overrides):
+        return self.provider_class(name)(spec=self.specs[name], **overrides)
+
+
+@lru_cache(maxsize=None)
+def get_catalog() -> ProviderCatalog:
+    return ProviderCatalog(SPECS)
+
+
+def get_spec(name: str) -> ProviderSpec:
+    return get_catalog().specs[name]
@@ -1,32 +1,40 @@
-import os
-import requests
+import json
+from typing import Dict, Iterator, List, Optional
+
+from metrics import span
+
 from .base import BaseProvider
+from .catalog import ProviderSpec, get_spec
+from .post_exchange import Step
+from .transport import TransportConfig
+from .ttlcache import TTLCache, token_key
+
+AD_ACCOUNT_FIELDS = "id,account_id,name,account_status,currency"
+BUSINESS_FIELDS = "id,name"
+PAGE_LIMIT = 100
+INVENTORY_TTL = 600.0
+# Items kept per edge in the cached and stored inventory; the rest are left
+# behind a cursor for iter_edge
+INVENTORY_ITEM_LIMIT = 500
+EDGES = {
+    "ad_accounts": ("me/adaccounts", AD_ACCOUNT_FIELDS),
+    "businesses": ("me/businesses", BUSINESS_FIELDS),
+}
+
+# First pages of the discovery batch, shared by the user_info and accounts
+# steps, and the fully paged inventory, both per access token
+_batches = TTLCache(ttl=INVENTORY_TTL)
+_inventories = TTLCache(ttl=INVENTORY_TTL)
 
 
 class FacebookProvider(BaseProvider):
-    def __init__(self):
-        super().__init__(
-            name="Facebook",
-            client_id=os.getenv("FACEBOOK_CLIENT_ID", ""),
-            client_secret=os.getenv("FACEBOOK_CLIENT_SECRET", ""),
-            redirect_uri=os.getenv("FACEBOOK_REDIRECT_URI", "http://localhost:8501"),
-            scope="ads_read,read_insights,business_management"
-        )
-    
-    def get_auth_url(self) -> str:
-        return "https://www.facebook.com/v24.0/dialog/oauth"
-    
-    def get_token_url(self) -> str:
-        return "https://graph.facebook.com/v24.0/oauth/access_token"
+    __slots__ = ()
     
-    def get_userinfo_url(self) -> str:
-        return ""
+    # Graph API calls are slower than Google's token endpoint
+    transport_config = TransportConfig(read_timeout=20.0)
     
-    def get_auth_params(self) -> dict:
-        params = super().get_auth_params()
-        # Facebook uses comma-separated scopes, not space-separated
-        params["scope"] = self.scope.replace(" ", ",")
-        return params
+    def __init__(self, spec: Optional[ProviderSpec] = None, **overrides):
+        super().__init__(spec or get_spec("Facebook"), **overrides)
     
     def exchange_for_long_lived_token(self, short_lived_token: str) -> dict:
         """
@@ -40,13 +48,128 @@ class FacebookProvider(BaseProvider):
             "client_secret": self.client_secret,
             "fb_exchange_token": short_lived_token
         }
-        response = requests.get(self.get_token_url(), params=params)
+        with span("long_lived_exchange", self.platform):
+            response = self.http_get(self.get_token_url(), params=params)
+            response.raise_for_status()
+            return response.json()
+    
+    def graph_batch(self, access_token: str, relative_urls: List[str]) -> List[Dict]:
+        """
+        Send several GET requests in one Graph batch call. Returns each
+        response body in order; a failed entry is its Graph error body.
+        """
+        batch = [{"method": "GET", "relative_url": url} for url in relative_urls]
+        # A batch of GETs is safe to replay even though it is a POST
+        response = self.http_post(
+            self.api_url,
+            idempotent=True,
+            data={"access_token": access_token, "include_headers": "false", "batch": json.dumps(batch)}
+        )
         response.raise_for_status()
-        return response.json()
+        bodies = []
+        for entry in response.json():
+            if not entry:
+                bodies.append({"error": {"message": "Batch request timed out"}})
+                continue
+            body = json.loads(entry.get("body") or "{}")
+            if entry.get("code") != 200 and "error" not in body:
+                body = {"error": {"message": f"Batch request failed with {entry.get('code')}"}}
+            bodies.append(body)
+        return bodies
     
-    def get_env_vars(self) -> dict:
-        return {
-            "client_id": "FACEBOOK_CLIENT_ID",
-            "client_secret": "FACEBOOK_CLIENT_SECRET",
-            "redirect_uri": "FACEBOOK_REDIRECT_URI"
-        }
+    def iter_page_chunks(self, page: Dict) -> Iterator[Dict]:
+        """
+        Yield the pages of a Graph edge starting at ``page``, following the
+        ``paging.next`` cursor so only one page is held at a time.
+        """
+        while page:
+            if "error" in page:
+                raise ValueError(page["error"].get("message", "Graph error"))
+            yield page
+            next_url = page.get("paging", {}).get("next")
+            if not next_url:
+                return
+            response = self.http_get(next_url)
+            response.raise_for_status()
+            page = response.json()
+    
+    def iter_pages(self, page: Dict) -> Iterator[Dict]:
+        """The items of a Graph edge starting at ``page``, one page at a time."""
+        for chunk in self.iter_page_chunks(page):
+            yield from chunk.get("data", [])
+    
+    def iter_edge(self, access_token: str, edge: str, after: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Stream every item of an inventory edge, from the start or from the
+        ``next_cursors`` entry a truncated inventory left for it.
+        """
+        path, fields = EDGES[edge]
+        params = {"access_token": access_token, "fields": fields, "limit": PAGE_LIMIT}
+        if after:
+            params["after"] = after
+        response = self.http_get(f"{self.api_url}/{path}", params=params)
+        response.raise_for_status()
+        return self.iter_pages(response.json())
+    
+    def fetch_inventory_batch(self, access_token: str) -> Dict[str, Dict]:
+        """First pages of /me, /me/adaccounts and /me/businesses from one batch call."""
+        def fetch():
+            with span("graph_batch", self.platform):
+                me, ad_accounts, businesses = self.graph_batch(access_token, [
+                    f"me?fields={self.spec.userinfo_fields}",
+                    *(f"{path}?fields={fields}&limit={PAGE_LIMIT}" for path, fields in EDGES.values()),
+                ])
+            return {"me": me, "ad_accounts": ad_accounts, "businesses": businesses}
+        
+        return _batches.get_or_set(token_key(access_token), fetch)
+    
+    def discover_accounts(self, access_token: str) -> Dict:
+        """
+        Ad accounts and businesses the token can reach, cached per token.
+        Pages are read only until ``INVENTORY_ITEM_LIMIT`` items of an edge
+        are in; the cursor to the rest goes under ``next_cursors`` for
+        ``iter_edge``. Edges the token lacks permission for are reported
+        under ``errors``.
+        """
+        def discover():
+            first_pages = self.fetch_inventory_batch(access_token)
+            inventory = {"ad_accounts": [], "businesses": [], "errors": {}, "next_cursors": {}}
+            with span("account_discovery", self.platform):
+                for edge in EDGES:
+                    try:
+                        for page in self.iter_page_chunks(first_pages[edge]):
+                            inventory[edge].extend(page.get("data", []))
+                            paging = page.get("paging", {})
+                            if len(inventory[edge]) >= INVENTORY_ITEM_LIMIT and paging.get("next"):
+                                # Only the cursor: the next URL carries the token
+                                inventory["next_cursors"][edge] = paging.get("cursors", {}).get("after")
+                                break
+                    except ValueError as e:
+                        inventory["errors"][edge] = str(e)
+            return inventory
+        
+        return _inventories.get_or_set(token_key(access_token), discover)
+    
+    def resolve_user_info(self, tokens: dict) -> Optional[dict]:
+        # /me comes with the discovery batch; a separate call is only a fallback
+        try:
+            me = self.fetch_inventory_batch(tokens["access_token"])["me"]
+        except Exception:
+            me = None
+        if me and "error" not in me:
+            return me
+        return super().resolve_user_info(tokens)
+    
+    def get_post_exchange_steps(self, tokens: dict) -> list:
+        # All only need the short-lived token, so they run side by side;
+        # user_info and accounts share a single discovery batch call
+        steps = super().get_post_exchange_steps(tokens)
+        short_lived_token = tokens["access_token"]
+        steps.append(Step("long_lived_token", lambda _: self.exchange_for_long_lived_token(short_lived_token)))
+        steps.append(Step("accounts", lambda _: self.discover_accounts(short_lived_token)))
+        return steps
+    
+    def refresh(self, tokens: dict) -> dict:
+        # Facebook has no refresh_token grant; a still-valid long-lived
+        # token is re-exchanged for a new long-lived token instead
+        return self.exchange_for_long_lived_token(tokens["access_token"])
@@ -0,0 +1,231 @@
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional, Tuple, Union
+
+from metrics import span
+from storage.pending_flows import PENDING_FLOW_TTL, PendingFlow
+from storage.rows import CompactTokens
+
+from . import resilience, validation
+from .base import BaseProvider, GrantPlan
+from .post_exchange import StepResult, run_steps
+
+# Budget for the whole flow: code exchange plus every post-exchange step
+FLOW_TIMEOUT = 30.0
+# A pending flow is renewed once less than this is left of its TTL, so an
+# authorization URL shown to the user still has time to be completed
+PENDING_RENEW_MARGIN = 300.0
+
+
+class ExchangeResult:
+    __slots__ = ("tokens", "user_info", "accounts", "steps")
+
+    def __init__(self, tokens: Dict, user_info: Optional[Dict], steps: Dict[str, StepResult], accounts: Optional[Dict] = None):
+        self.tokens = tokens
+        self.user_info = user_info
+        self.accounts = accounts
+        self.steps = steps
+
+
+class ProviderFlow:
+    """
+    One provider's authorization within a session: the provider object,
+    its pending flow (state and PKCE verifier), the code, the stored grant
+    of the account being re-authorized, if any, and the results. The grant
+    and results are its payload, which an idle session can spill.
+    """
+    __slots__ = (
+        "provider", "pending", "callback_state", "auth_code", "grant", "tokens", "user_info", "accounts",
+        "obtained_at", "saved", "spilled", "last_used", "__weakref__"
+    )
+
+    def __init__(self, provider: BaseProvider):
+        self.provider = provider
+        self.pending = provider.start_flow()
+        self.callback_state: Optional[str] = None
+        self.auth_code: Optional[str] = None
+        self.grant: Optional[Dict] = None
+        self.tokens: Optional[Dict] = None
+        self.user_info: Optional[Dict] = None
+        self.accounts: Optional[Dict] = None
+        self.obtained_at: Optional[datetime] = None
+        self.saved = False
+        self.spilled = False
+        self.last_used = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        # A callback can carry a state started in another session or replica
+        return self.callback_state or self.pending.state
+
+    def restart(self) -> None:
+        # States are single-use, so every exchange attempt needs a new one
+        self.pending = self.provider.start_flow()
+        self.callback_state = None
+
+    def current_pending(self) -> PendingFlow:
+        """The pending flow, renewed first if it has expired or is about to."""
+        if time.time() - self.pending.created_at > PENDING_FLOW_TTL - PENDING_RENEW_MARGIN:
+            self.pending = self.provider.start_flow()
+        return self.pending
+
+    def clear(self) -> None:
+        self.restart()
+        self.auth_code = None
+        self.grant = None
+        self.tokens = None
+        self.user_info = None
+        self.accounts = None
+        self.obtained_at = None
+        self.saved = False
+
+    def apply(self, result: "ExchangeResult") -> None:
+        grant_refresh_token = (self.grant or {}).get("refresh_token")
+        if grant_refresh_token and not result.tokens.get("refresh_token"):
+            # An incremental grant extends the stored one, whose refresh token stays valid
+            result.tokens["refresh_token"] = grant_refresh_token
+        if result.user_info:
+            self.user_info = result.user_info
+        self.accounts = result.accounts
+        self.tokens = CompactTokens(result.tokens)
+        # Saving the same tokens twice yields the same row, and the same insert ID
+        self.obtained_at = datetime.utcnow()
+        self.saved = False
+
+    @property
+    def payload(self) -> Tuple:
+        return (self.grant, self.tokens, self.user_info, self.accounts)
+
+    def dump_payload(self) -> str:
+        return json.dumps({
+            "grant": dict(self.grant) if self.grant else None,
+            "tokens": dict(self.tokens) if self.tokens else None,
+            "user_info": self.user_info,
+            "accounts": self.accounts,
+            "obtained_at": self.obtained_at.isoformat() if self.obtained_at else None,
+        }, separators=(",", ":"))
+
+    def drop_payload(self) -> None:
+        # The provider, pending state and code stay; they are small and needed to resume
+        self.grant = None
+        self.tokens = None
+        self.user_info = None
+        self.accounts = None
+        self.obtained_at = None
+        self.spilled = True
+
+    def load_payload(self, payload: Optional[str]) -> None:
+        # A payload dropped from the store (past its TTL) leaves the flow empty
+        self.spilled = False
+        if payload is None:
+            return
+        data = json.loads(payload)
+        self.grant = CompactTokens(data["grant"]) if data["grant"] else None
+        self.tokens = CompactTokens(data["tokens"]) if data["tokens"] else None
+        self.user_info = data["user_info"]
+        self.accounts = data["accounts"]
+        self.obtained_at = datetime.fromisoformat(data["obtained_at"]) if data["obtained_at"] else None
+
+
+def resume_grant(provider: BaseProvider, grant: Dict, plan: GrantPlan, timeout: float = FLOW_TIMEOUT) -> Dict:
+    """
+    Tokens for an account whose stored grant already covers the requested
+    scopes, without a consent round trip: one refresh call, or the stored
+    token itself while the provider still reports it valid.
+    """
+    tokens = dict(grant)
+    if plan.action == "refresh":
+        with resilience.deadline(timeout):
+            tokens.update(provider.refresh(tokens))
+        return tokens
+    if plan.action == "reuse":
+        result = validation.validate(provider, tokens["access_token"])
+        if result["expires_at"]:
+            # expires_in is relative to the row built on save
+            tokens["expires_in"] = max(int(result["expires_at"] - time.time()), 0)
+        return tokens
+    raise ValueError(f"A {plan.action} plan needs the user's consent")
+
+
+def exchange_code(
+    provider: BaseProvider,
+    auth_code: str,
+    timeout: float = FLOW_TIMEOUT,
+    state: Optional[str] = None
+) -> ExchangeResult:
+    """
+    Exchange an authorization code and run the provider's post-exchange
+    steps, all within one ``timeout`` budget. A callback ``state`` is
+    verified against the pending-flow store before the code is sent. A
+    successful long-lived token exchange is merged into the returned
+    tokens and discovered accounts are returned as ``accounts``; all
+    step outcomes are left in ``steps``.
+    """
+    with resilience.deadline(timeout) as budget:
+        return _exchange_code(provider, auth_code, budget, state)
+
+
+def _exchange_code(
+    provider: BaseProvider,
+    auth_code: str,
+    budget: resilience.Deadline,
+    state: Optional[str]
+) -> ExchangeResult:
+    with span("token_exchange", provider.platform):
+        # The code is single-use, so this call is never retried
+        response = provider.http_post(provider.get_token_url(), data=provider.get_token_data(auth_code, state))
+        response.raise_for_status()
+        tokens = response.json()
+
+    steps: Dict[str, StepResult] = {}
+    user_info = None
+    accounts = None
+    if "access_token" in tokens:
+        with span("post_exchange", provider.platform):
+            steps = run_steps(provider.get_post_exchange_steps(tokens), timeout=budget.remaining())
+
+        long_lived = steps.get("long_lived_token")
+        if long_lived is not None and long_lived.ok:
+            tokens.update(long_lived.value)
+
+        user_info_result = steps.get("user_info")
+        if user_info_result is not None and user_info_result.ok and user_info_result.value:
+            user_info = user_info_result.value
+
+        accounts_result = steps.get("accounts")
+        if accounts_result is not None and accounts_result.ok:
+            accounts = accounts_result.value
+
+    return ExchangeResult(tokens, user_info, steps, accounts)
+
+
+def exchange_many(
+    codes: Dict[str, Tuple[BaseProvider, str, Optional[str]]],
+    timeout: float = FLOW_TIMEOUT
+) -> Dict[str, Union[ExchangeResult, Exception]]:
+    """
+    Exchange several providers' ``(provider, code, state)`` at once,
+    each with its post-exchange steps, under one shared ``timeout``.
+    Returns each key's result, or the exception its exchange raised, so
+    one failure does not lose the rest.
+    """
+    results: Dict[str, Union[ExchangeResult, Exception]] = {}
+    if not codes:
+        return results
+    with resilience.deadline(timeout), ThreadPoolExecutor(
+        max_workers=len(codes), thread_name_prefix="exchange"
+    ) as executor:
+        futures = {
+            # Each exchange runs in a copy of this context, deadline included
+            key: executor.submit(contextvars.copy_context().run, exchange_code, provider, code, timeout, state)
+            for key, (provider, code, state) in codes.items()
+        }
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                results[key] = e
+    return results
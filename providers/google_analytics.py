@@ -1,37 +1,117 @@
-import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from metrics import span
+
 from .base import BaseProvider
+from .catalog import ProviderSpec, get_spec
+from .post_exchange import Step
+from .ttlcache import TTLCache, token_key
+
+ANALYTICS_SCOPES = frozenset((
+    "https://www.googleapis.com/auth/analytics.readonly",
+    "https://www.googleapis.com/auth/analytics.edit",
+    "https://www.googleapis.com/auth/analytics",
+))
+PAGE_SIZE = 200
+DISCOVERY_WORKERS = 4
+INVENTORY_TTL = 600.0
+
+# Keyed by (user, granted scopes): what a user can see only changes with the grant
+_inventories = TTLCache(ttl=INVENTORY_TTL)
 
 
 class GoogleAnalyticsProvider(BaseProvider):
-    def __init__(self):
-        super().__init__(
-            name="Google Analytics",
-            client_id=os.getenv("GOOGLE_ANALYTICS_CLIENT_ID", ""),
-            client_secret=os.getenv("GOOGLE_ANALYTICS_CLIENT_SECRET", ""),
-            redirect_uri=os.getenv("GOOGLE_ANALYTICS_REDIRECT_URI", "http://localhost:8501"),
-            scope="https://www.googleapis.com/auth/analytics.readonly openid email profile"
-        )
+    __slots__ = ()
+    
+    def __init__(self, spec: Optional[ProviderSpec] = None, **overrides):
+        super().__init__(spec or get_spec("Google Analytics"), **overrides)
     
-    def get_auth_url(self) -> str:
-        return "https://accounts.google.com/o/oauth2/v2/auth"
+    def iter_admin_pages(self, access_token: str, path: str, items_key: str, params: Optional[Dict] = None) -> Iterator[List[Dict]]:
+        """Yield each page of an Admin API list call, following ``nextPageToken``."""
+        params = dict(params or {}, pageSize=PAGE_SIZE)
+        while True:
+            response = self.http_get(
+                f"{self.api_url}/{path}",
+                headers={"Authorization": f"Bearer {access_token}"},
+                params=params
+            )
+            response.raise_for_status()
+            page = response.json()
+            yield page.get(items_key, [])
+            if not page.get("nextPageToken"):
+                return
+            params["pageToken"] = page["nextPageToken"]
     
-    def get_token_url(self) -> str:
-        return "https://oauth2.googleapis.com/token"
+    def list_properties(self, access_token: str, account: str) -> List[Dict]:
+        return [
+            {
+                "property": item.get("name"),
+                "display_name": item.get("displayName"),
+                "account": account,
+                "property_type": item.get("propertyType"),
+                "time_zone": item.get("timeZone"),
+                "currency_code": item.get("currencyCode"),
+            }
+            for page in self.iter_admin_pages(access_token, "properties", "properties", {"filter": f"parent:{account}"})
+            for item in page
+        ]
     
-    def get_userinfo_url(self) -> str:
-        return ""
+    def discover_accounts(self, access_token: str, user_id: str, scope: str) -> Optional[Dict]:
+        """
+        GA4 accounts and properties the token can read, cached per user and
+        granted scopes. Account summaries are paged in order; each account's
+        full property listing is fetched concurrently as its page arrives.
+        Returns None when the grant has no Analytics scope.
+        """
+        scopes = self.normalize_scopes(scope)
+        if not scopes & ANALYTICS_SCOPES:
+            return None
+        
+        def discover():
+            inventory = {"accounts": [], "properties": [], "errors": {}}
+            listings = {}
+            with span("account_discovery", self.platform), ThreadPoolExecutor(
+                max_workers=DISCOVERY_WORKERS, thread_name_prefix="ga-discovery"
+            ) as executor:
+                for page in self.iter_admin_pages(access_token, "accountSummaries", "accountSummaries"):
+                    for summary in page:
+                        account = summary.get("account")
+                        inventory["accounts"].append({
+                            "account": account,
+                            "display_name": summary.get("displayName"),
+                            "properties": len(summary.get("propertySummaries", [])),
+                        })
+                        # Workers share this call's deadline
+                        listings[account] = executor.submit(
+                            contextvars.copy_context().run, self.list_properties, access_token, account
+                        )
+                for account, listing in listings.items():
+                    try:
+                        inventory["properties"].extend(listing.result())
+                    except Exception as e:
+                        inventory["errors"][f"properties of {account}"] = str(e)
+            return inventory
+        
+        return _inventories.get_or_set((user_id, scopes), discover)
     
-    def get_auth_params(self) -> dict:
-        params = super().get_auth_params()
-        params.update({
-            "access_type": "offline",
-            "prompt": "consent"
-        })
-        return params
+    def get_post_exchange_steps(self, tokens: dict) -> list:
+        steps = super().get_post_exchange_steps(tokens)
+        access_token = tokens["access_token"]
+        # The token response echoes the scopes actually granted
+        scope = tokens.get("scope") or self.scope
+        steps.append(Step(
+            "accounts",
+            lambda deps: self.discover_accounts(access_token, self.user_key(deps["user_info"], access_token), scope),
+            depends_on=("user_info",)
+        ))
+        return steps
     
-    def get_env_vars(self) -> dict:
-        return {
-            "client_id": "GOOGLE_ANALYTICS_CLIENT_ID",
-            "client_secret": "GOOGLE_ANALYTICS_CLIENT_SECRET",
-            "redirect_uri": "GOOGLE_ANALYTICS_REDIRECT_URI"
-        }
+    @staticmethod
+    def user_key(user_info: Optional[Dict], access_token: str) -> str:
+        # Without an identity the cache entry is tied to the token instead
+        if user_info and (user_info.get("sub") or user_info.get("email")):
+            return user_info.get("sub") or user_info["email"]
+        return token_key(access_token)
+
@@ -0,0 +1,134 @@
+import threading
+import time
+from importlib.util import find_spec
+from typing import Dict, Optional, Tuple
+
+from . import transport
+from .transport import TransportConfig
+
+# PyJWT is optional: without it id_tokens are never trusted locally and the
+# userinfo endpoint stays the only source of identity. It is imported on
+# first verification to keep it off the cold-start path.
+JWT_AVAILABLE = find_spec("jwt") is not None
+
+DISCOVERY_TTL = 3600.0
+JWKS_TTL = 3600.0
+# An unknown "kid" forces a JWKS refetch, but no more often than this
+JWKS_MIN_REFRESH_INTERVAL = 30.0
+CLOCK_SKEW = 60
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "RS384", "RS512", "PS256", "PS384", "PS512", "ES256", "ES384", "ES512")
+
+IDENTITY_CLAIMS = ("sub", "email", "email_verified", "name", "given_name", "family_name", "picture", "locale")
+
+
+class TokenVerificationError(Exception):
+    pass
+
+
+def _issuer_variants(issuer: str) -> Tuple[str, ...]:
+    # Google still issues some tokens with a scheme-less "accounts.google.com"
+    bare = issuer.split("://", 1)[-1].rstrip("/")
+    return (issuer.rstrip("/"), bare)
+
+
+class DiscoveryCache:
+    """
+    Process-wide cache of OpenID Provider metadata and signing keys.
+    Both are kept for a TTL; a token signed with a key id that is not in
+    the cached JWKS triggers an early refetch to pick up key rotation.
+    """
+
+    def __init__(self, config: TransportConfig = transport.DEFAULT_CONFIG):
+        self.config = config
+        self._configurations: Dict[str, Tuple[float, dict]] = {}
+        self._jwks: Dict[str, Tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+
+    def _fetch_json(self, url: str) -> dict:
+        response = transport.get(url, config=self.config)
+        response.raise_for_status()
+        return response.json()
+
+    def get_configuration(self, issuer: str) -> dict:
+        issuer = issuer.rstrip("/")
+        now = time.monotonic()
+        with self._lock:
+            cached = self._configurations.get(issuer)
+        if cached and now - cached[0] < DISCOVERY_TTL:
+            return cached[1]
+
+        configuration = self._fetch_json(f"{issuer}/.well-known/openid-configuration")
+        with self._lock:
+            self._configurations[issuer] = (now, configuration)
+        return configuration
+
+    def get_jwks(self, jwks_uri: str, force: bool = False) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._jwks.get(jwks_uri)
+        if cached:
+            age = now - cached[0]
+            if age < JWKS_TTL and not (force and age >= JWKS_MIN_REFRESH_INTERVAL):
+                return cached[1]
+
+        jwks = self._fetch_json(jwks_uri)
+        with self._lock:
+            self._jwks[jwks_uri] = (now, jwks)
+        return jwks
+
+    def _find_key(self, jwks_uri: str, kid: Optional[str]) -> Optional[dict]:
+        for force in (False, True):
+            keys = self.get_jwks(jwks_uri, force=force).get("keys", [])
+            for key in keys:
+                if kid is None or key.get("kid") == kid:
+                    return key
+        return None
+
+    def verify_id_token(self, id_token: str, issuer: str, audience: str) -> dict:
+        if not JWT_AVAILABLE:
+            raise TokenVerificationError("PyJWT is not installed")
+        import jwt
+
+        configuration = self.get_configuration(issuer)
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except jwt.PyJWTError as e:
+            raise TokenVerificationError(f"Malformed id_token: {e}") from e
+
+        supported = configuration.get("id_token_signing_alg_values_supported") or ASYMMETRIC_ALGORITHMS
+        algorithms = [alg for alg in supported if alg in ASYMMETRIC_ALGORITHMS]
+        if header.get("alg") not in algorithms:
+            raise TokenVerificationError(f"Unsupported id_token algorithm: {header.get('alg')}")
+
+        key = self._find_key(configuration["jwks_uri"], header.get("kid"))
+        if key is None:
+            raise TokenVerificationError(f"No signing key found for kid {header.get('kid')}")
+
+        try:
+            claims = jwt.decode(
+                id_token,
+                key=jwt.PyJWK(key, algorithm=header["alg"]).key,
+                algorithms=[header["alg"]],
+                audience=audience,
+                leeway=CLOCK_SKEW,
+                options={"require": ["iss", "sub", "aud", "exp", "iat"]}
+            )
+        except jwt.PyJWTError as e:
+            raise TokenVerificationError(f"Invalid id_token: {e}") from e
+
+        accepted_issuers = _issuer_variants(configuration.get("issuer", issuer)) + _issuer_variants(issuer)
+        if claims["iss"].rstrip("/") not in accepted_issuers:
+            raise TokenVerificationError(f"Unexpected id_token issuer: {claims['iss']}")
+        return claims
+
+
+_discovery_cache = DiscoveryCache()
+
+
+def get_discovery_cache() -> DiscoveryCache:
+    return _discovery_cache
+
+
+def identity_from_claims(claims: dict) -> dict:
+    return {claim: claims[claim] for claim in IDENTITY_CLAIMS if claim in claims}
@@ -0,0 +1,113 @@
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class Step:
+    __slots__ = ("name", "func", "depends_on", "timeout")
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Dict[str, Any]], Any],
+        depends_on: Tuple[str, ...] = (),
+        timeout: Optional[float] = None
+    ):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+
+
+class StepResult:
+    __slots__ = ("value", "error", "elapsed")
+
+    def __init__(self, value: Any = None, error: Optional[Exception] = None, elapsed: float = 0.0):
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class SkippedStep(Exception):
+    pass
+
+
+def run_steps(steps: List[Step], max_workers: Optional[int] = None, timeout: Optional[float] = None) -> Dict[str, StepResult]:
+    """
+    Run post-exchange steps on a thread pool as soon as their dependencies
+    have finished, so the stage takes as long as its slowest branch.
+    Each step gets the values of its dependencies as a dict. A failed or
+    timed-out step only skips the steps that depend on it.
+    """
+    if not steps:
+        return {}
+
+    results: Dict[str, StepResult] = {}
+    pending = {step.name: step for step in steps}
+    running = {}
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(steps), thread_name_prefix="post-exchange")
+
+    try:
+        while pending or running:
+            launched = True
+            while launched:
+                launched = False
+                for name, step in list(pending.items()):
+                    failed = [dep for dep in step.depends_on if dep in results and not results[dep].ok]
+                    if failed:
+                        results[name] = StepResult(error=SkippedStep(f"Skipped because {failed[0]} failed"))
+                        del pending[name]
+                        launched = True
+                    elif all(dep in results for dep in step.depends_on):
+                        inputs = {dep: results[dep].value for dep in step.depends_on}
+                        # Steps see the caller's context, including its deadline
+                        future = executor.submit(contextvars.copy_context().run, step.func, inputs)
+                        running[future] = (step, time.monotonic())
+                        del pending[name]
+                        launched = True
+
+            if not running:
+                for name in pending:
+                    results[name] = StepResult(error=SkippedStep(f"Unresolved dependencies for {name}"))
+                break
+
+            now = time.monotonic()
+            limits = [started + step.timeout for step, started in running.values() if step.timeout is not None]
+            if deadline is not None:
+                limits.append(deadline)
+            wait_for = max(min(limits) - now, 0) if limits else None
+
+            done, _ = wait(list(running), timeout=wait_for, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in done:
+                step, started = running.pop(future)
+                try:
+                    results[step.name] = StepResult(value=future.result(), elapsed=now - started)
+                except Exception as e:
+                    results[step.name] = StepResult(error=e, elapsed=now - started)
+
+            for future, (step, started) in list(running.items()):
+                step_expired = step.timeout is not None and now >= started + step.timeout
+                if step_expired or (deadline is not None and now >= deadline):
+                    running.pop(future)
+                    future.cancel()
+                    results[step.name] = StepResult(
+                        error=TimeoutError(f"{step.name} timed out"),
+                        elapsed=now - started
+                    )
+
+            if deadline is not None and now >= deadline:
+                for name in pending:
+                    results[name] = StepResult(error=TimeoutError(f"{name} timed out"))
+                pending.clear()
+    finally:
+        # Timed-out calls are abandoned, not joined; the transport timeouts bound them
+        executor.shutdown(wait=False)
+
+    return results
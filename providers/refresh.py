@@ -0,0 +1,334 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+from storage.rows import created_epoch, refreshed_row, tokens_from_row
+
+from .base import BaseProvider
+from .catalog import get_catalog
+
+if TYPE_CHECKING:
+    from storage.token_store import TokenStore
+
+# Rows expiring within this window are scheduled; later ones on a later sync
+SYNC_HORIZON = 86400.0
+SYNC_INTERVAL = 3600.0
+
+
+class TokenRecord:
+    __slots__ = ("key", "provider_name", "tokens", "expires_at", "failures", "version")
+
+    def __init__(self, key: str, provider_name: str, tokens: dict, expires_at: float):
+        self.key = key
+        self.provider_name = provider_name
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.failures = 0
+        self.version = 0
+
+
+def expires_at_from(tokens: dict, obtained_at: Optional[float] = None) -> Optional[float]:
+    expires_in = tokens.get("expires_in")
+    if expires_in in (None, ""):
+        return None
+    return (obtained_at if obtained_at is not None else time.time()) + int(expires_in)
+
+
+class RefreshScheduler:
+    """
+    Refreshes tokens ahead of their expiry.
+    Records sit in a min-heap keyed by when they are due, which is
+    ``lead_time`` plus a random jitter before absolute expiry, so tokens
+    issued together do not all hit the token endpoint at the same moment.
+    A bounded thread pool runs the refreshes, and each provider gets its
+    own concurrency limit on top of that.
+    """
+
+    def __init__(
+        self,
+        providers: Dict[str, BaseProvider],
+        lead_time: float = 300.0,
+        jitter: float = 120.0,
+        max_workers: int = 8,
+        provider_concurrency: Optional[Dict[str, int]] = None,
+        retry_delay: float = 30.0,
+        on_refresh: Optional[Callable[[TokenRecord], None]] = None,
+        on_error: Optional[Callable[[TokenRecord, Exception], None]] = None
+    ):
+        self.providers = providers
+        self.lead_time = lead_time
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.on_refresh = on_refresh
+        self.on_error = on_error
+
+        provider_concurrency = provider_concurrency or {}
+        self._slots = {
+            name: threading.BoundedSemaphore(provider_concurrency.get(name, max_workers))
+            for name in providers
+        }
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="token-refresh")
+        self._records: Dict[str, TokenRecord] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, key: str, provider_name: str, tokens: dict, obtained_at: Optional[float] = None) -> Optional[TokenRecord]:
+        if provider_name not in self.providers:
+            raise KeyError(f"Unknown provider: {provider_name}")
+        expires_at = expires_at_from(tokens, obtained_at)
+        if expires_at is None or not self.providers[provider_name].can_refresh(tokens):
+            return None
+
+        with self._cond:
+            record = self._records.get(key)
+            if record is None:
+                record = TokenRecord(key, provider_name, tokens, expires_at)
+                self._records[key] = record
+            else:
+                record.provider_name = provider_name
+                record.tokens = tokens
+                record.expires_at = expires_at
+                record.failures = 0
+            self._push(record, self._due_at(expires_at))
+        return record
+
+    def cancel(self, key: str) -> None:
+        with self._cond:
+            self._records.pop(key, None)
+
+    def get(self, key: str) -> Optional[TokenRecord]:
+        with self._cond:
+            return self._records.get(key)
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._records)
+
+    def start(self) -> "RefreshScheduler":
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="refresh-scheduler", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None and wait:
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def _due_at(self, expires_at: float) -> float:
+        return expires_at - self.lead_time - random.uniform(0, self.jitter)
+
+    def _push(self, record: TokenRecord, due_at: float) -> None:
+        # Bumping the version lazily invalidates any older heap entry
+        record.version += 1
+        heapq.heappush(self._heap, (due_at, next(self._counter), record.key, record.version))
+        self._cond.notify()
+
+    def _run(self) -> None:
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                due_at, _, key, version = self._heap[0]
+                record = self._records.get(key)
+                if record is None or record.version != version:
+                    heapq.heappop(self._heap)
+                    continue
+
+                delay = due_at - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                if not self._slots[record.provider_name].acquire(blocking=False):
+                    # Provider is at its concurrency limit; try again shortly
+                    self._push(record, time.time() + random.uniform(0.1, 1.0))
+                    continue
+                self._executor.submit(self._refresh, record, version, record.provider_name)
+
+    def _refresh(self, record: TokenRecord, version: int, provider_name: str) -> None:
+        provider = self.providers[provider_name]
+        try:
+            refreshed = provider.refresh(record.tokens)
+        except Exception as e:
+            with self._cond:
+                if record.version == version and record.key in self._records:
+                    record.failures += 1
+                    retry_at = time.time() + min(self.retry_delay * 2 ** (record.failures - 1), 3600)
+                    if retry_at < record.expires_at:
+                        self._push(record, retry_at)
+                    else:
+                        self._records.pop(record.key, None)
+            if self.on_error:
+                self.on_error(record, e)
+            return
+        finally:
+            self._slots[provider_name].release()
+
+        tokens = dict(record.tokens)
+        tokens.update(refreshed)
+        with self._cond:
+            if record.version != version or record.key not in self._records:
+                return
+            record.tokens = tokens
+            record.failures = 0
+            record.expires_at = expires_at_from(tokens) or record.expires_at
+            self._push(record, self._due_at(record.expires_at))
+        if self.on_refresh:
+            self.on_refresh(record)
+
+
+class StoreRefresher:
+    """
+    Keeps a ``RefreshScheduler`` fed from a token store and writes refreshed
+    tokens back to it. Rows expiring within ``horizon`` are scheduled on
+    start and again every ``sync_interval`` (which also picks up rows
+    written by other processes); rows upserted through the store itself are
+    scheduled as they are saved. A row whose refresh was given up on is not
+    retried until its token changes.
+    """
+
+    def __init__(
+        self,
+        store: "TokenStore",
+        providers: Dict[str, BaseProvider],
+        horizon: float = SYNC_HORIZON,
+        sync_interval: float = SYNC_INTERVAL,
+        **scheduler_options
+    ):
+        self.store = store
+        self.horizon = horizon
+        self.sync_interval = sync_interval
+        self.refreshed = 0
+        self.failed = 0
+        self.last_error: Optional[str] = None
+        self._platforms = {provider.platform: name for name, provider in providers.items()}
+        self._rows: Dict[str, Dict] = {}
+        # Access token of each row given up on
+        self._given_up: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.scheduler = RefreshScheduler(
+            providers, on_refresh=self._on_refresh, on_error=self._on_error, **scheduler_options
+        )
+
+    def start(self) -> "StoreRefresher":
+        with self._lock:
+            if self._thread is not None:
+                return self
+            self._thread = threading.Thread(target=self._run, name="refresh-sync", daemon=True)
+        self.store.add_replica(self.schedule_row)
+        self.sync()
+        self.scheduler.start()
+        self._thread.start()
+        return self
+
+    def stop(self, wait: bool = True) -> None:
+        self._stopped.set()
+        if self._thread is not None and wait:
+            self._thread.join()
+        self.scheduler.stop(wait=wait)
+
+    def sync(self) -> int:
+        """Schedule the store's rows expiring within the horizon; returns how many."""
+        return sum(self.schedule_row(row) for row in self.store.expiring_before(time.time() + self.horizon))
+
+    def schedule_row(self, row: Dict) -> bool:
+        name = self._platforms.get(row["platform"])
+        if name is None or not row.get("created_at"):
+            return False
+        key = f"{row['platform']}:{row['unique_id']}"
+        tokens = tokens_from_row(row)
+        record = self.scheduler.get(key)
+        with self._lock:
+            # Already scheduled with this token (our own write-back included)
+            if record is not None and record.tokens.get("access_token") == tokens.get("access_token"):
+                return False
+            if self._given_up.get(key) == tokens.get("access_token"):
+                return False
+            self._given_up.pop(key, None)
+            self._rows[key] = row
+        return self.scheduler.schedule(key, name, tokens, created_epoch(row["created_at"])) is not None
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "scheduled": len(self.scheduler),
+                "refreshed": self.refreshed,
+                "failed": self.failed,
+                "last_error": self.last_error,
+            }
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                with self._lock:
+                    self.last_error = f"sync: {e}"
+
+    def _on_refresh(self, record: TokenRecord) -> None:
+        with self._lock:
+            row = self._rows.get(record.key)
+        if row is None:
+            return
+        if self.store.get_current(row["platform"], row["unique_id"]) is None:
+            # Deleted while scheduled; do not bring it back
+            self.scheduler.cancel(record.key)
+            with self._lock:
+                self._rows.pop(record.key, None)
+            return
+        row = refreshed_row(row, record.tokens)
+        try:
+            self.store.upsert(row)
+        except Exception as e:
+            self._on_error(record, e)
+            return
+        with self._lock:
+            self._rows[record.key] = row
+            self.refreshed += 1
+
+    def _on_error(self, record: TokenRecord, error: Exception) -> None:
+        with self._lock:
+            self.failed += 1
+            self.last_error = f"{record.key}: {error}"
+        if self.scheduler.get(record.key) is None:
+            with self._lock:
+                self._given_up[record.key] = record.tokens.get("access_token")
+                self._rows.pop(record.key, None)
+
+
+def configured_providers() -> Dict[str, BaseProvider]:
+    """Providers whose client ID and secret are set in the environment."""
+    catalog = get_catalog()
+    providers = {name: catalog.create(name) for name in catalog.names()}
+    return {name: provider for name, provider in providers.items() if provider.client_id and provider.client_secret}
+
+
+_refreshers: Dict[str, StoreRefresher] = {}
+_refreshers_lock = threading.Lock()
+
+
+def get_store_refresher(store: "TokenStore", providers: Dict[str, BaseProvider], **options) -> StoreRefresher:
+    """The process-wide (not yet started) refresher of ``store``."""
+    key = getattr(store, "path", str(id(store)))
+    with _refreshers_lock:
+        refresher = _refreshers.get(key)
+        if refresher is None:
+            refresher = _refreshers[key] = StoreRefresher(store, providers, **options)
+        return refresher
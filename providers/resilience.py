@@ -0,0 +1,292 @@
+"""
+Retries, deadline budgets and circuit breaking for provider HTTP calls.
+
+``call`` wraps a transport request. Idempotent calls are retried on
+throttling and server errors, waiting for ``Retry-After`` or Facebook's
+usage headers when they ask for longer than the exponential backoff, up
+to ``max_backoff``; a server asking for longer is not retried.
+Every attempt is bounded by the deadline of the surrounding ``deadline()``
+block, and by the caller's circuit breaker, one per provider, which fails
+fast once that provider's calls keep failing.
+"""
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Dict, Iterator, NamedTuple, Optional, Tuple
+
+from . import transport
+from .transport import TransportConfig
+
+if TYPE_CHECKING:
+    import requests
+
+
+class ResilienceError(Exception):
+    pass
+
+
+class CircuitOpenError(ResilienceError):
+    pass
+
+
+class DeadlineExceeded(ResilienceError):
+    pass
+
+
+class RetryPolicy(NamedTuple):
+    max_attempts: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 8.0
+    retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+# Graph error codes for application, user and page level throttling
+GRAPH_THROTTLE_CODES = frozenset((4, 17, 32, 613))
+USAGE_HEADERS = ("x-app-usage", "x-business-use-case-usage", "x-ad-account-usage")
+USAGE_FIELDS = ("call_count", "total_time", "total_cputime", "acc_id_util_pct")
+
+
+class Deadline:
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def clamp(self, timeout: Tuple[float, float]) -> Tuple[float, float]:
+        remaining = self.remaining()
+        return (min(timeout[0], remaining), min(timeout[1], remaining))
+
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(seconds: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """
+    Give every provider call in this block (and in threads started with a
+    copy of this context) one shared time budget. A nested block can only
+    shorten the budget, never extend it.
+    """
+    outer = _deadline.get()
+    if seconds is None:
+        yield outer
+        return
+    budget = Deadline(seconds)
+    if outer is not None and outer.expires_at < budget.expires_at:
+        budget = outer
+    token = _deadline.set(budget)
+    try:
+        yield budget
+    finally:
+        _deadline.reset(token)
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive failures and rejects calls
+    for ``reset_timeout`` seconds. The first call after that is let through
+    as a probe: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._probing:
+                raise CircuitOpenError(f"Circuit open; retry in {max(retry_in, 0):.1f}s")
+            self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            _breakers[name] = breaker
+        return breaker
+
+
+def _retry_after(response: "requests.Response") -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _usage_wait(response: "requests.Response") -> Optional[float]:
+    """
+    Seconds Facebook asks us to back off, from its usage headers.
+    None when no usage header is at its limit.
+    """
+    wait = None
+    for header in USAGE_HEADERS:
+        raw = response.headers.get(header)
+        if not raw:
+            continue
+        try:
+            usage = json.loads(raw)
+        except ValueError:
+            continue
+        # x-app-usage is one dict; the business header maps ids to lists of dicts
+        entries = [usage] if isinstance(usage, dict) and any(field in usage for field in USAGE_FIELDS) else [
+            entry for value in (usage.values() if isinstance(usage, dict) else [])
+            for entry in (value if isinstance(value, list) else [value])
+        ]
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            regain = max(
+                float(entry.get("estimated_time_to_regain_access") or 0) * 60,
+                float(entry.get("reset_time_duration") or 0)
+            )
+            saturated = any(float(entry.get(field) or 0) >= 100 for field in USAGE_FIELDS)
+            if regain or saturated:
+                wait = max(wait or 0.0, regain)
+    return wait
+
+
+def _graph_throttled(response: "requests.Response") -> bool:
+    if response.status_code not in (400, 403):
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    error = body.get("error") if isinstance(body, dict) else None
+    return isinstance(error, dict) and error.get("code") in GRAPH_THROTTLE_CODES
+
+
+def retry_delay(response: "requests.Response", attempt: int, policy: RetryPolicy = DEFAULT_POLICY) -> Optional[float]:
+    """
+    How long to wait before retrying ``response``, or None if it should not
+    be retried. Server-provided waits win over the exponential backoff, but
+    one longer than ``policy.max_backoff`` is not waited out here.
+    """
+    usage_wait = _usage_wait(response)
+    throttled = (
+        response.status_code in policy.retry_statuses
+        or usage_wait is not None and response.status_code >= 400
+        or _graph_throttled(response)
+    )
+    if not throttled:
+        return None
+    backoff = min(policy.backoff * (2 ** attempt), policy.max_backoff)
+    delay = max(backoff, _retry_after(response) or 0.0, usage_wait or 0.0)
+    # Retrying sooner than asked would only be throttled again
+    return delay if delay <= policy.max_backoff else None
+
+
+def call(
+    method: str,
+    url: str,
+    config: TransportConfig = transport.DEFAULT_CONFIG,
+    breaker: Optional[CircuitBreaker] = None,
+    idempotent: bool = False,
+    policy: RetryPolicy = DEFAULT_POLICY,
+    **kwargs
+) -> "requests.Response":
+    """
+    Send a request through the transport. Only ``idempotent`` calls are
+    retried; a retry that would not fit in the current deadline is not
+    attempted and the last response (or error) is returned instead.
+    """
+    import requests
+
+    budget = current_deadline()
+    attempts = policy.max_attempts if idempotent else 1
+    timeout = kwargs.pop("timeout", config.timeout)
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+
+    attempt = 0
+    while True:
+        if budget is not None and budget.expired:
+            raise DeadlineExceeded(f"Deadline exceeded before {method} {url}")
+        if breaker is not None:
+            breaker.allow()
+        try:
+            response = transport.request(
+                method, url, config=config,
+                timeout=budget.clamp(timeout) if budget is not None else timeout,
+                **kwargs
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if breaker is not None:
+                breaker.record_failure()
+            delay = min(policy.backoff * (2 ** attempt), policy.max_backoff)
+            if attempt + 1 >= attempts or budget is not None and delay >= budget.remaining():
+                raise
+        except Exception:
+            # Anything else still resolves a half-open probe
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        else:
+            if breaker is not None:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            delay = retry_delay(response, attempt, policy)
+            if delay is None or attempt + 1 >= attempts or budget is not None and delay >= budget.remaining():
+                return response
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,89 @@
+import threading
+from typing import TYPE_CHECKING, Dict, NamedTuple, Tuple
+from urllib.parse import urlparse
+
+# requests is imported when the first session is built, keeping it off the
+# cold-start path of sessions that never make an outbound call
+if TYPE_CHECKING:
+    import requests
+
+
+class TransportConfig(NamedTuple):
+    pool_connections: int = 4
+    pool_maxsize: int = 16
+    connect_timeout: float = 3.05
+    read_timeout: float = 10.0
+    max_retries: int = 0
+
+    @property
+    def timeout(self) -> Tuple[float, float]:
+        return (self.connect_timeout, self.read_timeout)
+
+
+DEFAULT_CONFIG = TransportConfig()
+
+_sessions: Dict[Tuple[str, TransportConfig], "requests.Session"] = {}
+_sessions_lock = threading.Lock()
+
+
+def _origin(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}".lower()
+
+
+def _build_session(config: TransportConfig) -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    from .cassette import build_adapter, get_cassette
+
+    session = requests.Session()
+    options = dict(
+        pool_connections=config.pool_connections,
+        pool_maxsize=config.pool_maxsize,
+        max_retries=config.max_retries,
+    )
+    cassette = get_cassette()
+    # With a cassette, calls are recorded through it or replayed from it
+    adapter = build_adapter(cassette, **options) if cassette else HTTPAdapter(**options)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url: str, config: TransportConfig = DEFAULT_CONFIG) -> "requests.Session":
+    """
+    Return the keep-alive session for the host of ``url``.
+    Sessions are shared process-wide so repeated calls to the same host
+    reuse pooled connections instead of paying a new TLS handshake.
+    """
+    key = (_origin(url), config)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _build_session(config)
+                _sessions[key] = session
+    return session
+
+
+def request(method: str, url: str, config: TransportConfig = DEFAULT_CONFIG, **kwargs) -> "requests.Response":
+    kwargs.setdefault("timeout", config.timeout)
+    return get_session(url, config).request(method, url, **kwargs)
+
+
+def get(url: str, config: TransportConfig = DEFAULT_CONFIG, **kwargs) -> "requests.Response":
+    return request("GET", url, config=config, **kwargs)
+
+
+def post(url: str, config: TransportConfig = DEFAULT_CONFIG, **kwargs) -> "requests.Response":
+    return request("POST", url, config=config, **kwargs)
+
+
+def close_all() -> None:
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
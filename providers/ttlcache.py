@@ -0,0 +1,87 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Union
+
+
+def token_key(token: str) -> str:
+    # Caches are keyed by a digest so raw tokens never sit in cache keys
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread-safe mapping whose entries expire after ``ttl`` seconds (or a
+    per-entry TTL). Holds at most ``maxsize`` entries, evicting the least
+    recently used.
+    """
+
+    def __init__(self, ttl: float = 300.0, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if time.monotonic() >= entry[0]:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_set(
+        self,
+        key: Hashable,
+        factory: Callable[[], Any],
+        ttl: Union[None, float, Callable[[Any], Optional[float]]] = None
+    ) -> Any:
+        """
+        Return the cached value or build, cache and return a new one.
+        Concurrent misses for the same key wait for the first caller's
+        ``factory`` instead of all calling it. ``ttl`` may be a function of
+        the built value; returning 0 keeps the value out of the cache.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            value = self.get(key, missing)
+            if value is missing:
+                try:
+                    value = factory()
+                    value_ttl = ttl(value) if callable(ttl) else ttl
+                    if value_ttl is None or value_ttl > 0:
+                        self.set(key, value, value_ttl)
+                finally:
+                    with self._lock:
+                        self._loading.pop(key, None)
+        return value
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
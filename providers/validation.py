@@ -0,0 +1,46 @@
+"""
+Token validation against the providers' introspection endpoints (Google
+``tokeninfo``, Graph ``debug_token``).
+
+Results are cached by platform and a digest of the token, never the token
+itself. A valid token is trusted until shortly before its reported expiry
+(capped, so revocations are still noticed); an invalid one stays invalid.
+Concurrent and repeated checks of the same token share a single request,
+so a bulk run over thousands of rows never validates a token twice.
+"""
+import time
+from typing import TYPE_CHECKING, Dict, Optional
+
+from . import resilience
+from .ttlcache import TTLCache, token_key
+
+if TYPE_CHECKING:
+    from .base import BaseProvider
+
+MAX_VALID_TTL = 3600.0
+INVALID_TTL = 86400.0
+EXPIRY_MARGIN = 60.0
+# Budget for one check when the caller has not set a deadline
+VALIDATION_TIMEOUT = 15.0
+
+_results = TTLCache(ttl=MAX_VALID_TTL, maxsize=100_000)
+
+
+def result_ttl(result: Dict, now: Optional[float] = None) -> float:
+    if not result["valid"]:
+        return INVALID_TTL
+    if result.get("expires_at") is None:
+        return MAX_VALID_TTL
+    remaining = result["expires_at"] - (now or time.time()) - EXPIRY_MARGIN
+    return min(max(remaining, 0.0), MAX_VALID_TTL)
+
+
+def validate(provider: "BaseProvider", access_token: str) -> Dict:
+    """Cached ``provider.validate_token``; errors are raised and not cached."""
+    with resilience.deadline(VALIDATION_TIMEOUT):
+        return _results.get_or_set(
+            (provider.platform, token_key(access_token)),
+            lambda: provider.validate_token(access_token),
+            result_ttl
+        )
+
@@ -0,0 +1,13 @@
+from importlib.util import find_spec
+
+
+def _module_available(name: str) -> bool:
+    try:
+        return find_spec(name) is not None
+    except ImportError:
+        return False
+
+
+# Resolved without importing google.cloud.bigquery itself
+BIGQUERY_AVAILABLE = _module_available("google.cloud.bigquery")
+PARQUET_AVAILABLE = _module_available("pyarrow")
@@ -0,0 +1,376 @@
+"""
+Token rows to BigQuery, in one of three write modes (``BIGQUERY_WRITE_MODE``):
+
+    streaming       insertAll with insert IDs; BigQuery drops retried rows best-effort
+    storage_write   Storage Write API committed stream; retries resend at their offset
+    load            NDJSON load jobs named after their rows; for bulk backfills
+
+Every row carries a deterministic ``insert_id`` derived from its platform,
+unique_id and created_at. With ``BIGQUERY_CURRENT_TABLE`` set, ``merge_current``
+collapses the history table into one current row per account.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from metrics import span
+
+from .rows import insert_id
+
+# The google-cloud stack takes most of a second to import, so it is only
+# loaded once a sink actually talks to BigQuery.
+if TYPE_CHECKING:
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+
+
+TOKEN_SCHEMA = [
+    ("email", "STRING", "REQUIRED"),
+    ("name", "STRING", "REQUIRED"),
+    ("unique_id", "STRING", "REQUIRED"),
+    ("platform", "STRING", "REQUIRED"),
+    ("access_token", "STRING", "REQUIRED"),
+    ("refresh_token", "STRING", "NULLABLE"),
+    ("expires_in", "INTEGER", "NULLABLE"),
+    ("scope", "STRING", "NULLABLE"),
+    ("token_type", "STRING", "NULLABLE"),
+    ("refresh_token_expires_in", "INTEGER", "NULLABLE"),
+    ("created_at", "TIMESTAMP", "REQUIRED"),
+    ("accounts", "STRING", "NULLABLE"),
+    ("insert_id", "STRING", "NULLABLE"),
+]
+
+WRITE_MODES = ("streaming", "storage_write", "load")
+DEFAULT_WRITE_MODE = "streaming"
+
+TABLE_READY_TIMEOUT = 10.0
+JOB_TIMEOUT = 300.0
+# A load job that failed on BigQuery's side is retried under the next attempt's ID
+LOAD_JOB_ATTEMPTS = 5
+TRANSIENT_JOB_ERRORS = {"backendError", "internalError", "rateLimitExceeded", "jobInternalError"}
+# Insert IDs this process has written, so a repeated save is not sent again
+RECENT_INSERT_IDS = 100_000
+
+MERGE_SQL = """
+MERGE `{current}` AS current
+USING (
+    SELECT * FROM `{history}`
+    WHERE @since IS NULL OR created_at >= @since
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY platform, unique_id ORDER BY created_at DESC, insert_id DESC) = 1
+) AS latest
+ON current.platform = latest.platform AND current.unique_id = latest.unique_id
+WHEN MATCHED AND latest.created_at > current.created_at THEN
+    UPDATE SET {updates}
+WHEN NOT MATCHED THEN
+    INSERT ({columns}) VALUES ({values})
+"""
+
+_credentials: Dict[str, Tuple[float, dict, "service_account.Credentials"]] = {}
+_clients: Dict[Tuple[str, str], "bigquery.Client"] = {}
+_sinks: Dict[Tuple[str, str, Optional[str], Optional[str]], "BigQuerySink"] = {}
+_lock = threading.Lock()
+
+
+def _clean_path(path: str) -> str:
+    return path.strip().strip('"').strip("'")
+
+
+def _load_credentials(cred_path: str) -> Tuple[dict, "service_account.Credentials"]:
+    from google.oauth2 import service_account
+
+    if not os.path.exists(cred_path):
+        raise FileNotFoundError(f"Credentials file not found: {cred_path}")
+
+    mtime = os.stat(cred_path).st_mtime
+    cached = _credentials.get(cred_path)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    with open(cred_path, 'r') as f:
+        service_account_info = json.load(f)
+
+    if 'project_id' not in service_account_info:
+        raise ValueError("Missing 'project_id' in service account JSON file")
+
+    credentials = service_account.Credentials.from_service_account_info(service_account_info)
+    _credentials[cred_path] = (mtime, service_account_info, credentials)
+    # Clients built from the old key file must not outlive it
+    for key in [key for key in _clients if key[0] == cred_path]:
+        _clients.pop(key).close()
+    return service_account_info, credentials
+
+
+def get_client(cred_path: str, project: Optional[str] = None) -> "bigquery.Client":
+    from google.cloud import bigquery
+
+    cred_path = _clean_path(cred_path)
+    with _lock:
+        service_account_info, credentials = _load_credentials(cred_path)
+        project = project or service_account_info['project_id']
+        client = _clients.get((cred_path, project))
+        if client is None:
+            # BIGQUERY_API_ENDPOINT points the client at a local stand-in
+            endpoint = os.getenv("BIGQUERY_API_ENDPOINT")
+            with span("bigquery_client_setup"):
+                client = bigquery.Client(
+                    credentials=credentials,
+                    project=project,
+                    client_options={"api_endpoint": endpoint} if endpoint else None
+                )
+            _clients[(cred_path, project)] = client
+        return client
+
+
+class BigQuerySink:
+    def __init__(
+        self,
+        cred_path: str,
+        table_id: str,
+        write_mode: Optional[str] = None,
+        current_table_id: Optional[str] = None
+    ):
+        self.cred_path = _clean_path(cred_path)
+        self.table_id = table_id
+        table_parts = table_id.split('.')
+        self.table_project = table_parts[0] if len(table_parts) == 3 else None
+        self.write_mode = write_mode or os.getenv("BIGQUERY_WRITE_MODE") or DEFAULT_WRITE_MODE
+        if self.write_mode not in WRITE_MODES:
+            raise ValueError(f"Unsupported BigQuery write mode: {self.write_mode}")
+        self.current_table_id = current_table_id or os.getenv("BIGQUERY_CURRENT_TABLE") or None
+        self._known_tables = set()
+        self._table_lock = threading.Lock()
+        self._stream = None
+        self._written: "OrderedDict[str, None]" = OrderedDict()
+        # Oldest created_at written since the last MERGE; None before the first
+        # MERGE of the process means the whole history is scanned once
+        self._merge_since: Optional[str] = None
+        self._merged = False
+
+    @property
+    def client(self) -> "bigquery.Client":
+        return get_client(self.cred_path, self.table_project)
+
+    def ensure_table(self, table_id: Optional[str] = None) -> bool:
+        """
+        Make sure a token table (the history table by default) exists,
+        creating it if needed. Returns True when the table was created by
+        this call.
+        """
+        table_id = table_id or self.table_id
+        if table_id in self._known_tables:
+            return False
+
+        from google.cloud import bigquery
+        from google.cloud.exceptions import NotFound
+
+        with self._table_lock:
+            if table_id in self._known_tables:
+                return False
+
+            client = self.client
+            created = False
+            try:
+                self._add_missing_fields(client, client.get_table(table_id))
+            except NotFound:
+                if len(table_id.split('.')) != 3:
+                    raise
+                schema = [
+                    bigquery.SchemaField(name, field_type, mode=mode)
+                    for name, field_type, mode in TOKEN_SCHEMA
+                ]
+                client.create_table(bigquery.Table(table_id, schema=schema), exists_ok=True)
+                self._wait_for_table(client, table_id)
+                created = True
+
+            self._known_tables.add(table_id)
+            return created
+
+    def _add_missing_fields(self, client: "bigquery.Client", table: "bigquery.Table") -> None:
+        # Tables created before a NULLABLE column was added to TOKEN_SCHEMA
+        from google.cloud import bigquery
+
+        existing = {field.name for field in table.schema}
+        missing = [
+            bigquery.SchemaField(name, field_type, mode=mode)
+            for name, field_type, mode in TOKEN_SCHEMA
+            if name not in existing and mode == "NULLABLE"
+        ]
+        if missing:
+            table.schema = list(table.schema) + missing
+            client.update_table(table, ["schema"])
+
+    def _wait_for_table(self, client: "bigquery.Client", table_id: str) -> None:
+        from google.cloud.exceptions import NotFound
+
+        deadline = time.monotonic() + TABLE_READY_TIMEOUT
+        delay = 0.1
+        while True:
+            try:
+                client.get_table(table_id)
+                return
+            except NotFound:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def insert_rows(self, rows: List[dict]) -> list:
+        """
+        Write ``rows`` in the configured mode. Errors come back in the
+        ``insert_rows_json`` format whatever the mode, so the buffered
+        writer settles every mode the same way.
+        """
+        self.ensure_table()
+        rows = [dict(row, insert_id=insert_id(row)) for row in rows]
+        positions = [index for index, row in enumerate(rows) if row["insert_id"] not in self._written]
+        if not positions:
+            return []
+        batch = [rows[index] for index in positions]
+        if self.write_mode == "storage_write":
+            errors = self._append_rows(batch)
+        elif self.write_mode == "load":
+            errors = self._load_rows(batch)
+        else:
+            errors = self._stream_rows(batch)
+
+        failed = {error.get("index") for error in errors or []}
+        written = [row for index, row in enumerate(batch) if index not in failed]
+        for row in written:
+            self._written[row["insert_id"]] = None
+        while len(self._written) > RECENT_INSERT_IDS:
+            self._written.popitem(last=False)
+        if written:
+            self._merge_since = min([row["created_at"] for row in written] + ([self._merge_since] if self._merge_since else []))
+        # Error indexes refer to the caller's rows
+        return [dict(error, index=positions[error["index"]]) for error in errors or []]
+
+    def _stream_rows(self, rows: List[dict]) -> list:
+        from google.cloud.exceptions import NotFound
+
+        deadline = time.monotonic() + TABLE_READY_TIMEOUT
+        delay = 0.1
+        while True:
+            try:
+                with span("bigquery_insert"):
+                    return self.client.insert_rows_json(
+                        self.table_id, rows, row_ids=[row["insert_id"] for row in rows]
+                    )
+            except NotFound:
+                # Streaming inserts can briefly 404 right after table creation
+                if time.monotonic() >= deadline:
+                    self._known_tables.discard(self.table_id)
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    def _append_rows(self, rows: List[dict]) -> list:
+        if self._stream is None:
+            from .storage_write import CommittedStream, get_write_client
+
+            client = self.client
+            with _lock:
+                _, credentials = _load_credentials(self.cred_path)
+            project, dataset, table = (client.project, *self.table_id.split('.'))[-3:]
+            self._stream = CommittedStream(
+                get_write_client(credentials),
+                f"projects/{project}/datasets/{dataset}/tables/{table}",
+                TOKEN_SCHEMA
+            )
+        return self._stream.append(rows)
+
+    def _load_rows(self, rows: List[dict]) -> list:
+        from google.cloud import bigquery
+        from google.cloud.exceptions import Conflict
+
+        client = self.client
+        payload = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            schema=[bigquery.SchemaField(name, field_type, mode=mode) for name, field_type, mode in TOKEN_SCHEMA]
+        )
+        # Job IDs are unique per project, so resubmitting a batch whose first
+        # load went through finds that job instead of loading the rows again
+        batch_key = hashlib.sha256("".join(row["insert_id"] for row in rows).encode()).hexdigest()[:40]
+        for attempt in range(LOAD_JOB_ATTEMPTS):
+            job_id = f"token_load_{batch_key}_{attempt}"
+            with span("bigquery_load"):
+                try:
+                    job = client.load_table_from_file(
+                        io.BytesIO(payload), self.table_id, size=len(payload), job_id=job_id, job_config=job_config
+                    )
+                except Conflict:
+                    job = client.get_job(job_id)
+                try:
+                    job.result(timeout=JOB_TIMEOUT)
+                    return []
+                except Exception:
+                    if not job.done() or not job.error_result:
+                        raise
+            if job.error_result.get("reason") not in TRANSIENT_JOB_ERRORS:
+                message = job.error_result.get("message", "load job failed")
+                return [{"index": index, "errors": [{"reason": "invalid", "message": message}]} for index in range(len(rows))]
+        raise RuntimeError(f"Load job failed {LOAD_JOB_ATTEMPTS} times: {job.error_result.get('message')}")
+
+    def merge_current(self) -> int:
+        """
+        Collapse the history table into the current-token table: the newest
+        row of each (platform, unique_id) replaces an older current row.
+        Only rows written since the last MERGE are scanned. Returns the
+        number of current rows inserted or updated.
+        """
+        from google.cloud import bigquery
+
+        if not self.current_table_id:
+            raise ValueError("No current-token table configured")
+        self.ensure_table()
+        self.ensure_table(self.current_table_id)
+
+        since, self._merge_since = self._merge_since, None
+        if self._merged and since is None:
+            return 0
+        columns = [name for name, _, _ in TOKEN_SCHEMA]
+        query = MERGE_SQL.format(
+            current=self.current_table_id,
+            history=self.table_id,
+            updates=", ".join(f"{column} = latest.{column}" for column in columns),
+            columns=", ".join(columns),
+            values=", ".join(f"latest.{column}" for column in columns)
+        )
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(
+                "since", "TIMESTAMP", datetime.fromisoformat(since) if since and self._merged else None
+            )
+        ])
+        try:
+            with span("bigquery_merge"):
+                job = self.client.query(query, job_config=job_config)
+                job.result(timeout=JOB_TIMEOUT)
+        except Exception:
+            # Rows written meanwhile may be newer; the next MERGE starts at the older of the two
+            if since:
+                self._merge_since = min(filter(None, (since, self._merge_since)))
+            raise
+        self._merged = True
+        return job.num_dml_affected_rows or 0
+
+
+def get_sink(
+    cred_path: str,
+    table_id: str,
+    write_mode: Optional[str] = None,
+    current_table_id: Optional[str] = None
+) -> BigQuerySink:
+    key = (_clean_path(cred_path), table_id, write_mode, current_table_id)
+    with _lock:
+        sink = _sinks.get(key)
+        if sink is None:
+            sink = BigQuerySink(cred_path, table_id, write_mode, current_table_id)
+            _sinks[key] = sink
+        return sink
@@ -0,0 +1,112 @@
+"""
+Token rows streamed out of a token store as NDJSON or Parquet.
+
+Rows are read, transformed and written one chunk at a time, so memory
+stays flat however many rows the store holds. Columns can be projected,
+rows filtered by platform and expiry window, and ``access_token`` and
+``refresh_token`` hashed (sha256 hex, so exports still join on them) or
+redacted on the way out. Parquet needs ``pyarrow``.
+"""
+import hashlib
+import json
+import sys
+from datetime import datetime
+from typing import IO, TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from .bigquery_sink import TOKEN_SCHEMA
+from .rows import TOKEN_FIELDS
+from .token_store import EXPORT_CHUNK_SIZE
+
+if TYPE_CHECKING:
+    from .token_store import TokenStore
+
+EXPORT_FORMATS = ("ndjson", "parquet")
+TOKEN_MODES = ("plain", "hash", "redact")
+SECRET_COLUMNS = ("access_token", "refresh_token")
+REDACTED = "[redacted]"
+
+_FIELD_TYPES = {name: field_type for name, field_type, _ in TOKEN_SCHEMA}
+
+
+def protect_tokens(chunk: List[Dict], mode: str) -> List[Dict]:
+    """Hash or redact the token columns of ``chunk`` in place."""
+    if mode == "plain":
+        return chunk
+    if mode not in TOKEN_MODES:
+        raise ValueError(f"Unknown token mode: {mode}")
+    for row in chunk:
+        for column in SECRET_COLUMNS:
+            value = row.get(column)
+            if value:
+                row[column] = hashlib.sha256(value.encode()).hexdigest() if mode == "hash" else REDACTED
+    return chunk
+
+
+def iter_export(
+    store: "TokenStore",
+    columns: Sequence[str] = TOKEN_FIELDS,
+    platforms: Sequence[str] = (),
+    expires_after: Optional[float] = None,
+    expires_before: Optional[float] = None,
+    tokens: str = "plain",
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[List[Dict]]:
+    """Chunks of export rows; see ``TokenStore.iter_chunks`` for the filters."""
+    for chunk in store.iter_chunks(columns, platforms, expires_after, expires_before, chunk_size):
+        yield protect_tokens(chunk, tokens)
+
+
+def write_ndjson(chunks: Iterable[List[Dict]], stream: IO[str]) -> int:
+    count = 0
+    for chunk in chunks:
+        stream.write("".join(json.dumps(row, separators=(",", ":")) + "\n" for row in chunk))
+        count += len(chunk)
+    return count
+
+
+def parquet_schema(columns: Sequence[str]):
+    import pyarrow as pa
+
+    types = {"STRING": pa.string(), "INTEGER": pa.int64(), "TIMESTAMP": pa.timestamp("us", tz="UTC")}
+    return pa.schema([pa.field(column, types[_FIELD_TYPES[column]]) for column in columns])
+
+
+def write_parquet(chunks: Iterable[List[Dict]], path: str, columns: Sequence[str]) -> int:
+    """One row group per chunk; the file has the schema even when no row matches."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(columns)
+    timestamps = [column for column in columns if _FIELD_TYPES[column] == "TIMESTAMP"]
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            for row in chunk:
+                for column in timestamps:
+                    if row[column]:
+                        row[column] = datetime.fromisoformat(row[column])
+            writer.write_batch(pa.RecordBatch.from_pylist(chunk, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def export(store: "TokenStore", output: Optional[str], fmt: str = "ndjson", **options) -> int:
+    """
+    Write the store's rows to ``output`` (stdout for NDJSON when None) and
+    return how many were written. ``options`` are those of ``iter_export``.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    columns = options.setdefault("columns", TOKEN_FIELDS)
+    unknown = [column for column in columns if column not in TOKEN_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+    chunks = iter_export(store, **options)
+    if fmt == "parquet":
+        if not output:
+            raise ValueError("Parquet exports need an output path")
+        return write_parquet(chunks, output, columns)
+    if not output:
+        return write_ndjson(chunks, sys.stdout)
+    with open(output, "w") as stream:
+        return write_ndjson(chunks, stream)
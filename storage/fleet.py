@@ -0,0 +1,202 @@
+"""
+Health of every stored token, computed column-wise.
+
+The store's platform, expiry, refresh expiry, token presence and scope
+columns are read in batches into pandas columns (categoricals for
+the strings, epoch floats with NaN for "never expires") and kept until the
+store's version changes. Reports are computed from those arrays with NumPy,
+never row by row:
+
+- expiry buckets per platform,
+- accounts at risk within N hours: the access token expires by then and
+  cannot be refreshed the way the provider's ``can_refresh`` allows (no
+  refresh token outlives it, or, on platforms that re-exchange access
+  tokens, it has already expired), so the account needs consent again,
+- refresh-token expiry cliffs: refresh tokens expiring per day,
+- scope coverage: the share of each platform's accounts granting a scope.
+"""
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, NamedTuple, Optional, Tuple
+
+from metrics import span
+from providers.catalog import SPECS
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+    from .token_store import TokenStore
+
+EXPIRY_BUCKETS = ("expired", "< 1 hour", "< 1 day", "< 7 days", "< 30 days", "later", "never")
+# Seconds from now separating the buckets before "never"
+_BUCKET_EDGES = (0.0, 3600.0, 86400.0, 7 * 86400.0, 30 * 86400.0)
+CLIFF_DAYS = 90
+FLEET_BATCH_SIZE = 10_000
+FLEET_COLUMNS = ("platform", "expires_at", "refresh_expires_at", "has_refresh_token", "has_access_token", "scope")
+# Platforms whose access tokens are refreshed by re-exchanging them
+ACCESS_TOKEN_REFRESH_PLATFORMS = frozenset(spec.platform for spec in SPECS if spec.refresh_with_access_token)
+# Reports for the same horizon are reused within a minute
+REPORT_RESOLUTION = 60.0
+SCOPE_SEPARATORS = r"[\s,]+"
+
+
+class FleetReport(NamedTuple):
+    total: int
+    generated_at: float
+    horizon_hours: float
+    # platform x EXPIRY_BUCKETS counts
+    buckets: "pd.DataFrame"
+    # per platform: accounts, expiring, at_risk
+    at_risk: "pd.DataFrame"
+    # day x platform counts of refresh tokens expiring that day
+    refresh_cliffs: "pd.DataFrame"
+    # platform, scope, accounts, coverage (share of accounts with a known scope)
+    scope_coverage: "pd.DataFrame"
+
+
+def load_frame(store: "TokenStore", batch_size: int = FLEET_BATCH_SIZE) -> "pd.DataFrame":
+    import numpy as np
+    import pandas as pd
+
+    frames = [
+        pd.DataFrame({
+            "platform": batch["platform"],
+            "expires_at": np.array(batch["expires_at"], dtype=float),
+            "refresh_expires_at": np.array(batch["refresh_expires_at"], dtype=float),
+            "has_refresh_token": np.array(batch["has_refresh_token"], dtype=bool),
+            "has_access_token": np.array(batch["has_access_token"], dtype=bool),
+            "scope": batch["scope"],
+        })
+        for batch in store.iter_columns(FLEET_COLUMNS, batch_size)
+    ]
+    if not frames:
+        frames = [pd.DataFrame({
+            "platform": [], "expires_at": np.array([], dtype=float), "refresh_expires_at": np.array([], dtype=float),
+            "has_refresh_token": np.array([], dtype=bool), "has_access_token": np.array([], dtype=bool), "scope": []
+        })]
+    frame = pd.concat(frames, ignore_index=True)
+    frame["platform"] = frame["platform"].astype("category")
+    frame["scope"] = frame["scope"].fillna("").astype("category")
+    return frame
+
+
+def _per_platform(codes, platforms: int, values, width: int = 1):
+    import numpy as np
+
+    # One bincount over platform * width + value instead of a loop per platform
+    counts = np.bincount(codes * width + values, minlength=platforms * width)
+    return counts.reshape(platforms, width)
+
+
+def build_report(frame: "pd.DataFrame", horizon_hours: float, now: Optional[float] = None) -> FleetReport:
+    import numpy as np
+    import pandas as pd
+
+    now = time.time() if now is None else now
+    platforms = frame["platform"].cat.categories
+    codes = frame["platform"].cat.codes.to_numpy().astype(np.int64)
+    expires_at = frame["expires_at"].to_numpy()
+    refresh_expires_at = frame["refresh_expires_at"].to_numpy()
+
+    remaining = expires_at - now
+    bucket = np.searchsorted(_BUCKET_EDGES, remaining, side="right")
+    bucket[np.isnan(remaining)] = len(EXPIRY_BUCKETS) - 1
+    buckets = pd.DataFrame(
+        _per_platform(codes, len(platforms), bucket, len(EXPIRY_BUCKETS)),
+        index=pd.Index(platforms, name="platform"),
+        columns=EXPIRY_BUCKETS
+    )
+
+    # NaN compares False: tokens that never expire are never at risk
+    horizon = now + horizon_hours * 3600
+    expiring = expires_at < horizon
+    refreshable = frame["has_refresh_token"].to_numpy() & ~(refresh_expires_at < horizon)
+    # Re-exchanged ahead of expiry while the access token is still valid
+    exchanges = np.isin(np.asarray(platforms, dtype=object), list(ACCESS_TOKEN_REFRESH_PLATFORMS))[codes]
+    refreshable |= exchanges & frame["has_access_token"].to_numpy() & (expires_at > now)
+    at_risk = pd.DataFrame(
+        {
+            "accounts": np.bincount(codes, minlength=len(platforms)),
+            "expiring": np.bincount(codes, weights=expiring, minlength=len(platforms)).astype(np.int64),
+            "at_risk": np.bincount(codes, weights=expiring & ~refreshable, minlength=len(platforms)).astype(np.int64),
+        },
+        index=pd.Index(platforms, name="platform")
+    )
+
+    today = now - now % 86400
+    day = np.floor((refresh_expires_at - today) / 86400)
+    upcoming = (refresh_expires_at >= now) & (day < CLIFF_DAYS)
+    refresh_cliffs = pd.DataFrame(
+        _per_platform(codes[upcoming], len(platforms), day[upcoming].astype(np.int64), CLIFF_DAYS).T,
+        index=pd.Index(pd.to_datetime(today + np.arange(CLIFF_DAYS) * 86400, unit="s").date, name="day"),
+        columns=platforms
+    )
+
+    return FleetReport(
+        total=len(frame),
+        generated_at=now,
+        horizon_hours=horizon_hours,
+        buckets=buckets,
+        at_risk=at_risk,
+        refresh_cliffs=refresh_cliffs,
+        scope_coverage=scope_coverage(frame)
+    )
+
+
+def scope_coverage(frame: "pd.DataFrame") -> "pd.DataFrame":
+    import pandas as pd
+
+    # Accounts share a handful of scope strings; split each distinct one once
+    combos = frame.groupby(["platform", "scope"], observed=True).size().rename("accounts").reset_index()
+    known = combos[combos["scope"] != ""]
+    if known.empty:
+        return pd.DataFrame(columns=["platform", "scope", "accounts", "coverage"])
+    totals = known.groupby("platform", observed=True)["accounts"].sum()
+    scopes = known.assign(scope=known["scope"].astype(str).str.split(SCOPE_SEPARATORS)).explode("scope")
+    scopes = scopes[scopes["scope"] != ""]
+    coverage = scopes.groupby(["platform", "scope"], observed=True)["accounts"].sum().reset_index()
+    coverage["coverage"] = coverage["accounts"] / coverage["platform"].map(totals).astype(float)
+    return coverage.sort_values(["platform", "accounts"], ascending=[True, False], ignore_index=True)
+
+
+class FleetSnapshot:
+    """The fleet columns at one store version, and reports computed from them."""
+
+    def __init__(self, version: int, frame: "pd.DataFrame"):
+        self.version = version
+        self.frame = frame
+        self._reports: Dict[Tuple[float, int], FleetReport] = {}
+        self._lock = threading.Lock()
+
+    def report(self, horizon_hours: float) -> FleetReport:
+        now = time.time()
+        key = (horizon_hours, int(now // REPORT_RESOLUTION))
+        with self._lock:
+            report = self._reports.get(key)
+        if report is None:
+            with span("fleet_report"):
+                report = build_report(self.frame, horizon_hours, now)
+            with self._lock:
+                # Reports from earlier minutes are stale
+                self._reports = {cached: value for cached, value in self._reports.items() if cached[1] == key[1]}
+                self._reports[key] = report
+        return report
+
+
+_snapshots: Dict[str, FleetSnapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_fleet(store: "TokenStore") -> FleetSnapshot:
+    """The cached snapshot of ``store``, reloaded once the store has changed."""
+    version = store.version()
+    key = getattr(store, "path", str(id(store)))
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with span("fleet_load"):
+        snapshot = FleetSnapshot(version, load_frame(store))
+    with _snapshots_lock:
+        _snapshots[key] = snapshot
+    return snapshot
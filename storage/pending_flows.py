@@ -0,0 +1,196 @@
+"""
+Pending authorization flows, keyed by their OAuth2 ``state``.
+
+An authorization URL registers its state and PKCE code verifier here; the
+code exchange takes the record back out, exactly once, and fails if it is
+unknown, expired or belongs to another provider. With a shared backend
+(SQLite on a shared volume, or Redis) the callback can land on any replica.
+
+    PENDING_FLOW_STORE=memory://                       # default, one process
+    PENDING_FLOW_STORE=sqlite:///.data/pending.sqlite3
+    PENDING_FLOW_STORE=redis://localhost:6379/0
+"""
+import base64
+import hashlib
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import urlparse
+
+PENDING_FLOW_TTL = 600.0
+DEFAULT_PENDING_STORE_URL = "memory://"
+STATE_SEPARATOR = "."
+REDIS_KEY_PREFIX = "oauth2:pending:"
+
+_stores: Dict[str, "PendingFlowStore"] = {}
+_stores_lock = threading.Lock()
+
+
+class InvalidStateError(ValueError):
+    pass
+
+
+def new_state(platform: str) -> str:
+    # The platform prefix routes the callback; the random part is the CSRF nonce
+    return f"{platform}{STATE_SEPARATOR}{secrets.token_urlsafe(16)}"
+
+
+def platform_from_state(state: Optional[str]) -> Optional[str]:
+    if not state or STATE_SEPARATOR not in state:
+        return None
+    return state.split(STATE_SEPARATOR, 1)[0]
+
+
+class PendingFlow(NamedTuple):
+    state: str
+    provider: str
+    code_verifier: str
+    created_at: float
+
+    @classmethod
+    def new(cls, provider: str, platform: str) -> "PendingFlow":
+        # 64 URL-safe characters, within RFC 7636's 43-128
+        return cls(new_state(platform), provider, secrets.token_urlsafe(48), time.time())
+
+    @property
+    def code_challenge(self) -> str:
+        digest = hashlib.sha256(self.code_verifier.encode()).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def to_json(self) -> str:
+        return json.dumps(self._asdict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, payload) -> "PendingFlow":
+        return cls(**json.loads(payload))
+
+
+class PendingFlowStore:
+    """
+    Pending flows with a TTL. ``take`` removes the record as it returns it,
+    so a state can only ever be redeemed once.
+    """
+
+    def put(self, flow: PendingFlow, ttl: float = PENDING_FLOW_TTL) -> None:
+        raise NotImplementedError("Subclasses must implement put")
+
+    def take(self, state: str) -> Optional[PendingFlow]:
+        raise NotImplementedError("Subclasses must implement take")
+
+
+class MemoryPendingFlowStore(PendingFlowStore):
+    """Process-local store; only correct with a single app instance."""
+
+    def __init__(self):
+        self._flows: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._purged_at = time.monotonic()
+
+    def put(self, flow: PendingFlow, ttl: float = PENDING_FLOW_TTL) -> None:
+        now = time.monotonic()
+        with self._lock:
+            # Abandoned flows are dropped at most once a minute
+            if now - self._purged_at > 60:
+                self._flows = {state: entry for state, entry in self._flows.items() if entry[0] > now}
+                self._purged_at = now
+            self._flows[flow.state] = (now + ttl, flow)
+
+    def take(self, state: str) -> Optional[PendingFlow]:
+        with self._lock:
+            entry = self._flows.pop(state, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+
+class SQLitePendingFlowStore(PendingFlowStore):
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._purged_at = 0.0
+        with self.connection as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS pending_flows (
+                    state TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS pending_flows_expires_at ON pending_flows (expires_at);
+            """)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def put(self, flow: PendingFlow, ttl: float = PENDING_FLOW_TTL) -> None:
+        now = time.time()
+        with self.connection as connection:
+            if now - self._purged_at > 60:
+                connection.execute("DELETE FROM pending_flows WHERE expires_at <= ?", (now,))
+                self._purged_at = now
+            connection.execute(
+                "INSERT INTO pending_flows (state, payload, expires_at) VALUES (?, ?, ?)",
+                (flow.state, flow.to_json(), now + ttl)
+            )
+
+    def take(self, state: str) -> Optional[PendingFlow]:
+        # DELETE ... RETURNING is atomic, so two replicas cannot both redeem a state
+        with self.connection as connection:
+            record = connection.execute(
+                "DELETE FROM pending_flows WHERE state = ? RETURNING payload, expires_at",
+                (state,)
+            ).fetchone()
+        if record is None or record[1] <= time.time():
+            return None
+        return PendingFlow.from_json(record[0])
+
+
+class RedisPendingFlowStore(PendingFlowStore):
+    """Any server speaking the Redis protocol with GETDEL (Redis 6.2+)."""
+
+    def __init__(self, url: str):
+        import redis
+
+        # RESP2 is spoken by every Redis-compatible server; newer clients default to RESP3
+        self.client = redis.Redis.from_url(url, protocol=2)
+
+    def put(self, flow: PendingFlow, ttl: float = PENDING_FLOW_TTL) -> None:
+        self.client.set(REDIS_KEY_PREFIX + flow.state, flow.to_json(), px=int(ttl * 1000), nx=True)
+
+    def take(self, state: str) -> Optional[PendingFlow]:
+        payload = self.client.getdel(REDIS_KEY_PREFIX + state)
+        return PendingFlow.from_json(payload) if payload else None
+
+
+def _create_store(url: str) -> PendingFlowStore:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryPendingFlowStore()
+    if scheme == "sqlite":
+        # sqlite:///relative/path or sqlite:////absolute/path
+        return SQLitePendingFlowStore(url[len("sqlite:///"):])
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisPendingFlowStore(url)
+    raise ValueError(f"Unsupported pending flow store: {url}")
+
+
+def get_pending_store(url: Optional[str] = None) -> PendingFlowStore:
+    url = url or os.getenv("PENDING_FLOW_STORE") or DEFAULT_PENDING_STORE_URL
+    with _stores_lock:
+        store = _stores.get(url)
+        if store is None:
+            store = _create_store(url)
+            _stores[url] = store
+        return store
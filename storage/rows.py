@@ -0,0 +1,157 @@
+import hashlib
+import json
+import sys
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+TOKEN_FIELDS = (
+    "email",
+    "name",
+    "unique_id",
+    "platform",
+    "access_token",
+    "refresh_token",
+    "expires_in",
+    "scope",
+    "token_type",
+    "refresh_token_expires_in",
+    "created_at",
+    "accounts",
+)
+
+# Token response fields a session keeps; anything else in the response is dropped
+SESSION_TOKEN_FIELDS = (
+    "access_token",
+    "refresh_token",
+    "expires_in",
+    "scope",
+    "token_type",
+    "refresh_token_expires_in",
+    "id_token",
+)
+# Values shared by many sessions are stored once
+_INTERNED_FIELDS = ("scope", "token_type")
+
+
+class CompactTokens(Mapping):
+    """
+    A token response reduced to ``SESSION_TOKEN_FIELDS``, held in slots
+    instead of a dict. Reads like the response: absent fields are missing
+    keys, so ``.get``, ``in`` and ``dict()`` work unchanged.
+    """
+    __slots__ = SESSION_TOKEN_FIELDS
+
+    def __init__(self, tokens: Mapping):
+        for field in SESSION_TOKEN_FIELDS:
+            value = tokens.get(field)
+            if value == "":
+                value = None
+            elif field in _INTERNED_FIELDS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, field: str):
+        value = getattr(self, field, None) if field in SESSION_TOKEN_FIELDS else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return (field for field in SESSION_TOKEN_FIELDS if getattr(self, field) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"CompactTokens({', '.join(self)})"
+
+
+def build_token_row(
+    tokens: Dict,
+    user_info: Optional[Dict],
+    platform: str,
+    created_at: Optional[datetime] = None,
+    accounts: Optional[Dict] = None
+) -> Dict:
+    """
+    Flatten a token response and user info into a token table row.
+    Discovered accounts are stored alongside as a JSON string.
+    Raises ValueError when the user info has no email.
+    """
+    user_info = user_info or {}
+
+    email = ''
+    name = ''
+    unique_id = ''
+
+    if user_info:
+        email = user_info.get('email') or user_info.get('mail') or ''
+        name = user_info.get('name') or user_info.get('display_name') or user_info.get('full_name') or ''
+        if not name and (user_info.get('given_name') or user_info.get('family_name')):
+            name = f"{user_info.get('given_name', '')} {user_info.get('family_name', '')}".strip()
+        unique_id = user_info.get('id') or user_info.get('sub') or user_info.get('user_id') or user_info.get('account_id') or ''
+
+    if not email:
+        raise ValueError("Email not found in user info")
+
+    if not unique_id:
+        unique_id = email
+
+    if not name:
+        name = email.split('@')[0]
+
+    return {
+        "email": email,
+        "name": name,
+        "unique_id": str(unique_id),
+        "platform": platform,
+        "access_token": tokens.get("access_token") or "",
+        "refresh_token": tokens.get("refresh_token") or None,
+        "expires_in": tokens.get("expires_in"),
+        "scope": tokens.get("scope") or None,
+        "token_type": tokens.get("token_type") or None,
+        "refresh_token_expires_in": tokens.get("refresh_token_expires_in"),
+        "created_at": (created_at or datetime.utcnow()).isoformat(),
+        "accounts": json.dumps(accounts, separators=(",", ":")) if accounts else None
+    }
+
+
+def insert_id(row: Dict) -> str:
+    """
+    Deterministic ID of a saved token row. A retried or repeated write of
+    the same save carries the same ID, so BigQuery can drop the duplicate.
+    """
+    key = "\x1f".join((row["platform"], str(row["unique_id"]), row["created_at"]))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def created_epoch(created_at: str) -> float:
+    """Epoch seconds of a row's ``created_at``; naive timestamps are UTC."""
+    parsed = datetime.fromisoformat(created_at)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def refreshed_row(row: Dict, tokens: Dict) -> Dict:
+    """``row`` with refreshed ``tokens``, keeping its identity and account inventory."""
+    refreshed = build_token_row(tokens, user_info_from_row(row), row["platform"])
+    refreshed.update(email=row["email"], name=row["name"], unique_id=row["unique_id"], accounts=row.get("accounts"))
+    return refreshed
+
+
+def tokens_from_row(row: Dict) -> Dict:
+    return {
+        field: row[field]
+        for field in ("access_token", "refresh_token", "expires_in", "scope", "token_type", "refresh_token_expires_in")
+        if row.get(field) not in (None, "")
+    }
+
+
+def accounts_from_row(row: Dict) -> Optional[Dict]:
+    return json.loads(row["accounts"]) if row.get("accounts") else None
+
+
+def user_info_from_row(row: Dict) -> Dict:
+    return {"email": row.get("email"), "name": row.get("name"), "id": row.get("unique_id")}
@@ -0,0 +1,211 @@
+"""
+Memory budgets for what sessions hold server-side.
+
+Each run touches its session with the session's provider flows. A flow's
+payload (grant, tokens, user info, accounts) is what grows with use; the
+provider, pending state and code stay in memory. When a session's flows
+exceed the per-session budget its least recently used flows that are not
+on screen are spilled. When all sessions together exceed the global
+budget, the longest idle sessions are spilled first, and a session idle
+for ``SESSION_IDLE_SECONDS`` is spilled whatever the total.
+
+Spilled payloads go to the token store's ``spilled_sessions`` table, not
+to the saved tokens, and come back into the flow the next time it is used.
+
+    SESSION_MEMORY_BUDGET=67108864       # bytes, all sessions
+    SESSION_MEMORY_PER_SESSION=1048576   # bytes, one session
+    SESSION_IDLE_SECONDS=900
+"""
+import os
+import sys
+import threading
+import time
+import weakref
+from collections.abc import Mapping
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from metrics import REGISTRY
+
+from .token_store import TokenStore
+
+if TYPE_CHECKING:
+    from providers.flow import ProviderFlow
+
+DEFAULT_BUDGET = 64 * 1024 * 1024
+DEFAULT_PER_SESSION = 1024 * 1024
+DEFAULT_IDLE_SECONDS = 900.0
+# Other sessions are only spilled once idle this long, so a run in progress
+# (which touches its session first) is never spilled under it
+MIN_IDLE_SECONDS = 60.0
+SWEEP_INTERVAL = 30.0
+
+
+def deep_sizeof(value, seen: Optional[set] = None) -> int:
+    """Approximate bytes held by a JSON-like value, each object counted once."""
+    if value is None:
+        return 0
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, Mapping):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    return size
+
+
+class _Session:
+    __slots__ = ("flows", "last_seen", "bytes")
+
+    def __init__(self):
+        # Weak, so a session Streamlit has dropped is not kept alive here
+        self.flows: Dict[str, weakref.ref] = {}
+        self.last_seen = time.monotonic()
+        self.bytes = 0
+
+    def live_flows(self) -> Dict[str, "ProviderFlow"]:
+        flows = {name: ref() for name, ref in self.flows.items()}
+        return {name: flow for name, flow in flows.items() if flow is not None}
+
+
+class SessionMemory:
+    def __init__(
+        self,
+        store: TokenStore,
+        budget: int = DEFAULT_BUDGET,
+        per_session: int = DEFAULT_PER_SESSION,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS
+    ):
+        self.store = store
+        self.budget = budget
+        self.per_session = per_session
+        self.idle_seconds = idle_seconds
+        self.spilled = 0
+        self.restored = 0
+        self._sessions: Dict[str, _Session] = {}
+        self._lock = threading.RLock()
+        self._swept_at = time.monotonic()
+
+    def touch(self, session_id: str, flows: Dict[str, "ProviderFlow"], active: Iterable[str] = ()) -> None:
+        """
+        Record a run of ``session_id``: its ``active`` flows (the ones on
+        screen) are restored if spilled, then budgets are enforced.
+        """
+        now = time.monotonic()
+        active = set(active)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = _Session()
+            session.last_seen = now
+            session.flows = {name: weakref.ref(flow) for name, flow in flows.items()}
+            for name in active & flows.keys():
+                flow = flows[name]
+                flow.last_used = now
+                if flow.spilled:
+                    self._restore(session_id, name, flow)
+            session.bytes = self._measure(flows)
+            if session.bytes > self.per_session:
+                self._shrink(session_id, session, flows, active)
+            if session.bytes + self._others_bytes(session_id) > self.budget or now - self._swept_at > SWEEP_INTERVAL:
+                self._sweep(session_id, now)
+            self._publish()
+
+    def restore(self, session_id: str, name: str, flow: "ProviderFlow") -> None:
+        """Bring a spilled flow's payload back before it is read."""
+        if flow.spilled:
+            with self._lock:
+                if flow.spilled:
+                    self._restore(session_id, name, flow)
+                    self._publish()
+
+    def status(self) -> Dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "bytes": sum(session.bytes for session in sessions),
+            "budget": self.budget,
+            "spilled_flows": sum(
+                flow.spilled for session in sessions for flow in session.live_flows().values()
+            ),
+            "spilled": self.spilled,
+            "restored": self.restored,
+        }
+
+    def _measure(self, flows: Dict[str, "ProviderFlow"]) -> int:
+        seen: set = set()
+        return sum(deep_sizeof(flow.payload, seen) for flow in flows.values())
+
+    def _others_bytes(self, session_id: str) -> int:
+        return sum(session.bytes for key, session in self._sessions.items() if key != session_id)
+
+    def _spill(self, session_id: str, name: str, flow: "ProviderFlow") -> None:
+        if flow.spilled or not any(flow.payload):
+            return
+        # Written before it is dropped, so a failed write loses nothing
+        self.store.spill(f"{session_id}:{name}", flow.dump_payload())
+        flow.drop_payload()
+        self.spilled += 1
+
+    def _restore(self, session_id: str, name: str, flow: "ProviderFlow") -> None:
+        flow.load_payload(self.store.unspill(f"{session_id}:{name}"))
+        self.restored += 1
+
+    def _shrink(self, session_id: str, session: _Session, flows: Dict[str, "ProviderFlow"], active: set) -> None:
+        idle = sorted((name for name in flows if name not in active), key=lambda name: flows[name].last_used)
+        for name in idle:
+            self._spill(session_id, name, flows[name])
+            session.bytes = self._measure(flows)
+            if session.bytes <= self.per_session:
+                break
+
+    def _sweep(self, session_id: str, now: float) -> None:
+        self._swept_at = now
+        candidates: List[tuple] = []
+        for key, session in list(self._sessions.items()):
+            flows = session.live_flows()
+            if not flows:
+                # Streamlit dropped the session
+                del self._sessions[key]
+                continue
+            if key != session_id and now - session.last_seen >= MIN_IDLE_SECONDS:
+                candidates.append((session.last_seen, key, session, flows))
+        total = sum(session.bytes for session in self._sessions.values())
+        for last_seen, key, session, flows in sorted(candidates, key=lambda candidate: candidate[0]):
+            if total <= self.budget and now - last_seen < self.idle_seconds:
+                break
+            for name, flow in flows.items():
+                self._spill(key, name, flow)
+            total -= session.bytes
+            session.bytes = self._measure(flows)
+            total += session.bytes
+
+    def _publish(self) -> None:
+        sessions = self._sessions.values()
+        REGISTRY.set_gauge(
+            "oauth_session_memory_bytes", sum(session.bytes for session in sessions),
+            "Bytes of flow payloads held in memory by all sessions"
+        )
+        REGISTRY.set_gauge("oauth_sessions", len(self._sessions), "Sessions tracked by the session memory budget")
+        REGISTRY.set_gauge("oauth_session_spills", self.spilled, "Flow payloads spilled to the token store since start")
+
+
+_managers: Dict[int, SessionMemory] = {}
+_managers_lock = threading.Lock()
+
+
+def get_session_memory(store: TokenStore) -> SessionMemory:
+    """The process-wide manager for ``store``, with budgets from the environment."""
+    with _managers_lock:
+        manager = _managers.get(id(store))
+        if manager is None:
+            manager = _managers[id(store)] = SessionMemory(
+                store,
+                budget=int(os.getenv("SESSION_MEMORY_BUDGET", DEFAULT_BUDGET)),
+                per_session=int(os.getenv("SESSION_MEMORY_PER_SESSION", DEFAULT_PER_SESSION)),
+                idle_seconds=float(os.getenv("SESSION_IDLE_SECONDS", DEFAULT_IDLE_SECONDS))
+            )
+        return manager
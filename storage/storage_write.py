@@ -0,0 +1,183 @@
+"""
+Appends to a BigQuery table through a Storage Write API committed stream.
+
+Every append names the offset it expects to land at. If an append whose
+outcome is unknown (a timeout, a dropped connection) is resent at the same
+offset, BigQuery answers ALREADY_EXISTS instead of writing the rows twice,
+so retries within a stream are exactly-once.
+
+    BIGQUERY_STORAGE_ENDPOINT=127.0.0.1:8766   # plaintext gRPC stand-in
+"""
+import os
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+from metrics import span
+
+if TYPE_CHECKING:
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+    from google.oauth2 import service_account
+
+# google.rpc.Code values carried in AppendRowsResponse.error
+ALREADY_EXISTS = 6
+APPEND_TIMEOUT = 30.0
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def timestamp_micros(value: str) -> int:
+    # Row timestamps are naive UTC ISO strings; the API wants epoch microseconds
+    moment = datetime.fromisoformat(value).replace(tzinfo=None)
+    return (moment - _EPOCH) // _MICROSECOND
+
+
+def row_descriptor(schema: Sequence[Tuple[str, str, str]]):
+    """A proto2 message descriptor and class for rows of a TOKEN_SCHEMA-style schema."""
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    field_types = {
+        "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+        "INTEGER": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+        "TIMESTAMP": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    }
+    file_proto = descriptor_pb2.FileDescriptorProto(name="token_row.proto", syntax="proto2")
+    message = file_proto.message_type.add(name="TokenRow")
+    for number, (name, field_type, _) in enumerate(schema, 1):
+        message.field.add(
+            name=name,
+            number=number,
+            type=field_types[field_type],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message, message_factory.GetMessageClass(pool.FindMessageTypeByName("TokenRow"))
+
+
+def get_write_client(credentials: "service_account.Credentials") -> "BigQueryWriteClient":
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+
+    endpoint = os.getenv("BIGQUERY_STORAGE_ENDPOINT")
+    if endpoint:
+        import grpc
+        from google.cloud.bigquery_storage_v1.services.big_query_write.transports import BigQueryWriteGrpcTransport
+
+        # A local stand-in speaks plaintext gRPC
+        return BigQueryWriteClient(transport=BigQueryWriteGrpcTransport(channel=grpc.insecure_channel(endpoint)))
+    return BigQueryWriteClient(credentials=credentials)
+
+
+class CommittedStream:
+    """
+    One committed write stream on a table. Not thread-safe; the buffered
+    writer appends from its single worker thread.
+    """
+
+    def __init__(self, client: "BigQueryWriteClient", table_path: str, schema: Sequence[Tuple[str, str, str]]):
+        self.client = client
+        self.table_path = table_path
+        self.schema = schema
+        self.name: Optional[str] = None
+        self.offset = 0
+        self._descriptor, self._row_class = row_descriptor(schema)
+        # Insert IDs and offset of an append whose outcome is unknown
+        self._unconfirmed: Optional[Tuple[Tuple[str, ...], int]] = None
+
+    def append(self, rows: List[Dict]) -> list:
+        """
+        Append ``rows`` (which carry an ``insert_id``). Returns row errors in
+        the ``insert_rows_json`` format; transport failures raise.
+        """
+        if self._unconfirmed is not None:
+            ids, offset = self._unconfirmed
+            if tuple(row["insert_id"] for row in rows[:len(ids)]) != ids:
+                # The rows are no longer resent as they were; their offset means
+                # nothing on a new stream, and insert IDs catch any duplicate
+                self.reset()
+            else:
+                errors = self._send(rows[:len(ids)], offset)
+                if errors:
+                    return errors + _stopped(range(len(ids), len(rows)))
+                rest = self._send(rows[len(ids):]) if len(rows) > len(ids) else []
+                return [dict(error, index=error["index"] + len(ids)) for error in rest]
+        return self._send(rows)
+
+    def reset(self) -> None:
+        self.name = None
+        self.offset = 0
+        self._unconfirmed = None
+
+    def _create(self) -> None:
+        from google.cloud.bigquery_storage_v1 import types
+
+        with span("bigquery_write_stream"):
+            stream = self.client.create_write_stream(
+                parent=self.table_path,
+                write_stream=types.WriteStream(type_=types.WriteStream.Type.COMMITTED)
+            )
+        self.name = stream.name
+        self.offset = 0
+
+    def _send(self, rows: List[Dict], offset: Optional[int] = None) -> list:
+        from google.api_core.exceptions import NotFound
+        from google.cloud.bigquery_storage_v1 import types
+
+        if not rows:
+            return []
+        if self.name is None:
+            self._create()
+        if offset is None:
+            offset = self.offset
+        request = types.AppendRowsRequest(
+            write_stream=self.name,
+            offset=offset,
+            proto_rows=types.AppendRowsRequest.ProtoData(
+                writer_schema=types.ProtoSchema(proto_descriptor=self._descriptor),
+                rows=types.ProtoRows(serialized_rows=[self._serialize(row) for row in rows])
+            )
+        )
+        self._unconfirmed = (tuple(row["insert_id"] for row in rows), offset)
+        try:
+            with span("bigquery_append"):
+                responses = self.client.append_rows(
+                    iter([request]),
+                    timeout=APPEND_TIMEOUT,
+                    metadata=(("x-goog-request-params", f"write_stream={self.name}"),)
+                )
+                response = next(iter(responses), None)
+        except NotFound:
+            # Streams are garbage-collected when idle; the retry opens a new one
+            self.reset()
+            raise
+        if response is None:
+            # The connection closed before the append was answered; it may still have landed
+            raise ConnectionError("AppendRows stream closed without a response")
+        self._unconfirmed = None
+
+        if response.row_errors:
+            # The whole request was rejected; rows without an error can be resent
+            rejected = {error.index: error.message for error in response.row_errors}
+            return [
+                {"index": index, "errors": [{"reason": "invalid", "message": rejected[index]}]}
+                if index in rejected else {"index": index, "errors": [{"reason": "stopped"}]}
+                for index in range(len(rows))
+            ]
+        if response.error.code and response.error.code != ALREADY_EXISTS:
+            self.reset()
+            raise RuntimeError(f"AppendRows failed: {response.error.message}")
+        self.offset = offset + len(rows)
+        return []
+
+    def _serialize(self, row: Dict) -> bytes:
+        values = {}
+        for name, field_type, _ in self.schema:
+            value = row.get(name)
+            if value is None:
+                continue
+            values[name] = timestamp_micros(value) if field_type == "TIMESTAMP" else value
+        return self._row_class(**values).SerializeToString()
+
+
+def _stopped(indexes) -> list:
+    return [{"index": index, "errors": [{"reason": "stopped"}]} for index in indexes]
@@ -0,0 +1,344 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from .rows import TOKEN_FIELDS, created_epoch
+
+DEFAULT_STORE_PATH = ".data/tokens.sqlite3"
+# Spilled session payloads nobody came back for are dropped after a day
+SPILL_TTL = 86400.0
+EXPORT_CHUNK_SIZE = 1000
+# Columns readable by iter_columns that are computed rather than stored
+DERIVED_COLUMNS = {
+    "has_refresh_token": "refresh_token IS NOT NULL",
+    "has_access_token": "COALESCE(access_token, '') != ''",
+}
+
+_stores: Dict[str, "SQLiteTokenStore"] = {}
+_stores_lock = threading.Lock()
+
+
+def _expiry(row: Dict, field: str) -> Optional[float]:
+    seconds = row.get(field)
+    if seconds in (None, "") or not row.get("created_at"):
+        return None
+    return created_epoch(row["created_at"]) + int(seconds)
+
+
+class TokenStore:
+    """
+    Current token per (platform, unique_id). Re-authorizing an account
+    replaces its row instead of adding another one. Replicas are called
+    with every row after it is committed.
+    """
+
+    def __init__(self):
+        self._replicas: List[Callable[[Dict], None]] = []
+
+    def add_replica(self, replica: Callable[[Dict], None]) -> None:
+        self._replicas.append(replica)
+
+    def upsert(self, row: Dict) -> None:
+        self._upsert(row)
+        for replica in self._replicas:
+            replica(row)
+
+    def upsert_many(self, rows: List[Dict]) -> None:
+        """
+        Upsert several rows in one write. Replicas are only called once
+        every row is committed.
+        """
+        self._upsert_many(rows)
+        for row in rows:
+            for replica in self._replicas:
+                replica(row)
+
+    def _upsert(self, row: Dict) -> None:
+        raise NotImplementedError("Subclasses must implement _upsert")
+
+    def _upsert_many(self, rows: List[Dict]) -> None:
+        for row in rows:
+            self._upsert(row)
+
+    def get_current(self, platform: str, unique_id: str) -> Optional[Dict]:
+        raise NotImplementedError("Subclasses must implement get_current")
+
+    def expiring_before(self, timestamp: float, platform: Optional[str] = None) -> Iterator[Dict]:
+        raise NotImplementedError("Subclasses must implement expiring_before")
+
+    def iter_rows(self, platform: Optional[str] = None) -> Iterator[Dict]:
+        raise NotImplementedError("Subclasses must implement iter_rows")
+
+    def iter_chunks(
+        self,
+        columns: Sequence[str] = TOKEN_FIELDS,
+        platforms: Sequence[str] = (),
+        expires_after: Optional[float] = None,
+        expires_before: Optional[float] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[List[Dict]]:
+        """
+        Rows in lists of at most ``chunk_size``, with only ``columns``.
+        ``expires_before`` keeps tokens expiring before that epoch time;
+        ``expires_after`` keeps those expiring later or never.
+        """
+        raise NotImplementedError("Subclasses must implement iter_chunks")
+
+    def iter_columns(self, columns: Sequence[str], batch_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Dict[str, list]]:
+        """
+        Every row's ``columns`` in batches, each batch a dict of column
+        lists. Besides the stored columns this includes the absolute
+        ``expires_at``/``refresh_expires_at`` and ``DERIVED_COLUMNS``.
+        """
+        raise NotImplementedError("Subclasses must implement iter_columns")
+
+    def version(self) -> int:
+        """A number that changes whenever any row is written or deleted, by any process."""
+        raise NotImplementedError("Subclasses must implement version")
+
+    def list_accounts(self, platform: str) -> List[Dict]:
+        raise NotImplementedError("Subclasses must implement list_accounts")
+
+    def delete(self, platform: str, unique_id: str) -> None:
+        raise NotImplementedError("Subclasses must implement delete")
+
+    def count(self) -> int:
+        raise NotImplementedError("Subclasses must implement count")
+
+    def spill(self, key: str, payload: str) -> None:
+        """
+        Park an idle session's payload under ``key``. Spilled payloads are
+        kept apart from the saved tokens and never replicated.
+        """
+        raise NotImplementedError("Subclasses must implement spill")
+
+    def unspill(self, key: str) -> Optional[str]:
+        """Take a spilled payload back out; None if it is gone."""
+        raise NotImplementedError("Subclasses must implement unspill")
+
+
+class SQLiteTokenStore(TokenStore):
+    _COLUMNS = TOKEN_FIELDS + ("expires_at", "refresh_expires_at")
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        super().__init__()
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._create_schema()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections are per thread; WAL lets readers run alongside the writer
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self) -> None:
+        with self.connection as connection:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    platform TEXT NOT NULL,
+                    unique_id TEXT NOT NULL,
+                    email TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    access_token TEXT NOT NULL,
+                    refresh_token TEXT,
+                    expires_in INTEGER,
+                    scope TEXT,
+                    token_type TEXT,
+                    refresh_token_expires_in INTEGER,
+                    created_at TEXT NOT NULL,
+                    expires_at REAL,
+                    refresh_expires_at REAL,
+                    accounts TEXT,
+                    PRIMARY KEY (platform, unique_id)
+                );
+                CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at);
+                CREATE TABLE IF NOT EXISTS store_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    version INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO store_version (id, version) VALUES (0, 0);
+                CREATE TRIGGER IF NOT EXISTS tokens_inserted AFTER INSERT ON tokens
+                    BEGIN UPDATE store_version SET version = version + 1; END;
+                CREATE TRIGGER IF NOT EXISTS tokens_updated AFTER UPDATE ON tokens
+                    BEGIN UPDATE store_version SET version = version + 1; END;
+                CREATE TRIGGER IF NOT EXISTS tokens_deleted AFTER DELETE ON tokens
+                    BEGIN UPDATE store_version SET version = version + 1; END;
+                CREATE TABLE IF NOT EXISTS spilled_sessions (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    spilled_at REAL NOT NULL
+                );
+            """)
+            # Stores created before a column existed get it added in place
+            existing = {record["name"] for record in connection.execute("PRAGMA table_info(tokens)")}
+            if "accounts" not in existing:
+                connection.execute("ALTER TABLE tokens ADD COLUMN accounts TEXT")
+
+    def _upsert(self, row: Dict) -> None:
+        self._upsert_many([row])
+
+    def _upsert_many(self, rows: List[Dict]) -> None:
+        columns = ", ".join(self._COLUMNS)
+        placeholders = ", ".join(f":{column}" for column in self._COLUMNS)
+        # A token refresh does not rediscover accounts, so keep the stored ones
+        updates = ", ".join(
+            f"{column} = COALESCE(excluded.{column}, tokens.{column})" if column == "accounts"
+            else f"{column} = excluded.{column}"
+            for column in self._COLUMNS if column not in ("platform", "unique_id")
+        )
+        values = [
+            dict(
+                row,
+                expires_at=_expiry(row, "expires_in"),
+                refresh_expires_at=_expiry(row, "refresh_token_expires_in")
+            )
+            for row in rows
+        ]
+        # One transaction for the whole batch
+        with self.connection as connection:
+            connection.executemany(
+                f"INSERT INTO tokens ({columns}) VALUES ({placeholders}) "
+                f"ON CONFLICT (platform, unique_id) DO UPDATE SET {updates}",
+                [{column: value.get(column) for column in self._COLUMNS} for value in values]
+            )
+
+    def _row(self, record: sqlite3.Row) -> Dict:
+        return {field: record[field] for field in TOKEN_FIELDS}
+
+    def get_current(self, platform: str, unique_id: str) -> Optional[Dict]:
+        record = self.connection.execute(
+            "SELECT * FROM tokens WHERE platform = ? AND unique_id = ?",
+            (platform, str(unique_id))
+        ).fetchone()
+        return self._row(record) if record else None
+
+    def expiring_before(self, timestamp: float, platform: Optional[str] = None) -> Iterator[Dict]:
+        query = "SELECT * FROM tokens WHERE expires_at < ?"
+        params: list = [timestamp]
+        if platform:
+            query += " AND platform = ?"
+            params.append(platform)
+        for record in self.connection.execute(query + " ORDER BY expires_at", params):
+            yield self._row(record)
+
+    def iter_rows(self, platform: Optional[str] = None) -> Iterator[Dict]:
+        if platform:
+            cursor = self.connection.execute("SELECT * FROM tokens WHERE platform = ?", (platform,))
+        else:
+            cursor = self.connection.execute("SELECT * FROM tokens")
+        for record in cursor:
+            yield self._row(record)
+
+    def iter_chunks(
+        self,
+        columns: Sequence[str] = TOKEN_FIELDS,
+        platforms: Sequence[str] = (),
+        expires_after: Optional[float] = None,
+        expires_before: Optional[float] = None,
+        chunk_size: int = EXPORT_CHUNK_SIZE
+    ) -> Iterator[List[Dict]]:
+        unknown = [column for column in columns if column not in TOKEN_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+        conditions = []
+        params: list = []
+        if platforms:
+            conditions.append(f"platform IN ({', '.join('?' for _ in platforms)})")
+            params.extend(platforms)
+        if expires_after is not None:
+            conditions.append("(expires_at >= ? OR expires_at IS NULL)")
+            params.append(expires_after)
+        if expires_before is not None:
+            conditions.append("expires_at < ?")
+            params.append(expires_before)
+        query = f"SELECT {', '.join(columns)} FROM tokens"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        # Unselected columns never leave SQLite, and rows leave it one chunk at a time
+        cursor = self.connection.execute(query, params)
+        try:
+            while True:
+                records = cursor.fetchmany(chunk_size)
+                if not records:
+                    return
+                yield [dict(zip(columns, record)) for record in records]
+        finally:
+            cursor.close()
+
+    def iter_columns(self, columns: Sequence[str], batch_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Dict[str, list]]:
+        unknown = [column for column in columns if column not in self._COLUMNS and column not in DERIVED_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+        expressions = ", ".join(
+            f"{DERIVED_COLUMNS[column]} AS {column}" if column in DERIVED_COLUMNS else column for column in columns
+        )
+        cursor = self.connection.execute(f"SELECT {expressions} FROM tokens")
+        try:
+            while True:
+                records = cursor.fetchmany(batch_size)
+                if not records:
+                    return
+                yield dict(zip(columns, map(list, zip(*records))))
+        finally:
+            cursor.close()
+
+    def version(self) -> int:
+        # Kept by triggers, so writes from the CLI or another replica count too
+        return self.connection.execute("SELECT version FROM store_version").fetchone()[0]
+
+    def list_accounts(self, platform: str) -> List[Dict]:
+        # Identity columns only; the picker does not need the tokens
+        return [
+            {"unique_id": record["unique_id"], "email": record["email"], "name": record["name"]}
+            for record in self.connection.execute(
+                "SELECT unique_id, email, name FROM tokens WHERE platform = ? ORDER BY email",
+                (platform,)
+            )
+        ]
+
+    def delete(self, platform: str, unique_id: str) -> None:
+        with self.connection as connection:
+            connection.execute(
+                "DELETE FROM tokens WHERE platform = ? AND unique_id = ?",
+                (platform, str(unique_id))
+            )
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    def spill(self, key: str, payload: str) -> None:
+        now = time.time()
+        with self.connection as connection:
+            connection.execute("DELETE FROM spilled_sessions WHERE spilled_at < ?", (now - SPILL_TTL,))
+            connection.execute(
+                "INSERT OR REPLACE INTO spilled_sessions (key, payload, spilled_at) VALUES (?, ?, ?)",
+                (key, payload, now)
+            )
+
+    def unspill(self, key: str) -> Optional[str]:
+        with self.connection as connection:
+            record = connection.execute(
+                "DELETE FROM spilled_sessions WHERE key = ? RETURNING payload", (key,)
+            ).fetchone()
+        return record["payload"] if record else None
+
+
+def get_store(path: str = DEFAULT_STORE_PATH) -> SQLiteTokenStore:
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = SQLiteTokenStore(path)
+            _stores[path] = store
+        return store
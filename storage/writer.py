@@ -0,0 +1,249 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_SPOOL_PATH = ".spool/bigquery_tokens.ndjson"
+DEFAULT_MERGE_INTERVAL = 300.0
+
+_writers: Dict[str, "BufferedTokenWriter"] = {}
+_writers_lock = threading.Lock()
+
+
+class WriterClosedError(RuntimeError):
+    pass
+
+
+def _classify_errors(errors: list, batch_len: int) -> Tuple[List[int], List[int]]:
+    """
+    Split ``insert_rows_json`` errors into rejected rows and rows that were
+    only stopped because another row in the same request was invalid.
+    """
+    rejected, stopped = [], []
+    for error in errors or []:
+        index = error.get("index")
+        if index is None or not 0 <= index < batch_len:
+            continue
+        reasons = {e.get("reason") for e in error.get("errors", [])}
+        if reasons and reasons <= {"stopped"}:
+            stopped.append(index)
+        else:
+            rejected.append(index)
+    return rejected, stopped
+
+
+class BufferedTokenWriter:
+    """
+    Buffers token rows and flushes them to a sink on a worker thread.
+    Every row is appended to a local NDJSON spool before it is queued, and
+    flushed or rejected rows are recorded in the same file, so rows that
+    never reached the sink are replayed the next time the writer starts.
+    A sink with a ``current_table_id`` also has its history merged into
+    that table, at most every ``merge_interval`` seconds after new rows
+    and once more on close.
+    """
+
+    def __init__(
+        self,
+        sink,
+        spool_path: str = DEFAULT_SPOOL_PATH,
+        batch_size: int = 500,
+        max_batch_age: float = 2.0,
+        retry_delay: float = 5.0,
+        merge_interval: float = DEFAULT_MERGE_INTERVAL
+    ):
+        self.sink = sink
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.max_batch_age = max_batch_age
+        self.retry_delay = retry_delay
+        self.merge_interval = merge_interval
+
+        self.flushed = 0
+        self.failed = 0
+        self.merged = 0
+        self.last_error: Optional[str] = None
+
+        self._pending: List[Tuple[str, float, dict]] = []
+        self._in_flight = 0
+        self._retry_at = 0.0
+        self._merge_at: Optional[float] = None
+        self._closing = False
+        self._cond = threading.Condition()
+
+        self._replay()
+        self._thread = threading.Thread(target=self._run, name="token-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, row: dict) -> str:
+        entry_id = uuid.uuid4().hex
+        with self._cond:
+            if self._closing:
+                raise WriterClosedError("Token writer is closed; row not queued for BigQuery")
+            self._append([{"op": "row", "id": entry_id, "row": row}])
+            self._pending.append((entry_id, time.monotonic(), row))
+            self._cond.notify()
+        return entry_id
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "queued": len(self._pending) + self._in_flight,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "merged": self.merged,
+                "last_error": self.last_error,
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        # A worker still flushing writes its acks and closes the spool itself
+        if not self._thread.is_alive():
+            with self._cond:
+                self._spool.close()
+
+    def _replay(self) -> None:
+        directory = os.path.dirname(self.spool_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        rows: Dict[str, dict] = {}
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash mid-append leaves a truncated last line
+                        continue
+                    if record.get("op") == "row":
+                        rows[record["id"]] = record["row"]
+                    else:
+                        for entry_id in record.get("ids", []):
+                            rows.pop(entry_id, None)
+
+        # Compact the spool down to the rows still waiting for the sink
+        tmp_path = f"{self.spool_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for entry_id, row in rows.items():
+                f.write(json.dumps({"op": "row", "id": entry_id, "row": row}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+        enqueued_at = time.monotonic() - self.max_batch_age
+        self._pending = [(entry_id, enqueued_at, row) for entry_id, row in rows.items()]
+        self._spool = open(self.spool_path, 'a')
+
+    def _append(self, records: List[dict]) -> None:
+        self._spool.write("".join(json.dumps(record) + "\n" for record in records))
+        self._spool.flush()
+        os.fsync(self._spool.fileno())
+
+    def _next_batch(self) -> Optional[List[Tuple[str, float, dict]]]:
+        """
+        The next batch to flush, an empty list when a MERGE is due, or None
+        once the writer is closing and has nothing left it can send.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                if self._pending and now >= self._retry_at:
+                    age = now - self._pending[0][1]
+                    if self._closing or len(self._pending) >= self.batch_size or age >= self.max_batch_age:
+                        batch = self._pending[:self.batch_size]
+                        del self._pending[:self.batch_size]
+                        self._in_flight = len(batch)
+                        return batch
+                    timeout = self.max_batch_age - age
+                elif self._pending and not self._closing:
+                    timeout = self._retry_at - now
+                if self._merge_at is not None:
+                    if self._closing or now >= self._merge_at:
+                        self._merge_at = None
+                        return []
+                    timeout = min(timeout, self._merge_at - now) if timeout is not None else self._merge_at - now
+                if self._closing:
+                    # Anything left is still in the spool and replays on next start
+                    return None
+                self._cond.wait(timeout)
+
+    def _run(self) -> None:
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                if batch:
+                    self._flush(batch)
+                else:
+                    self._merge()
+        finally:
+            with self._cond:
+                if self._closing:
+                    self._spool.close()
+
+    def _merge(self) -> None:
+        try:
+            merged = self.sink.merge_current()
+        except Exception as e:
+            with self._cond:
+                self.last_error = f"MERGE failed: {e}"
+                if not self._closing:
+                    self._merge_at = time.monotonic() + self.retry_delay
+            return
+        with self._cond:
+            self.merged += merged
+
+    def _flush(self, batch: List[Tuple[str, float, dict]]) -> None:
+        try:
+            errors = self.sink.insert_rows([row for _, _, row in batch])
+        except Exception as e:
+            with self._cond:
+                self.last_error = str(e)
+                self._pending[:0] = batch
+                self._in_flight = 0
+                self._retry_at = time.monotonic() + self.retry_delay
+            return
+
+        rejected, stopped = _classify_errors(errors, len(batch))
+        unsettled = set(rejected) | set(stopped)
+        acked = [batch[i][0] for i in range(len(batch)) if i not in unsettled]
+
+        with self._cond:
+            records = []
+            if acked:
+                records.append({"op": "ack", "ids": acked})
+            if rejected:
+                records.append({"op": "fail", "ids": [batch[i][0] for i in rejected]})
+                self.last_error = str(errors)
+            if records:
+                self._append(records)
+            self.flushed += len(acked)
+            self.failed += len(rejected)
+            if acked and self._merge_at is None and getattr(self.sink, "current_table_id", None):
+                self._merge_at = time.monotonic() + self.merge_interval
+            self._pending[:0] = [batch[i] for i in stopped]
+            self._in_flight = 0
+            if stopped and not rejected:
+                self._retry_at = time.monotonic() + self.retry_delay
+
+
+def get_writer(sink, spool_path: str = DEFAULT_SPOOL_PATH, **options) -> BufferedTokenWriter:
+    with _writers_lock:
+        writer = _writers.get(spool_path)
+        if writer is None:
+            writer = BufferedTokenWriter(sink, spool_path, **options)
+            _writers[spool_path] = writer
+        return writer